@@ -0,0 +1,86 @@
+"""
+Measure how long it takes to reconstruct a surface from dense point sets of increasing size.
+
+Points are sampled on a torus (a concave surface that the convex hull cannot represent). Dense point sets
+are decimated before surface reconstruction, therefore reconstruction time should not grow with the number
+of points. The benchmark can be run with any Python that has numpy and vtk (or with Slicer's Python):
+
+  PythonSlicer SurfaceReconstructionBenchmark.py --points 1000 10000 100000 1000000 --output reconstruction.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import VolumeClipLib
+
+def createTorusPoints(numberOfPoints, majorRadius=40.0, minorRadius=15.0):
+  """Returns points randomly sampled on the surface of a torus, with some measurement noise"""
+  randomState = np.random.RandomState(0)
+  majorAngles = randomState.uniform(0, 2 * np.pi, numberOfPoints)
+  minorAngles = randomState.uniform(0, 2 * np.pi, numberOfPoints)
+  radii = majorRadius + minorRadius * np.cos(minorAngles)
+  points = np.column_stack([radii * np.cos(majorAngles), radii * np.sin(majorAngles), minorRadius * np.sin(minorAngles)])
+  return points + randomState.normal(scale=0.1, size=points.shape)
+
+def getTorusDistances(points, majorRadius=40.0, minorRadius=15.0):
+  """Returns distance of points from the torus surface"""
+  radialDistances = np.hypot(points[:, 0], points[:, 1]) - majorRadius
+  return np.abs(np.hypot(radialDistances, points[:, 2]) - minorRadius)
+
+def measure(function, repeat):
+  """Returns the shortest execution time of repeated calls and the result of the last call"""
+  times = []
+  for repeatIndex in range(repeat):
+    startTime = time.perf_counter()
+    result = function()
+    times.append(time.perf_counter() - startTime)
+  return min(times), result
+
+def runBenchmark(pointCounts, maxNumberOfPoints, repeat):
+  from vtk.util import numpy_support
+  results = []
+  for numberOfPoints in pointCounts:
+    points = createTorusPoints(numberOfPoints)
+    if numberOfPoints > maxNumberOfPoints:
+      decimationTimeSec, decimatedPoints = measure(lambda: VolumeClipLib.decimatePoints(points,
+        VolumeClipLib.getDecimationVoxelSize(points, maxNumberOfPoints)), repeat)
+    else:
+      decimationTimeSec, decimatedPoints = 0.0, points
+    totalTimeSec, polyData = measure(lambda: VolumeClipLib.reconstructSurface(points, maxNumberOfPoints), repeat)
+    surfacePoints = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()) if polyData.GetNumberOfPoints() else np.zeros((0, 3))
+    distances = getTorusDistances(surfacePoints)
+    results.append({
+      "numberOfPoints": numberOfPoints,
+      "numberOfDecimatedPoints": len(decimatedPoints),
+      "decimationTimeSec": decimationTimeSec,
+      "totalTimeSec": totalTimeSec,
+      "numberOfSurfacePoints": len(surfacePoints),
+      "surfaceError95PercentileMm": float(np.percentile(distances, 95)) if len(distances) else None,
+      })
+    print("points={0:8d} decimated={1:6d} decimation={2:7.3f}s total={3:7.3f}s error95={4}".format(
+      numberOfPoints, len(decimatedPoints), decimationTimeSec, totalTimeSec,
+      "{0:.2f}mm".format(results[-1]["surfaceError95PercentileMm"]) if len(distances) else "-"))
+  return results
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Measure surface reconstruction time against number of points.")
+  parser.add_argument("--points", type=int, nargs="+", default=[1000, 10000, 100000, 1000000], help="point counts to measure")
+  parser.add_argument("--max-points", type=int, default=5000, help="points are decimated to about this many points")
+  parser.add_argument("--repeat", type=int, default=3, help="number of repetitions (shortest time is reported)")
+  parser.add_argument("--output", help="write results to this JSON file")
+  args = parser.parse_args(argv)
+
+  results = runBenchmark(args.points, args.max_points, args.repeat)
+  if args.output:
+    report = {"maxNumberOfPoints": args.max_points, "results": results}
+    with open(args.output, "w") as outputFile:
+      json.dump(report, outputFile, indent=2)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
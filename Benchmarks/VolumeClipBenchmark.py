@@ -0,0 +1,361 @@
+"""
+Performance benchmark of the VolumeClip module logics, using synthetic data (no download is needed).
+
+Synthetic volumes are generated for all combinations of sizes and scalar types, and each logic entry point
+is timed with synthetic clipping shapes (sphere model, convex hull of markup points, oblique ROI box).
+Wall time, peak resident memory (RSS) and throughput are written to a JSON report. If a baseline report
+is specified then results are compared to it and the script exits with an error if any entry point
+became slower than the tolerance.
+
+Run it in Slicer (it requires the VolumeClip modules and the MRML scene):
+
+  Slicer --no-main-window --python-script VolumeClipBenchmark.py --sizes 64 128 256 512 --output report.json
+  Slicer --no-main-window --python-script VolumeClipBenchmark.py --baseline report-previous-release.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+import vtk
+import slicer
+
+import VolumeClipLib
+from VolumeClipWithModel import VolumeClipWithModelLogic
+from VolumeClipWithRoi import VolumeClipWithRoiLogic
+
+scalarTypes = {"uint8": np.uint8, "int16": np.int16, "float32": np.float32}
+
+#
+# Memory measurement
+#
+
+def getCurrentRss():
+  """Returns current resident set size of the process in bytes (None if it cannot be determined)"""
+  try:
+    import psutil
+    return psutil.Process().memory_info().rss
+  except ImportError:
+    pass
+  try:
+    with open("/proc/self/statm") as statmFile:
+      return int(statmFile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (IOError, OSError, ValueError):
+    return None
+
+class PeakRssMonitor(object):
+  """Samples resident memory size on a background thread to measure the peak memory usage of an operation"""
+
+  def __init__(self, samplingIntervalSec=0.005):
+    self.samplingIntervalSec = samplingIntervalSec
+    self.baselineRss = None
+    self.peakRss = None
+    self._stopEvent = threading.Event()
+    self._thread = None
+
+  def __enter__(self):
+    self.baselineRss = getCurrentRss()
+    self.peakRss = self.baselineRss
+    self._stopEvent.clear()
+    self._thread = threading.Thread(target=self._sample)
+    self._thread.daemon = True
+    self._thread.start()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self._stopEvent.set()
+    self._thread.join()
+    self._updatePeak()
+
+  def _sample(self):
+    while not self._stopEvent.wait(self.samplingIntervalSec):
+      self._updatePeak()
+
+  def _updatePeak(self):
+    rss = getCurrentRss()
+    if rss is not None and (self.peakRss is None or rss > self.peakRss):
+      self.peakRss = rss
+
+#
+# Synthetic data
+#
+
+def createSyntheticVolume(size, scalarType, name="BenchmarkVolume"):
+  """Create a volume node with smoothly varying voxel values, anisotropic spacing and non-zero origin"""
+  k, j, i = np.ogrid[0:size, 0:size, 0:size]
+  voxels = np.empty((size, size, size), dtype=scalarTypes[scalarType])
+  voxels[...] = (i + 2 * j + 3 * k) % 200
+  volumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name)
+  volumeNode.SetSpacing(0.8, 0.9, 1.2)
+  volumeNode.SetOrigin(-0.4 * size, -0.45 * size, -0.6 * size)
+  slicer.util.updateVolumeFromArray(volumeNode, voxels)
+  return volumeNode
+
+def getVolumeCenterAndExtent(volumeNode):
+  bounds = [0.0] * 6
+  volumeNode.GetRASBounds(bounds)
+  center = [(bounds[axis * 2] + bounds[axis * 2 + 1]) / 2.0 for axis in range(3)]
+  size = min(bounds[axis * 2 + 1] - bounds[axis * 2] for axis in range(3))
+  return center, size
+
+def createSphereModel(volumeNode):
+  center, size = getVolumeCenterAndExtent(volumeNode)
+  sphere = vtk.vtkSphereSource()
+  sphere.SetCenter(center)
+  sphere.SetRadius(size * 0.35)
+  sphere.SetPhiResolution(60)
+  sphere.SetThetaResolution(60)
+  sphere.Update()
+  modelNode = slicer.modules.models.logic().AddModel(sphere.GetOutput())
+  modelNode.SetName("BenchmarkSphere")
+  return modelNode
+
+def createMarkupPoints(center, size, numberOfPoints=30):
+  """Random points on the surface of an ellipsoid, as a markup point list would contain"""
+  directions = np.random.RandomState(0).normal(size=(numberOfPoints, 3))
+  directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+  return np.array(center) + directions * size * np.array([0.4, 0.3, 0.35])
+
+def createMarkupHullModel(modelLogic, volumeNode):
+  modelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode", "BenchmarkMarkupHull")
+  center, size = getVolumeCenterAndExtent(volumeNode)
+  modelLogic.updateModelFromPoints(createMarkupPoints(center, size), modelNode)
+  return modelNode
+
+def createSequence(volumeNodes, name="BenchmarkSequence"):
+  """Create a sequence that contains a copy of each volume, and a browser that shows its first frame"""
+  sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", name)
+  for frameIndex, volumeNode in enumerate(volumeNodes):
+    sequenceNode.SetDataNodeAtValue(volumeNode, str(frameIndex))
+  sequenceBrowserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode", name + " browser")
+  sequenceBrowserNode.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+  sequenceBrowserNode.SetSelectedItemNumber(0)
+  return sequenceNode, sequenceBrowserNode
+
+def selectNextFrame(sequenceBrowserNode):
+  sequenceBrowserNode.SetSelectedItemNumber(
+    (sequenceBrowserNode.GetSelectedItemNumber() + 1) % sequenceBrowserNode.GetNumberOfItems())
+
+def createObliqueRoi(volumeNode):
+  center, size = getVolumeCenterAndExtent(volumeNode)
+  roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode", "BenchmarkRoi")
+  roiNode.SetCenter(center)
+  roiNode.SetSize(size * 0.6, size * 0.5, size * 0.4)
+  roiToWorld = vtk.vtkTransform()
+  roiToWorld.Translate(center)
+  roiToWorld.RotateWXYZ(30, 1, 2, 3)
+  roiToWorld.Translate(-center[0], -center[1], -center[2])
+  roiNode.ApplyTransformMatrix(roiToWorld.GetMatrix())
+  return roiNode
+
+#
+# Benchmark
+#
+
+def measure(function, repeat, setup=None):
+  """Returns the shortest wall time and the largest peak RSS of repeated calls"""
+  times = []
+  peakRss = None
+  peakRssIncrease = None
+  for repeatIndex in range(repeat):
+    if setup:
+      setup()
+    with PeakRssMonitor() as monitor:
+      startTime = time.perf_counter()
+      function()
+      times.append(time.perf_counter() - startTime)
+    if monitor.peakRss is not None:
+      peakRss = max(peakRss or 0, monitor.peakRss)
+      peakRssIncrease = max(peakRssIncrease or 0, monitor.peakRss - monitor.baselineRss)
+  return min(times), peakRss, peakRssIncrease
+
+def runBenchmark(sizes, scalarTypeNames, repeat, numberOfThreads, temporaryDir):
+  modelLogic = VolumeClipWithModelLogic()
+  roiLogic = VolumeClipWithRoiLogic()
+  if numberOfThreads:
+    modelLogic.setNumberOfWorkerThreads(numberOfThreads)
+    roiLogic.setNumberOfWorkerThreads(numberOfThreads)
+
+  results = []
+  def addResult(entryPoint, shape, size, scalarType, numberOfVoxels, function, setup=None):
+    timeSec, peakRss, peakRssIncrease = measure(function, repeat, setup)
+    results.append({
+      "entryPoint": entryPoint,
+      "shape": shape,
+      "size": size,
+      "scalarType": scalarType,
+      "timeSec": timeSec,
+      "peakRssBytes": peakRss,
+      "peakRssIncreaseBytes": peakRssIncrease,
+      "voxelsPerSec": numberOfVoxels / timeSec if timeSec > 0 else None,
+      })
+    print("{0:24s} {1:12s} {2:5d}^3 {3:8s} {4:9.4f}s {5:10.3g} voxels/s peak RSS increase: {6} MB".format(
+      entryPoint, shape, size, scalarType, timeSec, results[-1]["voxelsPerSec"] or 0,
+      "{0:.1f}".format(peakRssIncrease / 1024.0 / 1024.0) if peakRssIncrease is not None else "?"))
+    sys.stdout.flush()
+
+  for size in sizes:
+    for scalarType in scalarTypeNames:
+      slicer.mrmlScene.Clear(0)
+      inputVolume = createSyntheticVolume(size, scalarType)
+      outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "BenchmarkOutput")
+      numberOfVoxels = size ** 3
+      inputFilePath = os.path.join(temporaryDir, "VolumeClipBenchmarkInput.nrrd")
+      outputFilePath = os.path.join(temporaryDir, "VolumeClipBenchmarkOutput.nrrd")
+      maskFilePath = os.path.join(temporaryDir, "VolumeClipBenchmarkMask.npz")
+      slicer.util.saveNode(inputVolume, inputFilePath, {"useCompression": False})
+      batchInputVolumes = [inputVolume] + [createSyntheticVolume(size, scalarType, "BenchmarkBatchVolume") for index in range(2)]
+      batchOutputVolumes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode") for volume in batchInputVolumes]
+      maskVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", "BenchmarkMask")
+      # Frames of the sequence are copies of the batch volumes
+      inputSequence, sequenceBrowserNode = createSequence(batchInputVolumes)
+      outputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", "BenchmarkOutputSequence")
+      numberOfSequenceVoxels = numberOfVoxels * inputSequence.GetNumberOfDataNodes()
+
+      # ROI
+      roiNode = createObliqueRoi(inputVolume)
+      addResult("clipVolumeWithRoi", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.clipVolumeWithRoi(roiNode, inputVolume, 0, True, outputVolume))
+      addResult("clipVolumeWithRoi-crop", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.clipVolumeWithRoi(roiNode, inputVolume, 0, True, outputVolume, cropToRoi=True))
+      addResult("clipVolumesWithRoi", "obliqueBox", size, scalarType, numberOfVoxels * len(batchInputVolumes),
+        lambda: roiLogic.clipVolumesWithRoi(roiNode, batchInputVolumes, 0, True, batchOutputVolumes))
+      addResult("clipVolumeFileWithRoi", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.clipVolumeFileWithRoi(roiNode, inputFilePath, 0, True, outputFilePath))
+      addResult("createMaskWithRoi", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.createMaskWithRoi(roiNode, inputVolume, maskVolume))
+      addResult("writeMaskFileWithRoi", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.writeMaskFileWithRoi(roiNode, inputVolume, maskFilePath))
+      addResult("clipSequenceWithRoi", "obliqueBox", size, scalarType, numberOfSequenceVoxels,
+        lambda: roiLogic.clipSequenceWithRoi(roiNode, inputSequence, 0, True, outputSequence))
+
+      # Live ROI clipping: only voxels that entered or left the box are updated after the ROI is moved
+      addResult("startLiveClipping", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.startLiveClipping(roiNode, inputVolume, 0, True, outputVolume))
+      roiCenter = [0.0, 0.0, 0.0]
+      roiNode.GetCenter(roiCenter)
+      roiShifts = [0.0]
+      def moveRoi():
+        roiShifts[0] = 2.0 - roiShifts[0]
+        roiNode.SetCenter(roiCenter[0] + roiShifts[0], roiCenter[1], roiCenter[2])
+      addResult("updateLiveClipping", "obliqueBox", size, scalarType, numberOfVoxels, roiLogic.updateLiveClipping, moveRoi)
+      roiLogic.stopLiveClipping()
+      roiNode.SetCenter(roiCenter)
+
+      # Browsing a sequence: the selected frame is clipped (or taken from the frame cache) when the browser moves to it
+      addResult("startSequenceClipping", "obliqueBox", size, scalarType, numberOfVoxels,
+        lambda: roiLogic.startSequenceClipping(roiNode, sequenceBrowserNode, inputSequence, 0, True, outputVolume))
+      addResult("updateSequenceClipping", "obliqueBox", size, scalarType, numberOfVoxels,
+        roiLogic.updateSequenceClipping, lambda: selectNextFrame(sequenceBrowserNode))
+      roiLogic.stopSequenceClipping()
+
+      # Models (stencil cache is cleared before each run so that rasterization is included in the measurement)
+      clearStencilCache = modelLogic.stencilCache.clear
+      for shape, modelNode in [("sphere", createSphereModel(inputVolume)), ("markupHull", createMarkupHullModel(modelLogic, inputVolume))]:
+        addResult("clipVolumeWithModel", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithModel(inputVolume, modelNode, True, 0, False, 1, outputVolume), clearStencilCache)
+        addResult("clipVolumeWithModel-cached", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithModel(inputVolume, modelNode, True, 0, False, 1, outputVolume))
+        # Narrow-band distance computation, time should depend on the surface area and not on the volume size
+        addResult("clipVolumeWithModel-margin", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithModel(inputVolume, modelNode, True, 0, False, 1, outputVolume, margin=3.0))
+        addResult("clipVolumeWithModel-feather", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithModel(inputVolume, modelNode, True, 0, False, 1, outputVolume, featherWidth=4.0))
+        addResult("clipVolumesWithModel", shape, size, scalarType, numberOfVoxels * len(batchInputVolumes),
+          lambda: modelLogic.clipVolumesWithModel(batchInputVolumes, modelNode, True, 0, False, 1, batchOutputVolumes), clearStencilCache)
+        addResult("clipVolumeFileWithModel", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeFileWithModel(inputFilePath, modelNode, True, 0, False, 1, outputFilePath))
+        addResult("clipVolumeWithShapes", shape + "+obliqueBox", size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithShapes(inputVolume, [("union", modelNode), ("intersection", roiNode)], True, 0, False, 1,
+            outputVolume), clearStencilCache)
+        addResult("createMaskWithModel", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.createMaskWithModel(inputVolume, modelNode, maskVolume), clearStencilCache)
+        addResult("writeMaskFileWithModel", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.writeMaskFileWithModel(inputVolume, modelNode, maskFilePath), clearStencilCache)
+        addResult("clipVolumeWithMaskFile", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.clipVolumeWithMaskFile(inputVolume, maskFilePath, True, 0, False, 1, outputVolume))
+        addResult("clipSequenceWithModel", shape, size, scalarType, numberOfSequenceVoxels,
+          lambda: modelLogic.clipSequenceWithModel(inputSequence, modelNode, True, 0, False, 1, outputSequence), clearStencilCache)
+        addResult("startSequenceClipping", shape, size, scalarType, numberOfVoxels,
+          lambda: modelLogic.startSequenceClipping(modelNode, sequenceBrowserNode, inputSequence, True, 0, False, 1, outputVolume),
+          clearStencilCache)
+        addResult("updateSequenceClipping", shape, size, scalarType, numberOfVoxels,
+          modelLogic.updateSequenceClipping, lambda: selectNextFrame(sequenceBrowserNode))
+        modelLogic.stopSequenceClipping()
+
+      for filePath in [inputFilePath, outputFilePath, maskFilePath]:
+        if os.path.exists(filePath):
+          os.remove(filePath)
+
+  # Surface generation from markup points does not depend on the volume
+  markupHullModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+  for numberOfPoints in [10, 100, 1000]:
+    points = createMarkupPoints([0.0, 0.0, 0.0], 100.0, numberOfPoints)
+    def resetHull():
+      modelLogic.markupHulls.clear()
+    addResult("updateModelFromPoints", "{0}points".format(numberOfPoints), 0, "", numberOfPoints,
+      lambda: modelLogic.updateModelFromPoints(points, markupHullModel), resetHull)
+
+  slicer.mrmlScene.Clear(0)
+  return results
+
+def getResultKey(result):
+  return (result["entryPoint"], result["shape"], result["size"], result["scalarType"])
+
+def compareToBaseline(results, baselineResults, tolerance):
+  """Print time ratios compared to baseline. Returns list of results that are slower than the tolerance."""
+  baselineTimes = {getResultKey(result): result["timeSec"] for result in baselineResults}
+  regressions = []
+  for result in results:
+    baselineTimeSec = baselineTimes.get(getResultKey(result))
+    if not baselineTimeSec:
+      continue
+    ratio = result["timeSec"] / baselineTimeSec
+    result["baselineTimeSec"] = baselineTimeSec
+    if ratio > 1.0 + tolerance:
+      regressions.append(result)
+      print("REGRESSION: {0} {1} {2}^3 {3}: {4:.4f}s (baseline: {5:.4f}s, {6:.0f}% slower)".format(
+        result["entryPoint"], result["shape"], result["size"], result["scalarType"],
+        result["timeSec"], baselineTimeSec, (ratio - 1.0) * 100))
+  return regressions
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark VolumeClip module logics on synthetic data.")
+  parser.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256],
+    help="number of voxels along each axis of the synthetic volumes (for example: 64 128 256 512 1024)")
+  parser.add_argument("--scalar-types", nargs="+", default=list(scalarTypes.keys()), choices=list(scalarTypes.keys()))
+  parser.add_argument("--repeat", type=int, default=3, help="number of repetitions (shortest time is reported)")
+  parser.add_argument("--threads", type=int, default=0, help="number of worker threads (default: number of CPUs)")
+  parser.add_argument("--output", help="write results to this JSON file")
+  parser.add_argument("--baseline", help="JSON report of a previous run to compare the results to")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown compared to baseline")
+  args = parser.parse_args(argv)
+
+  results = runBenchmark(args.sizes, args.scalar_types, args.repeat, args.threads, slicer.app.temporaryPath)
+  report = {
+    "environment": {
+      "slicerVersion": slicer.app.applicationVersion,
+      "platform": platform.platform(),
+      "processor": platform.processor(),
+      "numberOfCpus": VolumeClipLib.getDefaultNumberOfThreads(),
+      "numberOfThreads": args.threads or VolumeClipLib.getDefaultNumberOfThreads(),
+      },
+    "results": results,
+    }
+
+  regressions = []
+  if args.baseline:
+    with open(args.baseline) as baselineFile:
+      regressions = compareToBaseline(results, json.load(baselineFile)["results"], args.tolerance)
+  if args.output:
+    with open(args.output, "w") as outputFile:
+      json.dump(report, outputFile, indent=2)
+  return 1 if regressions else 0
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,105 @@
+"""
+Measure how slab-parallel clipping scales with the number of threads.
+
+The benchmark uses the VolumeClipLib functions that the module logics use for rasterizing models
+and filling voxels, on a synthetic volume, therefore it does not need a Slicer scene or any input data.
+It can be run with any Python that has numpy and vtk (or with Slicer's Python):
+
+  PythonSlicer VolumeClipScalingBenchmark.py --size 512 --threads 1 2 4 8 16 32 --output scaling.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import VolumeClipLib
+
+def createSyntheticVolume(size):
+  voxels = np.random.RandomState(0).randint(-1000, 1000, size=(size, size, size)).astype(np.int16)
+  return voxels, VolumeClipLib.createImageData(voxels)
+
+def createSphereModel(size):
+  sphere = vtk.vtkSphereSource()
+  sphere.SetCenter(size * 0.5, size * 0.5, size * 0.5)
+  sphere.SetRadius(size * 0.4)
+  sphere.SetPhiResolution(100)
+  sphere.SetThetaResolution(100)
+  sphere.Update()
+  return sphere.GetOutput()
+
+def createObliqueBox(size):
+  angle = np.radians(30)
+  ijkToBox = np.eye(4)
+  ijkToBox[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+  ijkToBox[:3, 3] = -size * 0.5
+  boxBounds = [-size * 0.3, size * 0.3, -size * 0.25, size * 0.25, -size * 0.35, size * 0.35]
+  return ijkToBox, boxBounds
+
+def measure(function, repeat):
+  """Returns the shortest execution time of repeated calls"""
+  times = []
+  for repeatIndex in range(repeat):
+    startTime = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - startTime)
+  return min(times)
+
+def runBenchmark(size, threadCounts, repeat):
+  voxels, imageData = createSyntheticVolume(size)
+  extent = imageData.GetExtent()
+  polyData = createSphereModel(size)
+  ijkToBox, boxBounds = createObliqueBox(size)
+  stencil = VolumeClipLib.rasterizePolyData(polyData, imageData, 1)
+  fillValue = VolumeClipLib.castFillValue(0, voxels.dtype)
+
+  stages = {
+    "rasterizeModel": lambda numberOfThreads: VolumeClipLib.rasterizePolyData(polyData, imageData, numberOfThreads),
+    "applyModelStencil": lambda numberOfThreads: VolumeClipLib.applyStencil(voxels, stencil, extent,
+      True, fillValue, False, fillValue, numberOfThreads),
+    "clipRoi": lambda numberOfThreads: VolumeClipLib.clipBox(voxels, ijkToBox, boxBounds, fillValue, True, extent, numberOfThreads),
+    }
+
+  results = []
+  for stageName, stageFunction in stages.items():
+    # Speedup is relative to the first thread count (1 thread by default)
+    baselineTimeSec = None
+    for numberOfThreads in threadCounts:
+      timeSec = measure(lambda: stageFunction(numberOfThreads), repeat)
+      if baselineTimeSec is None:
+        baselineTimeSec = timeSec
+      results.append({
+        "stage": stageName,
+        "numberOfThreads": numberOfThreads,
+        "timeSec": timeSec,
+        "speedup": baselineTimeSec / timeSec,
+        "voxelsPerSec": voxels.size / timeSec,
+        })
+      print("{0:20s} threads={1:3d} time={2:8.3f}s speedup={3:6.2f}".format(
+        stageName, numberOfThreads, timeSec, results[-1]["speedup"]))
+  return results
+
+def main(argv):
+  defaultThreadCounts = [1]
+  while defaultThreadCounts[-1] * 2 <= VolumeClipLib.getDefaultNumberOfThreads():
+    defaultThreadCounts.append(defaultThreadCounts[-1] * 2)
+  parser = argparse.ArgumentParser(description="Measure speedup of slab-parallel volume clipping against number of threads.")
+  parser.add_argument("--size", type=int, default=256, help="number of voxels along each axis of the synthetic volume")
+  parser.add_argument("--threads", type=int, nargs="+", default=defaultThreadCounts, help="thread counts to measure")
+  parser.add_argument("--repeat", type=int, default=3, help="number of repetitions (shortest time is reported)")
+  parser.add_argument("--output", help="write results to this JSON file")
+  args = parser.parse_args(argv)
+
+  results = runBenchmark(args.size, args.threads, args.repeat)
+  if args.output:
+    report = {"size": args.size, "numberOfCpus": VolumeClipLib.getDefaultNumberOfThreads(), "results": results}
+    with open(args.output, "w") as outputFile:
+      json.dump(report, outputFile, indent=2)
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
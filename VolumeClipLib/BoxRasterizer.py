@@ -0,0 +1,238 @@
+import numpy as np
+
+from .BrickClassifier import classifyBoxBricks, clipBricks
+
+__all__ = ["getAxisAlignedBoxSlices", "getBoxBoundingSlices", "getBoxRowSpans", "getBoxMask", "fillBox", "fillObliqueBox",
+  "getRowSpanDifferenceIndices", "updateBoxClip"]
+
+#
+# Analytic rasterization of a box on a voxel grid
+#
+# The box is specified by its bounds (xmin, xmax, ymin, ymax, zmin, zmax) in its own coordinate system
+# and by a 4x4 ijkToBox homogeneous transformation matrix (numpy array). A voxel is inside the box if its
+# transformed position is inside the bounds or on the boundary (same as vtkBox with
+# vtkImplicitFunctionToImageStencil).
+#
+# Since a box in IJK space is a convex polyhedron, the voxels inside the box form a single span in each IJK row,
+# which can be computed in closed form, without evaluating every voxel. The end points of each span are then
+# verified by evaluating the box transform the same way as vtkTransform does, so that rounding errors
+# cannot make the result differ from per-voxel evaluation.
+#
+# Extent is (i0, i1, j0, j1, k0, k1), voxel arrays are indexed as [k, j, i] (same as slicer.util.arrayFromVolume).
+#
+
+def getAxisAlignedBoxSlices(ijkToBox, boxBounds, extent):
+  """Get the region of the voxel array that is inside the box if the box axes are aligned with the IJK axes.
+
+  Returns a tuple of slices (k, j, i) (relative to the first voxel of the extent) or None
+  if the box is not aligned with the IJK axes.
+  """
+  ijkToBox = np.asarray(ijkToBox, dtype=np.float64)
+  nonZero = ijkToBox[:3, :3] != 0
+  if not (nonZero.sum(axis=0) == 1).all() or not (nonZero.sum(axis=1) == 1).all():
+    return None
+  slices = [None, None, None]
+  for boxAxis in range(3):
+    ijkAxis = int(np.nonzero(nonZero[boxAxis])[0][0])
+    indices = np.arange(extent[ijkAxis * 2], extent[ijkAxis * 2 + 1] + 1, dtype=np.float64)
+    # Same evaluation order as vtkTransform::TransformPoint (terms of other axes are 0)
+    position = ijkToBox[boxAxis, ijkAxis] * indices + ijkToBox[boxAxis, 3]
+    insideIndices = np.nonzero((position >= boxBounds[boxAxis * 2]) & (position <= boxBounds[boxAxis * 2 + 1]))[0]
+    if len(insideIndices) == 0:
+      slices[2 - ijkAxis] = slice(0, 0)
+    else:
+      slices[2 - ijkAxis] = slice(int(insideIndices[0]), int(insideIndices[-1]) + 1)
+  return tuple(slices)
+
+def getBoxBoundingSlices(ijkToBox, boxBounds, extent):
+  """Get the smallest region of the voxel array that contains all voxels inside the box.
+
+  Returns a tuple of slices (k, j, i) (relative to the first voxel of the extent)
+  or None if there are no voxels inside the box.
+  """
+  slices = getAxisAlignedBoxSlices(ijkToBox, boxBounds, extent)
+  if slices is None:
+    iMin, iMax = getBoxRowSpans(ijkToBox, boxBounds, extent)
+    nonEmptyRows = iMin <= iMax
+    if not nonEmptyRows.any():
+      return None
+    kIndices = np.nonzero(nonEmptyRows.any(axis=1))[0]
+    jIndices = np.nonzero(nonEmptyRows.any(axis=0))[0]
+    slices = (slice(int(kIndices[0]), int(kIndices[-1]) + 1), slice(int(jIndices[0]), int(jIndices[-1]) + 1),
+      slice(int(iMin[nonEmptyRows].min()), int(iMax[nonEmptyRows].max()) + 1))
+  for axisSlice in slices:
+    if axisSlice.start >= axisSlice.stop:
+      return None
+  return slices
+
+def _isInsideBox(ijkToBox, boxBounds, i, j, k):
+  inside = np.ones(np.broadcast(i, j, k).shape, dtype=bool)
+  for boxAxis in range(3):
+    position = ijkToBox[boxAxis, 0] * i + ijkToBox[boxAxis, 1] * j + ijkToBox[boxAxis, 2] * k + ijkToBox[boxAxis, 3]
+    inside &= (position >= boxBounds[boxAxis * 2]) & (position <= boxBounds[boxAxis * 2 + 1])
+  return inside
+
+def getBoxRowSpans(ijkToBox, boxBounds, extent):
+  """Compute the range of voxels inside the box in each IJK row.
+
+  Returns (iMin, iMax) arrays of shape (number of slices, number of rows), containing first and last
+  i index (relative to the first voxel of the extent) of the voxels inside the box.
+  iMin > iMax for rows that do not intersect the box.
+  """
+  ijkToBox = np.asarray(ijkToBox, dtype=np.float64)
+  i0, i1, j0, j1, k0, k1 = extent
+  k = np.arange(k0, k1 + 1, dtype=np.float64)[:, np.newaxis]
+  j = np.arange(j0, j1 + 1, dtype=np.float64)[np.newaxis, :]
+  lower = np.full((len(k), j.shape[1]), float(i0))
+  upper = np.full((len(k), j.shape[1]), float(i1))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    for boxAxis in range(3):
+      boundMin = boxBounds[boxAxis * 2]
+      boundMax = boxBounds[boxAxis * 2 + 1]
+      slope = ijkToBox[boxAxis, 0]
+      offset = ijkToBox[boxAxis, 1] * j + ijkToBox[boxAxis, 2] * k + ijkToBox[boxAxis, 3]
+      if slope == 0:
+        # box coordinate does not depend on i: the whole row is either inside or outside
+        rowOutside = (offset < boundMin) | (offset > boundMax)
+        upper[rowOutside] = i0 - 1
+        continue
+      first = (boundMin - offset) / slope
+      last = (boundMax - offset) / slope
+      if slope < 0:
+        first, last = last, first
+      lower = np.maximum(lower, np.ceil(first))
+      upper = np.minimum(upper, np.floor(last))
+  # Limit range so that values can be safely converted to integer
+  iMin = np.clip(lower, i0 - 1, i1 + 1).astype(np.int64)
+  iMax = np.clip(upper, i0 - 1, i1 + 1).astype(np.int64)
+  # Correct rounding errors at span end points, using the same formula as for per-voxel evaluation
+  nonEmpty = iMin <= iMax
+  kk = np.broadcast_to(k, iMin.shape)
+  jj = np.broadcast_to(j, iMin.shape)
+  extendMin = nonEmpty & (iMin > i0) & _isInsideBox(ijkToBox, boxBounds, iMin - 1, jj, kk)
+  iMin[extendMin] -= 1
+  shrinkMin = nonEmpty & ~_isInsideBox(ijkToBox, boxBounds, iMin, jj, kk)
+  iMin[shrinkMin] += 1
+  extendMax = nonEmpty & (iMax < i1) & _isInsideBox(ijkToBox, boxBounds, iMax + 1, jj, kk)
+  iMax[extendMax] += 1
+  shrinkMax = nonEmpty & ~_isInsideBox(ijkToBox, boxBounds, iMax, jj, kk)
+  iMax[shrinkMax] -= 1
+  return iMin - i0, iMax - i0
+
+def getBoxMask(ijkToBox, boxBounds, extent, kSlice=None):
+  """Returns a boolean voxel array that is True inside the box.
+  If kSlice is specified then only the mask of those slices (relative to the first slice of the extent) is computed.
+  """
+  slices = getAxisAlignedBoxSlices(ijkToBox, boxBounds, extent)
+  shape = (extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1)
+  if kSlice is None:
+    kSlice = slice(0, shape[0])
+  kStart, kStop, _ = kSlice.indices(shape[0])
+  mask = np.zeros((max(kStop - kStart, 0), shape[1], shape[2]), dtype=bool)
+  if slices is not None:
+    maskKStart = max(slices[0].start, kStart) - kStart
+    maskKStop = min(slices[0].stop, kStop) - kStart
+    if maskKStart < maskKStop:
+      mask[maskKStart:maskKStop, slices[1], slices[2]] = True
+    return mask
+  sliceExtent = (extent[0], extent[1], extent[2], extent[3], extent[4] + kStart, extent[4] + kStop - 1)
+  iMin, iMax = getBoxRowSpans(ijkToBox, boxBounds, sliceExtent)
+  i = np.arange(shape[2])
+  np.greater_equal(i, iMin[:, :, np.newaxis], out=mask)
+  mask &= i <= iMax[:, :, np.newaxis]
+  return mask
+
+def fillBox(voxels, ijkToBox, boxBounds, fillValue, fillOutside, extent=None):
+  """Fill voxels of the array inside or outside the box, in place.
+
+  :param voxels: numpy array indexed as [k, j, i] (optionally with an additional component axis)
+  :param fillOutside: if True then voxels outside the box are filled, otherwise voxels inside the box
+  :param extent: voxel extent corresponding to the array, by default it starts at (0, 0, 0)
+  """
+  if extent is None:
+    extent = (0, voxels.shape[2] - 1, 0, voxels.shape[1] - 1, 0, voxels.shape[0] - 1)
+  slices = getAxisAlignedBoxSlices(ijkToBox, boxBounds, extent)
+  if slices is not None:
+    if not fillOutside:
+      voxels[slices] = fillValue
+      return
+    # Fill the slabs around the box
+    kSlice, jSlice, iSlice = slices
+    if kSlice.start >= kSlice.stop or jSlice.start >= jSlice.stop or iSlice.start >= iSlice.stop:
+      voxels[...] = fillValue
+      return
+    voxels[:kSlice.start] = fillValue
+    voxels[kSlice.stop:] = fillValue
+    voxels[kSlice, :jSlice.start] = fillValue
+    voxels[kSlice, jSlice.stop:] = fillValue
+    voxels[kSlice, jSlice, :iSlice.start] = fillValue
+    voxels[kSlice, jSlice, iSlice.stop:] = fillValue
+    return
+  # Oblique box: bricks that are completely inside or outside are filled in bulk,
+  # only bricks that the box surface passes through are evaluated voxel by voxel
+  fillObliqueBox(voxels, ijkToBox, boxBounds, fillValue, fillOutside, extent, numberOfThreads=1, outputVoxels=voxels)
+
+def fillObliqueBox(inputVoxels, ijkToBox, boxBounds, fillValue, fillOutside, extent, numberOfThreads=None, outputVoxels=None,
+  progressCallback=None):
+  """Returns a voxel array where voxels inside or outside the box are filled, processed brick by brick.
+
+  Works for any box orientation, but axis-aligned boxes are faster to fill using getAxisAlignedBoxSlices.
+  See clipBricks for description of the parameters.
+  """
+  brickLabels = classifyBoxBricks(ijkToBox, boxBounds, extent)
+  return clipBricks(inputVoxels, brickLabels, extent, lambda brickExtent: getBoxMask(ijkToBox, boxBounds, brickExtent),
+    fillOutside, fillValue, not fillOutside, fillValue, numberOfThreads=numberOfThreads, outputVoxels=outputVoxels,
+    progressCallback=progressCallback)
+
+def getRowSpanDifferenceIndices(rowSpansA, rowSpansB, rowLength):
+  """Get voxels that are in the row spans A but not in the row spans B.
+
+  :param rowSpansA, rowSpansB: (iMin, iMax) arrays, as returned by getBoxRowSpans for the same extent
+  :param rowLength: number of voxels in a row
+  Returns a sorted array of flat voxel indices (into the voxel array reshaped to one dimension).
+  """
+  iMinA, iMaxA = rowSpansA
+  iMinB, iMaxB = rowSpansB
+  # Span A minus span B is at most two intervals in each row: before and after span B.
+  # Empty span B is replaced by a span after the end of the row, so that the first interval is all of span A.
+  emptyB = iMinB > iMaxB
+  iMinB = np.where(emptyB, rowLength, iMinB)
+  iMaxB = np.where(emptyB, rowLength - 1, iMaxB)
+  rowStarts = np.arange(iMinA.size, dtype=np.int64).reshape(iMinA.shape) * rowLength
+  intervalStarts = np.concatenate([(rowStarts + iMinA).ravel(), (rowStarts + np.maximum(iMinA, iMaxB + 1)).ravel()])
+  intervalStops = np.concatenate([(rowStarts + np.minimum(iMaxA, iMinB - 1)).ravel(), (rowStarts + iMaxA).ravel()]) + 1
+  nonEmpty = intervalStops > intervalStarts
+  intervalStarts = intervalStarts[nonEmpty]
+  intervalLengths = intervalStops[nonEmpty] - intervalStarts
+  # Intervals are expanded to indices without iterating through them:
+  # index = interval start + position within the interval
+  order = np.argsort(intervalStarts, kind="stable")
+  intervalStarts = intervalStarts[order]
+  intervalLengths = intervalLengths[order]
+  numberOfIndices = int(intervalLengths.sum())
+  intervalOffsets = np.cumsum(intervalLengths) - intervalLengths
+  return np.repeat(intervalStarts - intervalOffsets, intervalLengths) + np.arange(numberOfIndices, dtype=np.int64)
+
+def updateBoxClip(voxels, inputVoxels, oldRowSpans, newRowSpans, fillValue, fillOutside):
+  """Update a clipped voxel array after the box is moved or resized, in place.
+
+  Only voxels in the symmetric difference of the old and new box are written: voxels that are filled
+  by the new box are filled, voxels that are not filled anymore are restored from the input.
+
+  :param voxels: contiguous voxel array that was clipped with the old box (by fillBox, clipBox, or updateBoxClip)
+  :param inputVoxels: unclipped voxel array (same shape as voxels)
+  :param oldRowSpans, newRowSpans: (iMin, iMax) arrays returned by getBoxRowSpans for the old and new box
+  :param fillOutside: if True then voxels outside the box are filled, otherwise voxels inside the box
+  Returns the number of updated voxels.
+  """
+  rowLength = voxels.shape[2]
+  enteredIndices = getRowSpanDifferenceIndices(newRowSpans, oldRowSpans, rowLength)
+  leftIndices = getRowSpanDifferenceIndices(oldRowSpans, newRowSpans, rowLength)
+  numberOfVoxels = voxels.shape[0] * voxels.shape[1] * voxels.shape[2]
+  # Reshape to one row per voxel (a view, as voxels are contiguous), so that multi-component voxels are also supported
+  flatVoxels = voxels.reshape(numberOfVoxels, -1)
+  flatInputVoxels = inputVoxels.reshape(numberOfVoxels, -1)
+  restoredIndices, filledIndices = (enteredIndices, leftIndices) if fillOutside else (leftIndices, enteredIndices)
+  flatVoxels[restoredIndices] = flatInputVoxels[restoredIndices]
+  flatVoxels[filledIndices] = fillValue
+  return len(enteredIndices) + len(leftIndices)
@@ -0,0 +1,211 @@
+import numpy as np
+from vtk.util import numpy_support
+
+from .MaskFill import applyMask, applyWeightedMask, fillMask
+from .ParallelProcessing import processInParallel
+
+__all__ = ["brickOutside", "brickInside", "brickBoundary", "defaultBrickSize", "classifyBricks", "classifyBoxBricks",
+  "classifyPolyDataBricks", "clipBricks"]
+
+#
+# Classification of image bricks
+#
+# The image extent is divided into cubic bricks (the last brick along each axis may be smaller) and each brick
+# is classified as completely outside the clipping shape, completely inside, or boundary (the shape surface may
+# pass through the brick). Inside and outside bricks are filled or copied in bulk, only boundary bricks need
+# a voxel mask, therefore clipping cost depends on the surface area of the shape rather than on its volume.
+#
+# Brick labels are stored in a numpy array indexed as [k, j, i] (same as voxel arrays).
+#
+
+brickOutside = 0
+brickInside = 1
+brickBoundary = 2
+
+defaultBrickSize = 32
+
+_cornerIndices = np.array([[i, j, k] for k in (4, 5) for j in (2, 3) for i in (0, 1)])
+
+def _getBrickGridShape(extent, brickSize):
+  """Returns number of bricks along (i, j, k) axes"""
+  return [(extent[axis * 2 + 1] - extent[axis * 2]) // brickSize + 1 for axis in range(3)]
+
+def classifyBricks(classifyRegions, extent, brickSize=defaultBrickSize):
+  """Classify bricks of the extent hierarchically (octree).
+
+  Starting from a single region that covers the whole extent, regions that are classified as boundary
+  are split into 8 subregions, until the brick size is reached. Regions that are inside or outside are not
+  subdivided, so most of the image is classified by a few tests.
+
+  :param classifyRegions: function(regionExtents) that gets an integer array of shape (n, 6) containing
+    region extents and returns an array of n labels (brickOutside, brickInside, or brickBoundary).
+    It must only return inside or outside if all voxels of the region are inside or outside.
+  Returns brick labels as an unsigned char array indexed as [k, j, i].
+  """
+  extentMin = np.array(extent[0::2])
+  extentMax = np.array(extent[1::2])
+  gridShape = np.array(_getBrickGridShape(extent, brickSize))
+  brickLabels = np.empty(gridShape[::-1], dtype=np.uint8)
+  regionSize = 1
+  while regionSize < gridShape.max():
+    regionSize *= 2
+  childOffsets = np.array([[i, j, k] for k in (0, 1) for j in (0, 1) for i in (0, 1)])
+  # first brick (i, j, k) of each region of the current level
+  regions = np.zeros((1, 3), dtype=int)
+  while len(regions):
+    regionMin = extentMin + regions * brickSize
+    regionMax = np.minimum(extentMin + (regions + regionSize) * brickSize - 1, extentMax)
+    regionExtents = np.stack([regionMin, regionMax], axis=2).reshape(-1, 6)
+    labels = np.asarray(classifyRegions(regionExtents), dtype=np.uint8)
+    if regionSize == 1:
+      brickLabels[regions[:, 2], regions[:, 1], regions[:, 0]] = labels
+      break
+    for (i, j, k), label in zip(regions[labels != brickBoundary], labels[labels != brickBoundary]):
+      brickLabels[k:k + regionSize, j:j + regionSize, i:i + regionSize] = label
+    regionSize //= 2
+    regions = (regions[labels == brickBoundary][:, np.newaxis, :] + childOffsets * regionSize).reshape(-1, 3)
+    regions = regions[(regions < gridShape).all(axis=1)]
+  return brickLabels
+
+def classifyBoxBricks(ijkToBox, boxBounds, extent, brickSize=defaultBrickSize):
+  """Classify bricks of the extent by a box (see BoxRasterizer for description of ijkToBox and boxBounds).
+
+  A brick is inside if all its corners are inside the box (the box is convex) and outside if all its
+  corners are outside the same face of the box. Bricks near the box surface are classified as boundary,
+  so that rounding errors cannot make the result differ from per-voxel evaluation.
+  """
+  ijkToBox = np.asarray(ijkToBox, dtype=np.float64)
+  boundsMin = np.array(boxBounds[0::2], dtype=np.float64)
+  boundsMax = np.array(boxBounds[1::2], dtype=np.float64)
+  def classifyRegions(regionExtents):
+    corners = regionExtents[:, _cornerIndices].astype(np.float64)
+    positions = np.dot(corners, ijkToBox[:3, :3].T) + ijkToBox[:3, 3]
+    tolerance = 1e-6 * (1.0 + np.abs(positions).max() + np.abs(boxBounds).max())
+    inside = ((positions >= boundsMin + tolerance) & (positions <= boundsMax - tolerance)).all(axis=(1, 2))
+    outside = ((positions < boundsMin - tolerance).all(axis=1) | (positions > boundsMax + tolerance).all(axis=1)).any(axis=1)
+    labels = np.full(len(regionExtents), brickBoundary, dtype=np.uint8)
+    labels[outside] = brickOutside
+    labels[inside] = brickInside
+    return labels
+  return classifyBricks(classifyRegions, extent, brickSize)
+
+def _getCellBounds(points, cellArray):
+  """Returns (min, max) arrays of shape (number of cells, 3) of the cells of a vtkCellArray"""
+  offsets = numpy_support.vtk_to_numpy(cellArray.GetOffsetsArray()).astype(np.int64)
+  connectivity = numpy_support.vtk_to_numpy(cellArray.GetConnectivityArray()).astype(np.int64)
+  nonEmpty = offsets[1:] > offsets[:-1]
+  if not nonEmpty.any():
+    return np.zeros((0, 3)), np.zeros((0, 3))
+  cellStarts = offsets[:-1][nonEmpty]
+  cellPoints = points[connectivity]
+  return np.minimum.reduceat(cellPoints, cellStarts, axis=0), np.maximum.reduceat(cellPoints, cellStarts, axis=0)
+
+def classifyPolyDataBricks(polyData, imageData, stencil, margin=1.0, brickSize=defaultBrickSize):
+  """Classify bricks of the image by a closed surface.
+
+  :param polyData: closed surface, in the image point coordinate system
+  :param stencil: the surface rasterized on the image (see rasterizePolyData)
+  :param margin: bricks that are closer than this distance (in voxels, scalar or one value for each IJK axis)
+    to the bounding box of any polygon or triangle strip of the surface are boundary bricks.
+  The surface does not pass through other bricks, therefore all their voxels are the same as their first voxel
+  in the stencil.
+  """
+  extent = imageData.GetExtent()
+  extentMin = np.array(extent[0::2])
+  gridShape = np.array(_getBrickGridShape(extent, brickSize))
+  boundaryBricks = np.zeros(gridShape[::-1], dtype=bool)
+  if polyData.GetNumberOfPoints() > 0:
+    points = (numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(np.float64)
+      - imageData.GetOrigin()) / imageData.GetSpacing()
+    cellBounds = [_getCellBounds(points, cellArray) for cellArray in [polyData.GetPolys(), polyData.GetStrips()]]
+    cellMin = np.concatenate([bounds[0] for bounds in cellBounds])
+    cellMax = np.concatenate([bounds[1] for bounds in cellBounds])
+    brickMin = np.floor((cellMin - margin - extentMin) / brickSize)
+    brickMax = np.floor((cellMax + margin - extentMin) / brickSize)
+    inGrid = ((brickMax >= 0) & (brickMin < gridShape)).all(axis=1)
+    brickMin = np.clip(brickMin[inGrid], 0, gridShape - 1).astype(int)
+    brickMax = np.clip(brickMax[inGrid], 0, gridShape - 1).astype(int)
+    # Cells are usually small compared to bricks, they are marked at once if they span at most 2 bricks along each axis
+    small = ((brickMax - brickMin) <= 1).all(axis=1)
+    for offset in np.array([[i, j, k] for k in (0, 1) for j in (0, 1) for i in (0, 1)]):
+      bricks = np.minimum(brickMin[small] + offset, brickMax[small])
+      boundaryBricks[bricks[:, 2], bricks[:, 1], bricks[:, 0]] = True
+    for (i0, j0, k0), (i1, j1, k1) in zip(brickMin[~small], brickMax[~small]):
+      boundaryBricks[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1] = True
+
+  def classifyRegions(regionExtents):
+    labels = np.empty(len(regionExtents), dtype=np.uint8)
+    for regionIndex, regionExtent in enumerate(regionExtents):
+      i0, j0, k0 = (regionExtent[0::2] - extentMin) // brickSize
+      i1, j1, k1 = (regionExtent[1::2] - extentMin) // brickSize
+      if boundaryBricks[k0:k1 + 1, j0:j1 + 1, i0:i1 + 1].any():
+        labels[regionIndex] = brickBoundary
+      elif stencil.IsInside(int(regionExtent[0]), int(regionExtent[2]), int(regionExtent[4])):
+        labels[regionIndex] = brickInside
+      else:
+        labels[regionIndex] = brickOutside
+    return labels
+  return classifyBricks(classifyRegions, extent, brickSize)
+
+def clipBricks(inputVoxels, brickLabels, extent, getBoundaryMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+  brickSize=defaultBrickSize, numberOfThreads=None, outputVoxels=None, progressCallback=None):
+  """Returns a voxel array where voxels are filled inside and/or outside the clipping shape, processed brick by brick.
+
+  Inside and outside bricks are filled (or copied) without a mask. Consecutive bricks of a brick row that have
+  the same label are processed at once. Layers of bricks are processed on a thread pool.
+
+  :param inputVoxels: numpy array indexed as [k, j, i] (optionally with an additional component axis)
+  :param brickLabels: brick labels computed for the extent with the same brick size (see classifyBricks)
+  :param getBoundaryMask: function(regionExtent) that returns a boolean voxel array of the region,
+    True inside the clipping shape, or a floating-point array of inside weights (see applyWeightedMask).
+    It is only called for boundary bricks.
+  :param fillOutsideValue, fillInsideValue: fill values (already cast to the voxel type)
+  :param outputVoxels: array where the result is written, a new array is created if not specified.
+    If it is the input array then voxels are filled in place (only voxels that are filled are written).
+  :param progressCallback: function(fraction) that is called from the calling thread after each completed brick layer.
+  """
+  inPlace = outputVoxels is inputVoxels
+  if outputVoxels is None:
+    outputVoxels = np.empty_like(inputVoxels)
+  fillOptions = {brickOutside: (clipOutside, fillOutsideValue), brickInside: (clipInside, fillInsideValue)}
+
+  def clipBrickLayer(k):
+    kSlice = slice(k * brickSize, (k + 1) * brickSize)
+    layerInputVoxels = inputVoxels[kSlice]
+    layerOutputVoxels = outputVoxels[kSlice]
+    for j in range(brickLabels.shape[1]):
+      jSlice = slice(j * brickSize, (j + 1) * brickSize)
+      rowLabels = brickLabels[k, j]
+      runStarts = np.flatnonzero(np.concatenate([[True], rowLabels[1:] != rowLabels[:-1]]))
+      runStops = np.append(runStarts[1:], len(rowLabels))
+      for runStart, runStop in zip(runStarts, runStops):
+        index = (slice(None), jSlice, slice(runStart * brickSize, runStop * brickSize))
+        label = rowLabels[runStart]
+        if label == brickBoundary:
+          runExtent = (extent[0] + runStart * brickSize, min(extent[0] + runStop * brickSize - 1, extent[1]),
+            extent[2] + j * brickSize, min(extent[2] + (j + 1) * brickSize - 1, extent[3]),
+            extent[4] + k * brickSize, min(extent[4] + (k + 1) * brickSize - 1, extent[5]))
+          insideMask = getBoundaryMask(runExtent)
+          if insideMask.dtype != bool:
+            applyWeightedMask(layerInputVoxels[index], insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+              layerOutputVoxels[index])
+          elif inPlace:
+            fillMask(layerOutputVoxels[index], insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue)
+          else:
+            applyMask(layerInputVoxels[index], insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+              layerOutputVoxels[index])
+          continue
+        clip, fillValue = fillOptions[label]
+        if clip:
+          layerOutputVoxels[index] = fillValue
+        elif not inPlace:
+          layerOutputVoxels[index] = layerInputVoxels[index]
+
+  itemCompletedCallback = None
+  if progressCallback:
+    itemCompletedCallback = lambda numberOfCompletedLayers, numberOfLayers: progressCallback(float(numberOfCompletedLayers) / numberOfLayers)
+  layerResults = processInParallel(clipBrickLayer, range(brickLabels.shape[0]), numberOfThreads, itemCompletedCallback)
+  for layerResult in layerResults:
+    if layerResult["error"] is not None:
+      raise layerResult["error"]
+  return outputVoxels
@@ -0,0 +1,168 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+from .BoxRasterizer import getBoxMask
+from .NarrowBand import clipWithNarrowBand
+from .SlabProcessing import applyStencil, clipBox, rasterizePolyData
+from .VoxelArray import castFillValue, getStencilMask
+
+__all__ = ["getVoxelExtent", "getRoiBox", "getIjkToBox", "createRoiMask", "clipVoxelsWithRoi",
+  "getSurfacePolyData", "getSurfaceArrays", "rasterizeSurface", "createSurfaceMask", "clipVoxelsWithSurface",
+  "clipVoxelsWithStencil"]
+
+#
+# Clipping of numpy voxel arrays, without MRML nodes
+#
+# Volumes are described by a voxel array (indexed as [k, j, i]) and a 4x4 numpy array that maps voxel indices
+# (i, j, k) to RAS coordinates. ROIs are described by box bounds and the RAS to box transform, surfaces by
+# vertex positions (in RAS) and faces. All functions are module-level and only use their arguments (no scene
+# or other global state), therefore they can be called concurrently from multiple threads and can be
+# submitted to a process pool (functions and numpy arguments can be pickled).
+#
+# By default the first voxel of the array has index (0, 0, 0). If the array is part of a larger volume
+# (for example, a slab) then its index range is specified by extent (i0, i1, j0, j1, k0, k1).
+#
+
+def getVoxelExtent(voxels, extent=None):
+  """Returns the index range (i0, i1, j0, j1, k0, k1) of the voxel array (the extent if it is specified)"""
+  if extent is not None:
+    return tuple(extent)
+  return (0, voxels.shape[2] - 1, 0, voxels.shape[1] - 1, 0, voxels.shape[0] - 1)
+
+def _getImageGeometry(extent, stencil=None):
+  """Returns a vtkImageData without scalars that has the voxel grid of the extent (and of the stencil, if specified)"""
+  imageData = vtk.vtkImageData()
+  imageData.SetExtent(extent)
+  if stencil is not None:
+    imageData.SetOrigin(stencil.GetOrigin())
+    imageData.SetSpacing(stencil.GetSpacing())
+  return imageData
+
+def _getSpacing(ijkToRas):
+  """Returns physical size of voxels along (i, j, k) axes"""
+  return np.linalg.norm(np.asarray(ijkToRas, dtype=np.float64)[:3, :3], axis=0)
+
+#
+# ROI
+#
+
+def getRoiBox(roiCenter, roiSize, roiAxes=None):
+  """Returns box bounds (xmin, xmax, ymin, ymax, zmin, zmax) and RAS to box transform (4x4 numpy array) of an ROI.
+
+  :param roiCenter: center position in RAS
+  :param roiSize: size along the ROI axes
+  :param roiAxes: 3x3 array, columns are the directions of the ROI axes in RAS (identity by default)
+  """
+  boxToRas = np.eye(4)
+  if roiAxes is not None:
+    boxToRas[:3, :3] = roiAxes
+  boxToRas[:3, 3] = roiCenter
+  roiBounds = [-roiSize[0] / 2.0, roiSize[0] / 2.0, -roiSize[1] / 2.0, roiSize[1] / 2.0, -roiSize[2] / 2.0, roiSize[2] / 2.0]
+  return roiBounds, np.linalg.inv(boxToRas)
+
+def getIjkToBox(ijkToRas, rasToBox):
+  """Returns transform from voxel indices to box coordinates (4x4 numpy array)"""
+  return np.dot(np.asarray(rasToBox, dtype=np.float64), np.asarray(ijkToRas, dtype=np.float64))
+
+def createRoiMask(voxels, ijkToRas, roiBounds, rasToBox, extent=None):
+  """Returns a boolean array with the shape of the voxel array that is True inside the ROI. Voxel values are not read."""
+  return getBoxMask(getIjkToBox(ijkToRas, rasToBox), roiBounds, getVoxelExtent(voxels, extent))
+
+def clipVoxelsWithRoi(inputVoxels, ijkToRas, roiBounds, rasToBox, fillValue, clipOutside, extent=None,
+  numberOfThreads=None, outputVoxels=None, progressCallback=None):
+  """Returns a voxel array where voxels outside (or inside, if clipOutside is False) the ROI are set to fillValue.
+
+  :param outputVoxels: array where the result is written, a new array is created if not specified.
+    If it is the input array then voxels are filled in place.
+  """
+  return clipBox(inputVoxels, getIjkToBox(ijkToRas, rasToBox), roiBounds, castFillValue(fillValue, inputVoxels.dtype),
+    clipOutside, getVoxelExtent(inputVoxels, extent), numberOfThreads, outputVoxels, progressCallback)
+
+#
+# Surface
+#
+
+def getSurfacePolyData(vertices, faces):
+  """Returns vtkPolyData from vertex positions (N x 3 array) and faces (M x 3 array of vertex indices)"""
+  vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+  idType = numpy_support.get_vtk_to_numpy_typemap()[vtk.VTK_ID_TYPE]
+  faces = np.ascontiguousarray(faces, dtype=idType)
+  points = vtk.vtkPoints()
+  points.SetData(numpy_support.numpy_to_vtk(vertices, deep=True))
+  offsets = np.arange(0, faces.size + 1, faces.shape[1], dtype=idType)
+  polys = vtk.vtkCellArray()
+  polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=True),
+    numpy_support.numpy_to_vtkIdTypeArray(faces.ravel(), deep=True))
+  polyData = vtk.vtkPolyData()
+  polyData.SetPoints(points)
+  polyData.SetPolys(polys)
+  return polyData
+
+def getSurfaceArrays(polyData):
+  """Returns vertex positions (N x 3 array) and triangles (M x 3 array of vertex indices) of a surface"""
+  triangleFilter = vtk.vtkTriangleFilter()
+  triangleFilter.SetInputData(polyData)
+  triangleFilter.PassVertsOff()
+  triangleFilter.PassLinesOff()
+  triangleFilter.Update()
+  triangles = triangleFilter.GetOutput()
+  vertices = numpy_support.vtk_to_numpy(triangles.GetPoints().GetData()).astype(np.float64)
+  faces = numpy_support.vtk_to_numpy(triangles.GetPolys().GetConnectivityArray()).reshape(-1, 3).astype(np.int64)
+  return vertices, faces
+
+def _getSurfacePolyDataInIjk(vertices, faces, ijkToRas):
+  vertices = np.asarray(vertices, dtype=np.float64)
+  rasToIjk = np.linalg.inv(np.asarray(ijkToRas, dtype=np.float64))
+  verticesInIjk = np.dot(vertices, rasToIjk[:3, :3].T) + rasToIjk[:3, 3]
+  return getSurfacePolyData(verticesInIjk, faces)
+
+def rasterizeSurface(vertices, faces, ijkToRas, extent, numberOfThreads=None, progressCallback=None):
+  """Rasterize a closed surface (vertex positions in RAS) on the voxel grid of the extent.
+  Returns a vtkImageStencilData that is non-zero inside the surface (see rasterizePolyData).
+  """
+  return rasterizePolyData(_getSurfacePolyDataInIjk(vertices, faces, ijkToRas), _getImageGeometry(extent),
+    numberOfThreads, progressCallback)
+
+def createSurfaceMask(voxels, ijkToRas, vertices, faces, extent=None, numberOfThreads=None):
+  """Returns a boolean array with the shape of the voxel array that is True inside the surface. Voxel values are not read."""
+  extent = getVoxelExtent(voxels, extent)
+  return getStencilMask(rasterizeSurface(vertices, faces, ijkToRas, extent, numberOfThreads), extent)
+
+def clipVoxelsWithSurface(inputVoxels, ijkToRas, vertices, faces, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+  margin=0.0, featherWidth=0.0, extent=None, numberOfThreads=None, outputVoxels=None, progressCallback=None):
+  """Returns a voxel array where voxels are filled inside and/or outside a closed surface (vertex positions in RAS).
+  See clipVoxelsWithStencil for description of the parameters.
+  """
+  extent = getVoxelExtent(inputVoxels, extent)
+  surfacePolyDataInIjk = _getSurfacePolyDataInIjk(vertices, faces, ijkToRas)
+  stencil = rasterizePolyData(surfacePolyDataInIjk, _getImageGeometry(extent), numberOfThreads,
+    (lambda fraction: progressCallback(0.5 * fraction)) if progressCallback else None)
+  return clipVoxelsWithStencil(inputVoxels, ijkToRas, stencil, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+    surfacePolyDataInIjk if margin or featherWidth else None, margin, featherWidth, extent, numberOfThreads, outputVoxels,
+    (lambda fraction: progressCallback(0.5 + 0.5 * fraction)) if progressCallback else None)
+
+def clipVoxelsWithStencil(inputVoxels, ijkToRas, stencil, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+  surfacePolyDataInIjk=None, margin=0.0, featherWidth=0.0, extent=None, numberOfThreads=None, outputVoxels=None,
+  progressCallback=None):
+  """Returns a voxel array where voxels are filled inside and/or outside a rasterized surface.
+
+  :param stencil: the surface rasterized on the voxel grid (see rasterizeSurface)
+  :param fillOutsideValue, fillInsideValue: fill values, converted to the voxel type
+  :param surfacePolyDataInIjk: surface in voxel index coordinates, required if margin or featherWidth is not 0
+  :param margin: the surface is grown by this distance (in RAS units), shrunk if negative
+  :param featherWidth: width of a linear transition between voxel and fill values, centered on the grown surface
+  :param outputVoxels: array where the result is written, a new array is created if not specified.
+    If it is the input array then voxels are filled in place (only voxels that are filled are written).
+  """
+  extent = getVoxelExtent(inputVoxels, extent)
+  fillOutsideValue = castFillValue(fillOutsideValue, inputVoxels.dtype)
+  fillInsideValue = castFillValue(fillInsideValue, inputVoxels.dtype)
+  if margin or featherWidth:
+    if surfacePolyDataInIjk is None:
+      raise ValueError("clipVoxelsWithStencil failed: surface is required for clipping with margin or feathering")
+    return clipWithNarrowBand(inputVoxels, surfacePolyDataInIjk, _getImageGeometry(extent, stencil), stencil, _getSpacing(ijkToRas),
+      margin, featherWidth, clipOutside, fillOutsideValue, clipInside, fillInsideValue, numberOfThreads, outputVoxels,
+      progressCallback)
+  return applyStencil(inputVoxels, stencil, extent, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+    numberOfThreads, outputVoxels, progressCallback)
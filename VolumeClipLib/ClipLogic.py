@@ -0,0 +1,188 @@
+import slicer
+import vtk
+
+from .ClipOperation import ClipOperation
+from .ParallelProcessing import getDefaultNumberOfThreads
+from .SequenceClipping import SequenceClipping
+from .VoxelArray import createImageData
+
+__all__ = ["ClipLogicMixin"]
+
+#
+# State and methods shared by the logics of the VolumeClip modules
+#
+# This module requires Slicer (it updates volume, segmentation and slice view nodes), therefore it is not imported
+# by the VolumeClipLib package. The module logics import it as VolumeClipLib.ClipLogic.
+#
+
+class ClipLogicMixin(object):
+  """Progress reporting, profiling, cancellation, worker threads, output node updates, and sequence clipping
+  of a clipping module logic.
+
+  The logic calls ClipLogicMixin.__init__ from its constructor. For sequence clipping it implements
+  startSequenceClipping (which calls startSequenceClippingWithMask) and getSequenceClippingShapeKey.
+  """
+
+  def __init__(self):
+    # Number of threads used for processing multiple volumes or image regions concurrently
+    self.numberOfWorkerThreads = getDefaultNumberOfThreads()
+    # Progress reporting, profiling and cancellation of clipping operations
+    self.progressCallback = None
+    self.profilingCallback = None
+    self.currentOperation = None
+    self.lastClipResult = None
+    # VolumeClipLib.SequenceClipping of the browsed sequence, None if sequence clipping is not active
+    self.sequenceClipping = None
+    # Arguments of startSequenceClipping and the key of the clipping shape that the frames were clipped with
+    self.sequenceClippingParameters = None
+    self.sequenceClippingShapeKey = None
+    # Maximum total size of clipped frames kept for sequence clipping and
+    # number of frames that are clipped in advance after and before the current frame
+    self.frameCacheMemoryBudgetBytes = 512*1024*1024
+    self.numberOfPrefetchedFrames = 2
+
+  def setProgressCallback(self, progressCallback):
+    """
+    Set function(operationName, progress, stageName) that is called during clipping operations,
+    with progress between 0 and 1. It is called from the thread that runs the operation
+    (a background thread, if the operation was started by a startClip... method of the logic).
+    """
+    self.progressCallback = progressCallback
+
+  def setProfilingCallback(self, profilingCallback):
+    """Set function(clipResult) that is called with timing statistics after each clipping operation"""
+    self.profilingCallback = profilingCallback
+
+  def getLastClipResult(self):
+    """Returns VolumeClipLib.ClipResult of the most recent clipping operation (stage timings and data sizes)"""
+    return self.lastClipResult
+
+  def cancel(self):
+    """Request cancellation of the currently running clipping operation. Can be called from any thread."""
+    # Operation may be completed on another thread at any time
+    operation = self.currentOperation
+    if operation:
+      operation.cancel()
+
+  def startOperation(self, operationName):
+    self.currentOperation = ClipOperation(operationName, self.progressCallback, self.onOperationFinished)
+    return self.currentOperation
+
+  def onOperationFinished(self, clipResult):
+    self.currentOperation = None
+    self.lastClipResult = clipResult
+    if self.profilingCallback:
+      self.profilingCallback(clipResult)
+
+  def setNumberOfWorkerThreads(self, numberOfWorkerThreads):
+    """Set number of threads used for processing multiple volumes or image regions concurrently"""
+    self.numberOfWorkerThreads = numberOfWorkerThreads
+
+  def getNumberOfWorkerThreads(self):
+    return self.numberOfWorkerThreads
+
+  def notifyVoxelsModified(self, volumeNode):
+    """Notify observers that voxels of the volume have been modified in place (node modified event is invoked once)"""
+    wasModified = volumeNode.StartModify()
+    slicer.util.arrayFromVolumeModified(volumeNode)
+    volumeNode.EndModify(wasModified)
+
+  def updateOutputVolume(self, outputVolume, outputImageData, ijkToRas):
+    """Set clipped image and geometry in the output volume node"""
+    outputVolume.SetAndObserveImageData(outputImageData)
+    outputVolume.SetIJKToRASMatrix(ijkToRas)
+
+    # Add a default display node to output volume node if it does not exist yet (the display node type depends
+    # on the volume type, e.g., labelmap). Volumes that are not in the scene, such as frames of a sequence, are not displayed.
+    if outputVolume.GetScene() and not outputVolume.GetDisplayNode():
+      outputVolume.CreateDefaultDisplayNodes()
+
+  def updateMaskNode(self, outputNode, maskVoxels, referenceVolume, segmentName):
+    """Store a mask (unsigned char voxel array, with the geometry of the reference volume) in a labelmap volume or segmentation node"""
+    if outputNode.IsA("vtkMRMLSegmentationNode"):
+      segmentId = outputNode.GetSegmentation().GetSegmentIdBySegmentName(segmentName)
+      if not segmentId:
+        segmentId = outputNode.GetSegmentation().AddEmptySegment("", segmentName)
+      if not outputNode.GetDisplayNode():
+        outputNode.CreateDefaultDisplayNodes()
+      slicer.util.updateSegmentBinaryLabelmapFromArray(maskVoxels, outputNode, segmentId, referenceVolume)
+      return
+    ijkToRas = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix( ijkToRas )
+    self.updateOutputVolume(outputNode, createImageData(maskVoxels, referenceVolume.GetImageData()), ijkToRas)
+
+  def startSequenceClippingWithMask(self, parameters, shapeKey, sequenceBrowserNode, inputSequence, outputVolume, getInsideMask,
+    clipOutside, fillOutsideValue, clipInside, fillInsideValue):
+    """
+    Start sequence clipping (see VolumeClipLib.SequenceClipping) and show the selected frame in the output volume.
+    :param parameters: arguments of startSequenceClipping, used for restarting when the shape is changed
+    :param shapeKey: key of the clipping shape (see getSequenceClippingShapeKey)
+    """
+    self.stopSequenceClipping()
+    self.sequenceClipping = SequenceClipping(sequenceBrowserNode, inputSequence, outputVolume, getInsideMask,
+      clipOutside, fillOutsideValue, clipInside, fillInsideValue, self.updateOutputVolume,
+      self.frameCacheMemoryBudgetBytes, self.numberOfPrefetchedFrames)
+    self.sequenceClippingParameters = parameters
+    self.sequenceClippingShapeKey = shapeKey
+    self.sequenceClipping.showSelectedFrame()
+
+  def getSequenceClippingShapeKey(self, shapeNode):
+    """Returns a hashable key that changes when the clipping shape is changed"""
+    raise NotImplementedError()
+
+  def updateSequenceClipping(self):
+    """
+    Update the output volume of sequence clipping (see startSequenceClipping) to show the selected frame.
+    Returns True if the output volume is updated.
+    """
+    if not self.sequenceClipping:
+      return False
+    # Frames are clipped again if the clipping shape or the number of frames is changed
+    if (self.getSequenceClippingShapeKey(self.sequenceClippingParameters[0]) != self.sequenceClippingShapeKey
+      or self.sequenceClipping.isNumberOfFramesChanged()):
+      self.startSequenceClipping(*self.sequenceClippingParameters)
+      return True
+    return self.sequenceClipping.showSelectedFrame()
+
+  def stopSequenceClipping(self):
+    """Stop sequence clipping and release the clipped frames. The output volume is kept as it is."""
+    if self.sequenceClipping:
+      self.sequenceClipping.shutdown()
+    self.sequenceClipping = None
+
+  def setFrameCacheMemoryBudget(self, memoryBudgetBytes, numberOfPrefetchedFrames=None):
+    """
+    Set maximum total size of clipped frames kept for sequence clipping and, optionally,
+    the number of frames that are clipped in advance after and before the current frame.
+    """
+    self.frameCacheMemoryBudgetBytes = memoryBudgetBytes
+    if numberOfPrefetchedFrames is not None:
+      self.numberOfPrefetchedFrames = numberOfPrefetchedFrames
+    if self.sequenceClipping:
+      self.sequenceClipping.setMemoryBudget(self.frameCacheMemoryBudgetBytes, self.numberOfPrefetchedFrames)
+
+  def getFrameCacheStatistics(self):
+    """Returns hit/miss counters and memory usage of the frame cache of sequence clipping (None if it is not active)"""
+    if not self.sequenceClipping:
+      return None
+    return self.sequenceClipping.getStatistics()
+
+  def showInSliceViewers(self, volumeNode, sliceWidgetNames):
+    # Displays volumeNode in the selected slice viewers as background volume
+    # Existing background volume is pushed to foreground, existing foreground volume will not be shown anymore
+    # sliceWidgetNames is a list of slice view names, such as ["Yellow", "Green"]
+    if not volumeNode:
+      return
+    newVolumeNodeID = volumeNode.GetID()
+    for sliceWidgetName in sliceWidgetNames:
+      sliceLogic = slicer.app.layoutManager().sliceWidget(sliceWidgetName).sliceLogic()
+      foregroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetForegroundVolumeID()
+      backgroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetBackgroundVolumeID()
+      if foregroundVolumeNodeID == newVolumeNodeID or backgroundVolumeNodeID == newVolumeNodeID:
+        # new volume is already shown as foreground or background
+        continue
+      if backgroundVolumeNodeID:
+        # there is a background volume, push it to the foreground because we will replace the background volume
+        sliceLogic.GetSliceCompositeNode().SetForegroundVolumeID(backgroundVolumeNodeID)
+      # show the new volume as background
+      sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(newVolumeNodeID)
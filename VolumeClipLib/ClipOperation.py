@@ -0,0 +1,203 @@
+import contextlib
+import threading
+import time
+
+__all__ = ["ClipCancelledError", "ClipResult", "ClipOperation", "ClipTask"]
+
+#
+# Profiling, progress reporting and cancellation of clipping operations
+#
+
+class ClipCancelledError(Exception):
+  """Raised by a clipping operation when it is cancelled"""
+  pass
+
+class ClipResult(object):
+  """Timing and data size statistics of a clipping operation.
+
+  stages is a list of dictionaries with "name", "timeSec" and "bytes" (size of the data produced by the stage,
+  0 if not applicable), in the order the stages were executed. A stage may be executed multiple times
+  (for example, once for each volume).
+  """
+
+  def __init__(self, operationName):
+    self.operationName = operationName
+    self.stages = []
+    self.totalTimeSec = 0.0
+    self.success = False
+    self.cancelled = False
+    self.error = None
+
+  def getStageTimes(self):
+    """Returns total time spent in each stage: dictionary of stage name -> time in seconds"""
+    stageTimes = {}
+    for stage in self.stages:
+      stageTimes[stage["name"]] = stageTimes.get(stage["name"], 0.0) + stage["timeSec"]
+    return stageTimes
+
+  def getStageBytes(self):
+    """Returns total data size produced by each stage: dictionary of stage name -> bytes"""
+    stageBytes = {}
+    for stage in self.stages:
+      stageBytes[stage["name"]] = stageBytes.get(stage["name"], 0) + stage["bytes"]
+    return stageBytes
+
+  def toDict(self):
+    return {"operationName": self.operationName, "totalTimeSec": self.totalTimeSec, "success": self.success,
+      "cancelled": self.cancelled, "error": self.error, "stages": [dict(stage) for stage in self.stages]}
+
+  def __str__(self):
+    status = "cancelled" if self.cancelled else ("succeeded" if self.success else "failed: {0}".format(self.error))
+    lines = ["{0} {1} in {2:.3f}s".format(self.operationName, status, self.totalTimeSec)]
+    for stage in self.stages:
+      lines.append("  {0}: {1:.3f}s, {2:.1f} MB".format(stage["name"], stage["timeSec"], stage["bytes"] / 1024.0 / 1024.0))
+    return "\n".join(lines)
+
+class ClipOperation(object):
+  """Records stage timings of a clipping operation, reports progress and checks for cancellation.
+
+  Usage:
+
+    with ClipOperation("clipVolumeWithRoi", progressCallback) as operation:
+      with operation.stage("fillVoxels") as stage:
+        ...
+        stage["bytes"] = outputVoxels.nbytes
+      operation.setProgress(0.5)
+
+  progressCallback(operationName, progress, stageName) is called with progress between 0 and 1,
+  from the thread that runs the operation. cancel() may be called from any thread; the operation
+  then raises ClipCancelledError at the next progress update (unless cancellation is disabled because
+  the operation cannot be interrupted without leaving partial results).
+  finishedCallback(clipResult) is called when the operation is completed, failed, or cancelled.
+  """
+
+  def __init__(self, operationName, progressCallback=None, finishedCallback=None):
+    self.result = ClipResult(operationName)
+    self.progressCallback = progressCallback
+    self.finishedCallback = finishedCallback
+    self.cancelRequested = False
+    self.cancellable = True
+    self.currentStageName = None
+    self.startTime = time.time()
+
+  def __enter__(self):
+    self.startTime = time.time()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    self.result.totalTimeSec = time.time() - self.startTime
+    # Operation may also indicate failure by setting an error message without raising an exception
+    self.result.success = exceptionType is None and self.result.error is None
+    self.result.cancelled = exceptionType is not None and issubclass(exceptionType, ClipCancelledError)
+    if exceptionType is not None and not self.result.cancelled:
+      self.result.error = str(exceptionValue)
+    if self.finishedCallback:
+      self.finishedCallback(self.result)
+    return False
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """Context manager that records execution time of a stage. The yielded dictionary can be used to set "bytes"."""
+    self.checkCancelled()
+    stageRecord = {"name": name, "timeSec": 0.0, "bytes": 0}
+    self.currentStageName = name
+    startTime = time.time()
+    try:
+      yield stageRecord
+    finally:
+      stageRecord["timeSec"] = time.time() - startTime
+      self.result.stages.append(stageRecord)
+
+  def setProgress(self, progress):
+    """Report progress (between 0 and 1). Raises ClipCancelledError if cancel was requested."""
+    self.checkCancelled()
+    if self.progressCallback:
+      self.progressCallback(self.result.operationName, progress, self.currentStageName)
+    self.checkCancelled()
+
+  def getProgressCallback(self, startProgress, endProgress):
+    """Returns a function(fraction) that reports progress of a part of the operation, mapped to the specified range"""
+    return lambda fraction: self.setProgress(startProgress + fraction * (endProgress - startProgress))
+
+  def cancel(self):
+    """Request cancellation of the operation. Can be called from any thread."""
+    self.cancelRequested = True
+
+  def setCancellable(self, cancellable):
+    """Cancellation is ignored while cancellable is False (for example, while filling voxels in place)"""
+    self.cancellable = cancellable
+
+  def checkCancelled(self):
+    if self.cancelRequested and self.cancellable:
+      raise ClipCancelledError("{0} was cancelled".format(self.result.operationName))
+
+class ClipTask(object):
+  """Clipping operation that is split into phases, so that voxels can be processed on a background thread.
+
+  The operation is implemented as a generator. Code before the first yield prepares the inputs and may access
+  MRML nodes (it runs in the constructor, on the main thread). Code between the first and the second yield
+  processes voxels and must not access MRML nodes (it runs in run(), on any thread). Code after the second yield
+  updates the output nodes (it runs in finish(), on the main thread). The value returned by the generator
+  is returned by finish(). The generator may return early, in any phase.
+
+  Usage:
+
+    clipTask = ClipTask(operationSteps)
+    clipTask.runInBackground()
+    ... # keep the application responsive while clipTask.isRunning()
+    result = clipTask.finish()
+  """
+
+  def __init__(self, operationSteps):
+    self.operationSteps = operationSteps
+    self.completed = False
+    self.processed = False
+    self.returnValue = None
+    self.exception = None
+    self.thread = None
+    self._runNextPhase()
+
+  def _runNextPhase(self):
+    try:
+      next(self.operationSteps)
+    except StopIteration as e:
+      self.completed = True
+      self.returnValue = e.value
+
+  def run(self):
+    """Process voxels. Exceptions are not raised here but by finish()."""
+    if self.processed:
+      return
+    self.processed = True
+    if self.completed:
+      return
+    try:
+      self._runNextPhase()
+    except BaseException as e:
+      self.completed = True
+      self.exception = e
+
+  def runInBackground(self):
+    """Start run() on a new thread"""
+    self.thread = threading.Thread(target=self.run, name="ClipTask")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def isRunning(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def finish(self):
+    """Update the outputs and return the result of the operation. Must be called on the main thread.
+    If run() was not called yet then voxels are processed on the calling thread.
+    Exceptions raised by the operation in any phase (such as ClipCancelledError) are raised here.
+    """
+    if self.isRunning():
+      self.thread.join()
+    self.run()
+    if self.exception is not None:
+      raise self.exception
+    if not self.completed:
+      self._runNextPhase()
+      if not self.completed:
+        raise RuntimeError("Clipping operation has more phases than expected")
+    return self.returnValue
@@ -0,0 +1,292 @@
+__all__ = ["ConvexHull"]
+
+#
+# ConvexHull
+#
+
+class ConvexHull(object):
+  """Incrementally updated convex hull of an indexed 3D point set.
+
+  The hull is stored as a closed triangle mesh: each facet is a triangle of point indices,
+  oriented counterclockwise when viewed from outside. Adding a point only replaces the facets
+  that are visible from the new point. Points that are inside the hull are kept in the point list
+  (so that indices match the input point list), but they are not referenced by any facet.
+
+  All modifying methods return True if the hull surface changed. Moving or removing a point that
+  is inside the hull, or adding a point inside the hull, does not change the hull.
+
+  If there are less than 4 non-coplanar points then the hull is not valid (isValid() returns False)
+  and it has no facets.
+  """
+
+  def __init__(self):
+    self.points = []
+    self.valid = False
+    self.tolerance = 0.0
+    self._resetFacets()
+
+  def _resetFacets(self):
+    # facet ID -> (a, b, c) point indices
+    self.facets = {}
+    # facet ID -> (nx, ny, nz, offset) unit normal pointing outside and plane offset
+    self.planes = {}
+    # directed edge (a, b) -> ID of the facet that contains the edge in this direction
+    self.edges = {}
+    # point index -> number of facets that the point belongs to
+    self.vertexFacetCounts = {}
+    self.nextFacetId = 0
+
+  def isValid(self):
+    return self.valid
+
+  def getNumberOfPoints(self):
+    return len(self.points)
+
+  def getTriangles(self):
+    """Returns list of (a, b, c) point index triplets, oriented counterclockwise when viewed from outside"""
+    return list(self.facets.values())
+
+  def isHullVertex(self, index):
+    return self.vertexFacetCounts.get(index, 0) > 0
+
+  def isInside(self, position):
+    """Returns True if the position is inside the hull or on its surface"""
+    return self.valid and not self._getVisibleFacets(position)
+
+  def setPoints(self, points):
+    """Replace all points and recompute the hull. Returns True."""
+    self.points = [tuple(float(c) for c in point) for point in points]
+    self._rebuild()
+    return True
+
+  def update(self, points):
+    """Update the hull to match the provided point list.
+
+    Changes compared to the current point list are detected (moved points, a single added
+    or removed point) and only the affected part of the hull is updated.
+    Returns True if the hull surface changed.
+    """
+    points = [tuple(float(c) for c in point) for point in points]
+    numberOfOldPoints = len(self.points)
+    numberOfNewPoints = len(points)
+    if numberOfNewPoints == numberOfOldPoints:
+      hullChanged = False
+      for index in range(numberOfNewPoints):
+        if points[index] != self.points[index]:
+          hullChanged = self.setPoint(index, points[index]) or hullChanged
+      return hullChanged
+    if numberOfNewPoints == numberOfOldPoints + 1:
+      index = self._getFirstDifferentIndex(self.points, points)
+      if points[index+1:] == self.points[index:]:
+        return self.insertPoint(index, points[index])
+    elif numberOfNewPoints == numberOfOldPoints - 1:
+      index = self._getFirstDifferentIndex(points, self.points)
+      if points[index:] == self.points[index+1:]:
+        return self.removePoint(index)
+    return self.setPoints(points)
+
+  def addPoint(self, position):
+    """Append a point. Returns True if the hull surface changed."""
+    return self.insertPoint(len(self.points), position)
+
+  def insertPoint(self, index, position):
+    """Insert a point before the specified index. Returns True if the hull surface changed."""
+    position = tuple(float(c) for c in position)
+    if index < len(self.points):
+      self._shiftIndices(index, 1)
+    self.points.insert(index, position)
+    if not self.valid:
+      self._rebuild()
+      return self.valid
+    self._updateTolerance(position)
+    return self._addHullVertex(index)
+
+  def removePoint(self, index):
+    """Remove a point. Returns True if the hull surface changed."""
+    wasHullVertex = self.isHullVertex(index)
+    del self.points[index]
+    if self.valid and not wasHullVertex:
+      # points inside the hull do not contribute to the surface
+      self._shiftIndices(index + 1, -1)
+      return False
+    # Any of the interior points may become part of the hull
+    wasValid = self.valid
+    self._rebuild()
+    return self.valid or wasValid
+
+  def setPoint(self, index, position):
+    """Move a point. Returns True if the hull surface changed."""
+    position = tuple(float(c) for c in position)
+    if not self.valid:
+      self.points[index] = position
+      self._rebuild()
+      return self.valid
+    self._updateTolerance(position)
+    if not self.isHullVertex(index):
+      self.points[index] = position
+      # interior point either stays inside (no change) or becomes a hull vertex
+      return self._addHullVertex(index)
+    if self._getVisibleFacets(position):
+      # Hull vertex moved outward. The new position is added to the current hull as a temporary point.
+      # If the old position is not on the resulting hull then the result is the same
+      # as the hull of the updated point set.
+      temporaryIndex = len(self.points)
+      self.points.append(position)
+      self._addHullVertex(temporaryIndex)
+      if not self.isHullVertex(index):
+        self.points[index] = position
+        self._renameVertex(temporaryIndex, index)
+        del self.points[temporaryIndex]
+        return True
+      del self.points[temporaryIndex]
+    # Hull vertex moved inward or the old position is still on the hull, recompute the hull
+    self.points[index] = position
+    self._rebuild()
+    return True
+
+  def _getFirstDifferentIndex(self, shorterList, longerList):
+    for index in range(len(shorterList)):
+      if shorterList[index] != longerList[index]:
+        return index
+    return len(shorterList)
+
+  def _updateTolerance(self, position):
+    scale = max(abs(c) for c in position)
+    self.tolerance = max(self.tolerance, 1e-10 * scale)
+
+  def _rebuild(self):
+    self._resetFacets()
+    self.valid = False
+    self.tolerance = 1e-10
+    for position in self.points:
+      self._updateTolerance(position)
+    simplex = self._getInitialSimplex()
+    if not simplex:
+      return
+    self.valid = True
+    for facetIndices in [(0, 1, 2), (0, 1, 3), (0, 2, 3), (1, 2, 3)]:
+      a, b, c = [simplex[i] for i in facetIndices]
+      opposite = [simplex[i] for i in range(4) if i not in facetIndices][0]
+      # orient the facet so that the remaining vertex of the tetrahedron is behind it
+      normal = self._cross(self._subtract(self.points[b], self.points[a]), self._subtract(self.points[c], self.points[a]))
+      if self._dot(normal, self._subtract(self.points[opposite], self.points[a])) > 0:
+        b, c = c, b
+      self._addFacet(a, b, c)
+    for index in range(len(self.points)):
+      if index not in simplex:
+        self._addHullVertex(index)
+
+  def _getInitialSimplex(self):
+    """Find 4 non-coplanar points. Returns None if points are degenerate."""
+    if len(self.points) < 4:
+      return None
+    points = self.points
+    i0 = 0
+    i1 = max(range(len(points)), key=lambda i: self._squaredLength(self._subtract(points[i], points[i0])))
+    if self._squaredLength(self._subtract(points[i1], points[i0])) <= self.tolerance ** 2:
+      return None
+    direction = self._subtract(points[i1], points[i0])
+    i2 = max(range(len(points)), key=lambda i: self._squaredLength(self._cross(direction, self._subtract(points[i], points[i0]))))
+    normal = self._cross(direction, self._subtract(points[i2], points[i0]))
+    normalLength = self._squaredLength(normal) ** 0.5
+    if normalLength <= self.tolerance * self._squaredLength(direction) ** 0.5:
+      return None
+    i3 = max(range(len(points)), key=lambda i: abs(self._dot(normal, self._subtract(points[i], points[i0]))))
+    if abs(self._dot(normal, self._subtract(points[i3], points[i0]))) / normalLength <= self.tolerance:
+      return None
+    return [i0, i1, i2, i3]
+
+  def _getVisibleFacets(self, position):
+    visibleFacets = []
+    for facetId, plane in self.planes.items():
+      if plane[0] * position[0] + plane[1] * position[1] + plane[2] * position[2] - plane[3] > self.tolerance:
+        visibleFacets.append(facetId)
+    return visibleFacets
+
+  def _addHullVertex(self, index):
+    """Extend the hull with the point at the specified index. Returns True if the point was outside the hull."""
+    visibleFacets = self._getVisibleFacets(self.points[index])
+    if not visibleFacets:
+      return False
+    # Find horizon: boundary edges of the region that is visible from the new point
+    visibleFacetSet = set(visibleFacets)
+    horizonEdges = []
+    for facetId in visibleFacets:
+      a, b, c = self.facets[facetId]
+      for edge in ((a, b), (b, c), (c, a)):
+        if self.edges[(edge[1], edge[0])] not in visibleFacetSet:
+          horizonEdges.append(edge)
+    # Replace visible facets by a cone of facets connecting the horizon to the new point
+    for facetId in visibleFacets:
+      self._removeFacet(facetId)
+    for a, b in horizonEdges:
+      self._addFacet(a, b, index)
+    return True
+
+  def _addFacet(self, a, b, c):
+    facetId = self.nextFacetId
+    self.nextFacetId += 1
+    self.facets[facetId] = (a, b, c)
+    self.planes[facetId] = self._getPlane(a, b, c)
+    for edge in ((a, b), (b, c), (c, a)):
+      self.edges[edge] = facetId
+    for index in (a, b, c):
+      self.vertexFacetCounts[index] = self.vertexFacetCounts.get(index, 0) + 1
+
+  def _removeFacet(self, facetId):
+    a, b, c = self.facets.pop(facetId)
+    del self.planes[facetId]
+    for edge in ((a, b), (b, c), (c, a)):
+      del self.edges[edge]
+    for index in (a, b, c):
+      self.vertexFacetCounts[index] -= 1
+      if not self.vertexFacetCounts[index]:
+        del self.vertexFacetCounts[index]
+
+  def _getPlane(self, a, b, c):
+    pointA = self.points[a]
+    normal = self._cross(self._subtract(self.points[b], pointA), self._subtract(self.points[c], pointA))
+    length = self._squaredLength(normal) ** 0.5
+    if length == 0.0:
+      # degenerate facet, never visible
+      return (0.0, 0.0, 0.0, 0.0)
+    normal = [component / length for component in normal]
+    return (normal[0], normal[1], normal[2], self._dot(normal, pointA))
+
+  def _renameVertex(self, oldIndex, newIndex):
+    self._remapIndices(lambda index: newIndex if index == oldIndex else index)
+
+  def _shiftIndices(self, firstIndex, offset):
+    """Add offset to all point indices that are greater than or equal to firstIndex"""
+    self._remapIndices(lambda index: index + offset if index >= firstIndex else index)
+
+  def _remapIndices(self, remap):
+    facets = self.facets
+    planes = self.planes
+    nextFacetId = self.nextFacetId
+    self._resetFacets()
+    for facetId in sorted(facets):
+      a, b, c = [remap(index) for index in facets[facetId]]
+      self.facets[facetId] = (a, b, c)
+      self.planes[facetId] = planes[facetId]
+      for edge in ((a, b), (b, c), (c, a)):
+        self.edges[edge] = facetId
+      for index in (a, b, c):
+        self.vertexFacetCounts[index] = self.vertexFacetCounts.get(index, 0) + 1
+    self.nextFacetId = nextFacetId
+
+  @staticmethod
+  def _subtract(p1, p2):
+    return (p1[0] - p2[0], p1[1] - p2[1], p1[2] - p2[2])
+
+  @staticmethod
+  def _cross(v1, v2):
+    return (v1[1] * v2[2] - v1[2] * v2[1], v1[2] * v2[0] - v1[0] * v2[2], v1[0] * v2[1] - v1[1] * v2[0])
+
+  @staticmethod
+  def _dot(v1, v2):
+    return v1[0] * v2[0] + v1[1] * v2[1] + v1[2] * v2[2]
+
+  @staticmethod
+  def _squaredLength(v):
+    return v[0] * v[0] + v[1] * v[1] + v[2] * v[2]
@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import threading
+
+__all__ = ["FrameCache", "getPrefetchFrameIndices"]
+
+#
+# FrameCache
+#
+
+class FrameCache(object):
+  """Least recently used cache of clipped frames of a sequence, with prefetching of adjacent frames.
+
+  Frames are computed by clipFrame(frameIndex), which returns a voxel array. When a frame is requested
+  then the frames next to it (in both directions, wrapping around at the end of the sequence, as in looped
+  playback) are computed on a background thread, so that they are already available when the sequence is
+  browsed or played back. clipFrame is called from the background thread, therefore it must not access MRML nodes.
+  Frames stored in the cache are shared, they must not be modified.
+  Total size of the cached frames is limited by the memory budget.
+  """
+
+  def __init__(self, clipFrame, numberOfFrames, memoryBudgetBytes=512*1024*1024, numberOfPrefetchedFrames=2):
+    self.clipFrame = clipFrame
+    self.numberOfFrames = numberOfFrames
+    self.memoryBudgetBytes = memoryBudgetBytes
+    self.numberOfPrefetchedFrames = numberOfPrefetchedFrames
+    self.memoryUsageBytes = 0
+    # frame index -> (voxels, size in bytes), most recently used item is the last
+    self.frames = collections.OrderedDict()
+    # frame index -> future of frames that are scheduled for computation on the background thread
+    self.pendingFrames = {}
+    self.executor = None
+    self.lock = threading.RLock()
+    self.resetStatistics()
+
+  def setMemoryBudget(self, memoryBudgetBytes):
+    """Set maximum total size of cached frames. Set to 0 to disable caching."""
+    with self.lock:
+      self.memoryBudgetBytes = memoryBudgetBytes
+      self.evict(0)
+
+  def getMemoryBudget(self):
+    return self.memoryBudgetBytes
+
+  def getMemoryUsage(self):
+    return self.memoryUsageBytes
+
+  def setNumberOfPrefetchedFrames(self, numberOfPrefetchedFrames):
+    """Set number of frames that are computed in advance after and before the requested frame. Set to 0 to disable prefetching."""
+    self.numberOfPrefetchedFrames = numberOfPrefetchedFrames
+
+  def getNumberOfPrefetchedFrames(self):
+    return self.numberOfPrefetchedFrames
+
+  def getFrame(self, frameIndex):
+    """Returns the clipped frame and starts prefetching of adjacent frames.
+
+    If the frame is being computed on the background thread then this method waits for it,
+    if it is not cached and not scheduled then it is computed on the calling thread.
+    """
+    with self.lock:
+      item = self.frames.get(frameIndex)
+      future = self.pendingFrames.get(frameIndex)
+      if item is not None:
+        self.hits += 1
+        self.frames.move_to_end(frameIndex)
+      elif future is not None and not future.cancelled():
+        self.prefetchHits += 1
+      else:
+        future = None
+        self.misses += 1
+    if item is not None:
+      voxels = item[0]
+    elif future is not None:
+      voxels = future.result()
+    else:
+      voxels = self.clipFrame(frameIndex)
+      self.add(frameIndex, voxels)
+    self.prefetch(frameIndex)
+    return voxels
+
+  def prefetch(self, frameIndex):
+    """Schedule computation of frames next to the frame on the background thread.
+    Scheduled frames that are not adjacent anymore (and not started yet) are cancelled."""
+    frameIndices = getPrefetchFrameIndices(frameIndex, self.numberOfFrames, self.numberOfPrefetchedFrames)
+    with self.lock:
+      for pendingFrameIndex in list(self.pendingFrames.keys()):
+        if pendingFrameIndex not in frameIndices and self.pendingFrames[pendingFrameIndex].cancel():
+          del self.pendingFrames[pendingFrameIndex]
+      for prefetchedFrameIndex in frameIndices:
+        if prefetchedFrameIndex in self.frames or prefetchedFrameIndex in self.pendingFrames:
+          continue
+        if self.executor is None:
+          self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pendingFrames[prefetchedFrameIndex] = self.executor.submit(self._clipPendingFrame, prefetchedFrameIndex)
+
+  def _clipPendingFrame(self, frameIndex):
+    try:
+      voxels = self.clipFrame(frameIndex)
+      self.add(frameIndex, voxels)
+      return voxels
+    finally:
+      with self.lock:
+        self.pendingFrames.pop(frameIndex, None)
+
+  def add(self, frameIndex, voxels):
+    """Store a frame. Least recently used frames are removed if the memory budget is exceeded."""
+    sizeBytes = voxels.nbytes
+    with self.lock:
+      self.remove(frameIndex)
+      if sizeBytes > self.memoryBudgetBytes:
+        # would not fit even into an empty cache
+        return
+      self.evict(sizeBytes)
+      self.frames[frameIndex] = (voxels, sizeBytes)
+      self.memoryUsageBytes += sizeBytes
+
+  def remove(self, frameIndex):
+    with self.lock:
+      item = self.frames.pop(frameIndex, None)
+      if item is not None:
+        self.memoryUsageBytes -= item[1]
+
+  def evict(self, requiredBytes):
+    """Remove least recently used frames until requiredBytes fits into the memory budget."""
+    with self.lock:
+      while self.frames and self.memoryUsageBytes + requiredBytes > self.memoryBudgetBytes:
+        frameIndex, item = self.frames.popitem(last=False)
+        self.memoryUsageBytes -= item[1]
+        self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.frames.clear()
+      self.memoryUsageBytes = 0
+
+  def shutdown(self):
+    """Cancel scheduled frames, wait for the frame that is being computed, and remove all frames"""
+    with self.lock:
+      for future in self.pendingFrames.values():
+        future.cancel()
+      executor = self.executor
+      self.executor = None
+    if executor is not None:
+      executor.shutdown(wait=True)
+    with self.lock:
+      self.pendingFrames.clear()
+    self.clear()
+
+  def resetStatistics(self):
+    with self.lock:
+      self.hits = 0
+      self.prefetchHits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def getStatistics(self):
+    """Returns a dictionary containing hit/miss counters and memory usage.
+    prefetchHits counts requested frames that were still being computed on the background thread."""
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "prefetchHits": self.prefetchHits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "numberOfFrames": len(self.frames),
+        "numberOfPendingFrames": len(self.pendingFrames),
+        "memoryUsageBytes": self.memoryUsageBytes,
+        "memoryBudgetBytes": self.memoryBudgetBytes,
+        }
+
+def getPrefetchFrameIndices(frameIndex, numberOfFrames, numberOfPrefetchedFrames):
+  """Returns indices of frames after and before the frame (next frame first), wrapping around at the end of the sequence"""
+  frameIndices = []
+  for offset in range(1, numberOfPrefetchedFrames + 1):
+    for direction in (1, -1):
+      prefetchedFrameIndex = (frameIndex + direction * offset) % numberOfFrames
+      if prefetchedFrameIndex != frameIndex and prefetchedFrameIndex not in frameIndices:
+        frameIndices.append(prefetchedFrameIndex)
+  return frameIndices
@@ -0,0 +1,254 @@
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+
+__all__ = ["ImageFileInfo", "readImageFileInfo", "openVoxelArray", "writeNrrdHeader"]
+
+#
+# Reading and writing image files without loading them into memory
+#
+# Only uncompressed data can be accessed this way: voxels are memory-mapped from the file and written slab by slab.
+# Supported formats: NRRD (.nrrd, .nhdr with detached data file; raw encoding), NIfTI-1 (.nii, .hdr/.img pair;
+# 3D scalar images) and raw files (geometry is specified by the caller). Output files are written in NRRD format.
+#
+
+class ImageFileInfo(object):
+  """Location, voxel type and geometry of the voxel data in an image file.
+
+  :param dataFilePath: file that contains the voxel data
+  :param shape: voxel array shape (k, j, i) or (k, j, i, components)
+  :param dtype: voxel type (numpy dtype, with byte order)
+  :param ijkToRas: 4x4 numpy array that maps voxel index to RAS coordinates (identity by default)
+  :param dataOffset: position of the first voxel in the data file, in bytes
+  """
+
+  def __init__(self, dataFilePath, shape, dtype, ijkToRas=None, dataOffset=0):
+    self.dataFilePath = dataFilePath
+    self.shape = tuple(int(size) for size in shape)
+    self.dtype = np.dtype(dtype)
+    self.ijkToRas = np.eye(4) if ijkToRas is None else np.array(ijkToRas, dtype=np.float64)
+    self.dataOffset = int(dataOffset)
+    # Stored voxel values are mapped to intensity values as: intensity = storedValue * scaleSlope + scaleIntercept
+    self.scaleSlope = 1.0
+    self.scaleIntercept = 0.0
+
+  def getExtent(self):
+    return (0, self.shape[2] - 1, 0, self.shape[1] - 1, 0, self.shape[0] - 1)
+
+  def hasValueScaling(self):
+    return self.scaleSlope != 1.0 or self.scaleIntercept != 0.0
+
+def readImageFileInfo(filePath):
+  """Read the header of a NRRD or NIfTI file. Raises ValueError if the file cannot be accessed without loading it."""
+  lowerFilePath = filePath.lower()
+  if lowerFilePath.endswith(".nrrd") or lowerFilePath.endswith(".nhdr"):
+    return _readNrrdFileInfo(filePath)
+  if lowerFilePath.endswith(".nii") or lowerFilePath.endswith(".hdr"):
+    return _readNiftiFileInfo(filePath)
+  if lowerFilePath.endswith(".gz"):
+    raise ValueError("Compressed image files cannot be memory-mapped: {0}".format(filePath))
+  raise ValueError("Unsupported image file format: {0}. Use ImageFileInfo to specify the layout of raw files.".format(filePath))
+
+def openVoxelArray(imageFileInfo):
+  """Returns a read-only memory-mapped voxel array indexed as [k, j, i] (or [k, j, i, component])"""
+  return np.memmap(imageFileInfo.dataFilePath, dtype=imageFileInfo.dtype, mode="r",
+    offset=imageFileInfo.dataOffset, shape=imageFileInfo.shape)
+
+def writeNrrdHeader(outputFile, shape, dtype, ijkToRas):
+  """Write NRRD header (raw encoding, attached data) to a binary file. Voxel data must be written after the header
+  in [k, j, i] (or [k, j, i, component]) order.
+  """
+  dtype = np.dtype(dtype)
+  ijkToLps = np.dot(np.diag([-1.0, -1.0, 1.0, 1.0]), ijkToRas)
+  spaceDirections = " ".join("({0:.17g},{1:.17g},{2:.17g})".format(*ijkToLps[:3, axis]) for axis in range(3))
+  sizes = [shape[2], shape[1], shape[0]]
+  kinds = "domain domain domain"
+  if len(shape) > 3:
+    sizes = [shape[3]] + sizes
+    spaceDirections = "none " + spaceDirections
+    kinds = "vector " + kinds
+  lines = [
+    "NRRD0004",
+    "type: " + _nrrdTypeNames[dtype.newbyteorder("<").str],
+    "dimension: {0}".format(len(sizes)),
+    "space: left-posterior-superior",
+    "sizes: " + " ".join(str(size) for size in sizes),
+    "space directions: " + spaceDirections,
+    "kinds: " + kinds,
+    "endian: " + ("big" if dtype.byteorder == ">" or (dtype.byteorder == "=" and sys.byteorder == "big") else "little"),
+    "encoding: raw",
+    "space origin: ({0:.17g},{1:.17g},{2:.17g})".format(*ijkToLps[:3, 3]),
+    ]
+  outputFile.write(("\n".join(lines) + "\n\n").encode("ascii"))
+
+_nrrdTypeNames = {"|i1": "int8", "|u1": "uint8", "<i2": "int16", "<u2": "uint16", "<i4": "int32", "<u4": "uint32",
+  "<i8": "int64", "<u8": "uint64", "<f4": "float", "<f8": "double"}
+
+_nrrdTypes = {typeName: dtype for typeNames, dtype in [
+  (("signed char", "int8", "int8_t"), "i1"), (("uchar", "unsigned char", "uint8", "uint8_t"), "u1"),
+  (("short", "short int", "signed short", "signed short int", "int16", "int16_t"), "i2"),
+  (("ushort", "unsigned short", "unsigned short int", "uint16", "uint16_t"), "u2"),
+  (("int", "signed int", "int32", "int32_t"), "i4"), (("uint", "unsigned int", "uint32", "uint32_t"), "u4"),
+  (("longlong", "long long", "long long int", "signed long long", "signed long long int", "int64", "int64_t"), "i8"),
+  (("ulonglong", "unsigned long long", "unsigned long long int", "uint64", "uint64_t"), "u8"),
+  (("float",), "f4"), (("double",), "f8")] for typeName in typeNames}
+
+def _parseNrrdVector(text):
+  return [float(component) for component in text.strip().strip("()").split(",")]
+
+def _parseNrrdVectors(text):
+  """Returns list of vectors, skipping 'none' entries"""
+  return [_parseNrrdVector(vectorText) for vectorText in re.findall(r"\([^)]*\)", text)]
+
+# Axis kinds of spatial (or temporal) sampling axes, all other kinds (vector, RGB-color, list, ...) are voxel component axes
+_nrrdDomainKinds = ["domain", "space", "time"]
+
+def _getNrrdDomainAxes(fields, dimension, filePath):
+  """Returns a list that contains for each axis True if it is a domain axis, False if it is a component axis,
+  None if it is not known. Axis kinds are used if specified, otherwise axes without space direction are component axes.
+  """
+  if "kinds" in fields:
+    kinds = fields["kinds"].lower().split()
+    if len(kinds) != dimension:
+      raise ValueError("Number of NRRD axis kinds is different from the dimension: {0}".format(filePath))
+    return [None if kind in ["???", "none"] else kind in _nrrdDomainKinds for kind in kinds]
+  if "space directions" in fields:
+    directions = re.findall(r"none|\([^)]*\)", fields["space directions"], re.IGNORECASE)
+    if len(directions) == dimension:
+      return [direction.lower() != "none" for direction in directions]
+  return [None] * dimension
+
+def _readNrrdFileInfo(filePath):
+  fields = {}
+  with open(filePath, "rb") as headerFile:
+    magic = headerFile.readline()
+    if not magic.startswith(b"NRRD"):
+      raise ValueError("Not a NRRD file: {0}".format(filePath))
+    while True:
+      line = headerFile.readline()
+      if not line:
+        break
+      line = line.decode("latin-1").rstrip("\r\n")
+      if not line:
+        # Empty line separates the header from attached data
+        break
+      if line.startswith("#") or ":=" in line:
+        # comment or key/value pair
+        continue
+      fieldName, fieldValue = line.split(":", 1)
+      fields[fieldName.strip().lower()] = fieldValue.strip()
+    headerSize = headerFile.tell()
+
+  encoding = fields.get("encoding", "raw").lower()
+  if encoding != "raw":
+    raise ValueError("NRRD files with '{0}' encoding cannot be memory-mapped: {1}".format(encoding, filePath))
+  typeName = fields["type"].lower()
+  if typeName not in _nrrdTypes:
+    raise ValueError("Unsupported NRRD voxel type '{0}': {1}".format(typeName, filePath))
+  dtype = np.dtype(_nrrdTypes[typeName])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder(">" if fields.get("endian", "little").lower() == "big" else "<")
+
+  sizes = [int(size) for size in fields["sizes"].split()]
+  if len(sizes) not in [3, 4]:
+    raise ValueError("Only 3D images are supported: {0}".format(filePath))
+  # Voxel components must be stored along the first axis (as in files written by Slicer), as voxel arrays
+  # are indexed as [k, j, i, component]. Other layouts, such as a time series stored along the last axis, are rejected.
+  domainAxes = _getNrrdDomainAxes(fields, len(sizes), filePath)
+  if (len(sizes) == 4 and domainAxes[0] is not False) or False in domainAxes[-3:]:
+    raise ValueError("Only 3D images are supported, with voxel components stored along the first axis"
+      " (kinds: {0}): {1}".format(fields.get("kinds", "not specified"), filePath))
+  numberOfComponents = sizes.pop(0) if len(sizes) == 4 else None
+
+  # Geometry
+  ijkToRas = np.eye(4)
+  if "space directions" in fields:
+    directions = _parseNrrdVectors(fields["space directions"])
+    for axis in range(3):
+      ijkToRas[:3, axis] = directions[axis]
+    if "space origin" in fields:
+      ijkToRas[:3, 3] = _parseNrrdVector(fields["space origin"])
+  elif "spacings" in fields:
+    spacings = [float(spacing) for spacing in fields["spacings"].split() if spacing.lower() != "nan"]
+    ijkToRas[:3, :3] = np.diag(spacings[:3])
+  space = fields.get("space", "left-posterior-superior").lower()
+  if space in ["left-posterior-superior", "lps"]:
+    ijkToRas = np.dot(np.diag([-1.0, -1.0, 1.0, 1.0]), ijkToRas)
+  elif space not in ["right-anterior-superior", "ras"]:
+    raise ValueError("Unsupported NRRD space '{0}': {1}".format(space, filePath))
+
+  # Voxel data location
+  dataFilePath = filePath
+  dataOffset = headerSize
+  if "data file" in fields or "datafile" in fields:
+    dataFileName = fields.get("data file", fields.get("datafile"))
+    if dataFileName.startswith("LIST") or " " in dataFileName:
+      raise ValueError("NRRD files with multiple data files are not supported: {0}".format(filePath))
+    dataFilePath = os.path.join(os.path.dirname(filePath), dataFileName)
+    dataOffset = 0
+  byteSkip = int(fields.get("byte skip", fields.get("byteskip", 0)))
+  if byteSkip < 0:
+    raise ValueError("NRRD files with negative byte skip are not supported: {0}".format(filePath))
+  dataOffset += byteSkip
+
+  shape = (sizes[2], sizes[1], sizes[0])
+  if numberOfComponents is not None:
+    shape += (numberOfComponents,)
+  return ImageFileInfo(dataFilePath, shape, dtype, ijkToRas, dataOffset)
+
+_niftiTypes = {2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8"}
+
+def _readNiftiFileInfo(filePath):
+  with open(filePath, "rb") as headerFile:
+    header = headerFile.read(348)
+  if len(header) < 348:
+    raise ValueError("Not a NIfTI file: {0}".format(filePath))
+  byteOrder = "<" if struct.unpack("<i", header[0:4])[0] == 348 else ">"
+  if struct.unpack(byteOrder + "i", header[0:4])[0] != 348 or header[344:347] not in [b"n+1", b"ni1"]:
+    raise ValueError("Not a NIfTI-1 file: {0}".format(filePath))
+
+  dim = struct.unpack(byteOrder + "8h", header[40:56])
+  if dim[0] < 3 or any(size > 1 for size in dim[4:dim[0] + 1]):
+    raise ValueError("Only 3D scalar NIfTI images are supported: {0}".format(filePath))
+  datatype = struct.unpack(byteOrder + "h", header[70:72])[0]
+  if datatype not in _niftiTypes:
+    raise ValueError("Unsupported NIfTI datatype {0}: {1}".format(datatype, filePath))
+  dtype = np.dtype(_niftiTypes[datatype])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder(byteOrder)
+  pixdim = struct.unpack(byteOrder + "8f", header[76:108])
+  voxOffset = struct.unpack(byteOrder + "f", header[108:112])[0]
+  sclSlope, sclInter = struct.unpack(byteOrder + "2f", header[112:120])
+  qformCode, sformCode = struct.unpack(byteOrder + "2h", header[252:256])
+
+  # Geometry (NIfTI world coordinate system is RAS)
+  ijkToRas = np.eye(4)
+  if sformCode > 0:
+    ijkToRas[:3, :] = np.array(struct.unpack(byteOrder + "12f", header[280:328])).reshape(3, 4)
+  elif qformCode > 0:
+    b, c, d, qx, qy, qz = struct.unpack(byteOrder + "6f", header[256:280])
+    a = np.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = np.array([
+      [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+      [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+      [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    ijkToRas[:3, :3] = np.dot(rotation, np.diag([pixdim[1], pixdim[2], pixdim[3] * qfac]))
+    ijkToRas[:3, 3] = [qx, qy, qz]
+  else:
+    ijkToRas[:3, :3] = np.diag(pixdim[1:4])
+
+  if header[344:347] == b"n+1":
+    dataFilePath = filePath
+  else:
+    # Header and image are stored in separate files
+    dataFilePath = filePath[:-4] + (".IMG" if filePath.endswith(".HDR") else ".img")
+
+  imageFileInfo = ImageFileInfo(dataFilePath, (dim[3], dim[2], dim[1]), dtype, ijkToRas, int(voxOffset))
+  if sclSlope != 0 and np.isfinite(sclSlope) and np.isfinite(sclInter):
+    imageFileInfo.scaleSlope = float(sclSlope)
+    imageFileInfo.scaleIntercept = float(sclInter)
+  return imageFileInfo
@@ -0,0 +1,50 @@
+import numpy as np
+
+from .SlabProcessing import getSlabExtents
+
+__all__ = ["packMask", "writeMaskFile", "readMaskFile"]
+
+#
+# Compact storage of clipping masks
+#
+# Masks are stored with 1 bit per voxel: each image row is packed into bytes (np.packbits along the I axis),
+# therefore a packed mask is indexed as [k, j, byte]. Mask files are compressed numpy archives (npz),
+# which contain the packed mask and the voxel grid, so that the mask can be reapplied without rasterizing
+# the clipping shape again.
+#
+
+_maskFileFormatVersion = 1
+
+def packMask(getSlabMask, extent, maxSlabSizeBytes=64*1024*1024):
+  """Returns a bit-packed mask (uint8 array indexed as [k, j, byte]).
+
+  :param getSlabMask: function(slabExtent) that returns the boolean mask of a slab of the extent
+    (for example, VolumeClipLib.getStencilMask)
+  The mask is computed slab by slab, so the full-size unpacked mask is not allocated.
+  """
+  numberOfSlices = extent[5] - extent[4] + 1
+  sliceSizeBytes = (extent[1] - extent[0] + 1) * (extent[3] - extent[2] + 1)
+  numberOfSlabs = -(-(numberOfSlices * sliceSizeBytes) // maxSlabSizeBytes)
+  slabMasks = [np.packbits(getSlabMask(slabExtent), axis=-1) for slabExtent in getSlabExtents(extent, numberOfSlabs)]
+  return np.concatenate(slabMasks) if len(slabMasks) > 1 else slabMasks[0]
+
+def writeMaskFile(filePath, packedMask, extent, ijkToRas):
+  """Write a bit-packed mask (see packMask) and its voxel grid into a compressed file.
+
+  :param extent: voxel extent of the mask (i0, i1, j0, j1, k0, k1)
+  :param ijkToRas: 4x4 numpy array
+  """
+  with open(filePath, "wb") as maskFile:
+    np.savez_compressed(maskFile, formatVersion=np.array(_maskFileFormatVersion), packedMask=packedMask,
+      extent=np.array(extent, dtype=np.int64), ijkToRas=np.asarray(ijkToRas, dtype=np.float64))
+
+def readMaskFile(filePath):
+  """Read a mask file written by writeMaskFile.
+  Returns boolean mask (indexed as [k, j, i]), voxel extent, and IJK to RAS matrix (4x4 numpy array).
+  """
+  with np.load(filePath, allow_pickle=False) as maskFile:
+    if int(maskFile["formatVersion"]) > _maskFileFormatVersion:
+      raise ValueError("Unsupported mask file version {0}: {1}".format(int(maskFile["formatVersion"]), filePath))
+    extent = tuple(int(value) for value in maskFile["extent"])
+    mask = np.unpackbits(maskFile["packedMask"], axis=-1, count=extent[1] - extent[0] + 1).view(bool)
+    return mask, extent, maskFile["ijkToRas"]
@@ -0,0 +1,66 @@
+import numpy as np
+
+__all__ = ["applyMask", "applyWeightedMask", "fillMask"]
+
+def applyMask(inputVoxels, insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue, outputVoxels=None):
+  """Returns a voxel array where voxels are filled inside and/or outside the mask.
+
+  :param inputVoxels: numpy array indexed as [k, j, i] (optionally with an additional component axis)
+  :param insideMask: boolean array indexed as [k, j, i], True inside the clipping shape
+  :param fillOutsideValue, fillInsideValue: fill values (already cast to the voxel type)
+  :param outputVoxels: array where the result is written, a new array is created if not specified
+
+  The input is read only once and the output is written once, the mask is not inverted or copied.
+  """
+  if inputVoxels.ndim > insideMask.ndim:
+    insideMask = insideMask[..., np.newaxis]
+  if outputVoxels is None:
+    outputVoxels = np.empty_like(inputVoxels)
+  if clipOutside:
+    outputVoxels[...] = fillOutsideValue
+    if clipInside:
+      np.copyto(outputVoxels, fillInsideValue, where=insideMask)
+    else:
+      np.copyto(outputVoxels, inputVoxels, where=insideMask)
+  else:
+    outputVoxels[...] = inputVoxels
+    if clipInside:
+      np.copyto(outputVoxels, fillInsideValue, where=insideMask)
+  return outputVoxels
+
+def fillMask(voxels, insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue):
+  """Fill voxels inside and/or outside the mask, in place.
+
+  Parameters are the same as for applyMask. Only the voxels that are filled are written.
+  """
+  if voxels.ndim > insideMask.ndim:
+    insideMask = insideMask[..., np.newaxis]
+  if clipOutside and clipInside:
+    voxels[...] = fillOutsideValue
+    np.copyto(voxels, fillInsideValue, where=insideMask)
+  elif clipOutside:
+    np.copyto(voxels, fillOutsideValue, where=~insideMask)
+  elif clipInside:
+    np.copyto(voxels, fillInsideValue, where=insideMask)
+  return voxels
+
+def applyWeightedMask(inputVoxels, insideWeights, clipOutside, fillOutsideValue, clipInside, fillInsideValue, outputVoxels=None):
+  """Returns a voxel array that blends the inside and outside results according to a weight for each voxel.
+
+  Parameters are the same as for applyMask, except insideWeights, which is a floating-point array indexed as [k, j, i]:
+  1 is the same as inside, 0 is the same as outside, voxels in between are linearly interpolated.
+  Integer results are rounded and clamped to the range of the voxel type.
+  The output array may be the same as the input array.
+  """
+  if inputVoxels.ndim > insideWeights.ndim:
+    insideWeights = insideWeights[..., np.newaxis]
+  if outputVoxels is None:
+    outputVoxels = np.empty_like(inputVoxels)
+  outsideValues = np.asarray(fillOutsideValue if clipOutside else inputVoxels, dtype=np.float64)
+  insideValues = np.asarray(fillInsideValue if clipInside else inputVoxels, dtype=np.float64)
+  blendedVoxels = outsideValues + insideWeights * (insideValues - outsideValues)
+  if outputVoxels.dtype.kind in "iu":
+    typeInfo = np.iinfo(outputVoxels.dtype)
+    blendedVoxels = np.clip(np.rint(blendedVoxels), typeInfo.min, typeInfo.max)
+  outputVoxels[...] = blendedVoxels
+  return outputVoxels
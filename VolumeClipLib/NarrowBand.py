@@ -0,0 +1,127 @@
+import numpy as np
+
+from .BrickClassifier import classifyPolyDataBricks, clipBricks, defaultBrickSize
+from .VoxelArray import getStencilMask
+
+__all__ = ["getSquaredDistances", "getSignedDistances", "getInsideWeights", "clipWithNarrowBand"]
+
+#
+# Narrow-band signed distance from a rasterized surface
+#
+# Clipping with a margin (the surface is grown or shrunk by a distance) or with a feathered boundary (fill values
+# ramp from inside to outside) requires the signed distance from the clipping surface, but only near the surface:
+# further away all voxels are completely inside or outside. Therefore the distance is only computed in bricks
+# near the surface (see BrickClassifier), and only up to the band width, so memory and time depend on the size
+# of the band and not on the size of the volume.
+#
+# Distances are computed from the rasterized surface (stencil), between voxel centers, in physical units
+# (voxel spacing is taken into account). The surface is assumed to be halfway between inside and outside voxels,
+# therefore distances are accurate to about half a voxel.
+#
+
+def getSquaredDistances(targetMask, spacing, maximumDistance):
+  """Returns squared distance of each voxel from the nearest voxel where targetMask is True.
+
+  :param targetMask: boolean array indexed as [k, j, i]
+  :param spacing: voxel spacing along (i, j, k) axes
+  Distances are only computed up to maximumDistance (computation time is proportional to it),
+  larger distances are returned as infinity or as a value larger than maximumDistance squared.
+  """
+  # Separable exact Euclidean distance transform. Along rows the nearest target voxel is found directly
+  # (from the running index of the previous and next target voxels), along the other axes the minimum is
+  # searched within maximumDistance.
+  rowLength = targetMask.shape[2]
+  indices = np.arange(rowLength, dtype=np.float32)
+  previousTargets = np.where(targetMask, indices, np.float32(-np.inf))
+  np.maximum.accumulate(previousTargets, axis=2, out=previousTargets)
+  nextTargets = np.minimum.accumulate(np.where(targetMask, indices, np.float32(np.inf))[..., ::-1], axis=2)[..., ::-1]
+  squaredDistances = np.minimum(indices - previousTargets, nextTargets - indices)
+  squaredDistances *= np.float32(spacing[0])
+  np.square(squaredDistances, out=squaredDistances)
+  shiftedSquaredDistances = np.empty_like(squaredDistances)
+  for axis, axisSpacing in [(1, spacing[1]), (0, spacing[2])]:
+    axisLength = squaredDistances.shape[axis]
+    radius = min(int(maximumDistance / axisSpacing), axisLength - 1)
+    axisSquaredDistances = squaredDistances.copy()
+    for offset in range(1, radius + 1):
+      offsetSquaredDistance = np.float32((offset * axisSpacing) ** 2)
+      lower = [slice(None)] * 3
+      upper = [slice(None)] * 3
+      lower[axis] = slice(0, axisLength - offset)
+      upper[axis] = slice(offset, axisLength)
+      lower = tuple(lower)
+      upper = tuple(upper)
+      np.add(squaredDistances[lower], offsetSquaredDistance, out=shiftedSquaredDistances[lower])
+      np.minimum(axisSquaredDistances[upper], shiftedSquaredDistances[lower], out=axisSquaredDistances[upper])
+      np.add(squaredDistances[upper], offsetSquaredDistance, out=shiftedSquaredDistances[upper])
+      np.minimum(axisSquaredDistances[lower], shiftedSquaredDistances[upper], out=axisSquaredDistances[lower])
+    squaredDistances = axisSquaredDistances
+  return squaredDistances
+
+def getSignedDistances(stencil, regionExtent, imageExtent, spacing, minimumDistance, maximumDistance):
+  """Returns signed distance of voxels of the region from the boundary of the stencil (negative inside).
+
+  :param regionExtent: extent of the voxels where distance is computed
+  :param imageExtent: voxels outside the image extent are ignored (the image boundary is not a surface boundary)
+  :param spacing: physical voxel spacing along (i, j, k) axes
+  Only distances between minimumDistance and maximumDistance are accurate, other voxels are only guaranteed
+  to be below or above this range. Distance transform is only computed inside the surface if minimumDistance
+  is negative and outside if maximumDistance is positive.
+  """
+  # Voxel centers are at least half a voxel from the surface
+  halfVoxel = 0.5 * min(spacing)
+  maximumInsideDistance = -minimumDistance + halfVoxel if minimumDistance < 0 else 0.0
+  maximumOutsideDistance = maximumDistance + halfVoxel if maximumDistance > 0 else 0.0
+  padding = [int(np.ceil(max(maximumInsideDistance, maximumOutsideDistance) / axisSpacing)) + 1 for axisSpacing in spacing]
+  paddedExtent = []
+  for axis in range(3):
+    paddedExtent.append(max(regionExtent[axis * 2] - padding[axis], imageExtent[axis * 2]))
+    paddedExtent.append(min(regionExtent[axis * 2 + 1] + padding[axis], imageExtent[axis * 2 + 1]))
+  insideMask = getStencilMask(stencil, paddedExtent)
+  regionSlices = tuple(slice(regionExtent[axis * 2] - paddedExtent[axis * 2], regionExtent[axis * 2 + 1] - paddedExtent[axis * 2] + 1)
+    for axis in reversed(range(3)))
+  regionInsideMask = insideMask[regionSlices]
+  signedDistances = np.where(regionInsideMask, np.float32(-np.inf), np.float32(np.inf))
+  if maximumOutsideDistance > 0:
+    outsideDistances = np.sqrt(getSquaredDistances(insideMask, spacing, maximumOutsideDistance)[regionSlices]) - halfVoxel
+    np.copyto(signedDistances, outsideDistances, where=~regionInsideMask)
+  if maximumInsideDistance > 0:
+    insideDistances = np.sqrt(getSquaredDistances(~insideMask, spacing, maximumInsideDistance)[regionSlices]) - halfVoxel
+    np.copyto(signedDistances, -insideDistances, where=regionInsideMask)
+  return signedDistances
+
+def getInsideWeights(signedDistances, margin=0.0, featherWidth=0.0):
+  """Returns inside weights of voxels (see applyWeightedMask) from their signed distance from the surface.
+
+  :param margin: the surface is grown by this distance (shrunk if negative)
+  :param featherWidth: width of the linear ramp between inside and outside, centered on the grown surface.
+    If it is 0 then a boolean mask is returned.
+  """
+  if featherWidth <= 0:
+    return signedDistances <= margin
+  return np.clip(0.5 - (signedDistances - margin) / featherWidth, 0.0, 1.0)
+
+def clipWithNarrowBand(inputVoxels, polyData, imageData, stencil, spacing, margin, featherWidth,
+  clipOutside, fillOutsideValue, clipInside, fillInsideValue, numberOfThreads=None, outputVoxels=None, progressCallback=None):
+  """Returns a voxel array where voxels are filled inside and/or outside the surface, grown by a margin
+  and with a feathered boundary. Signed distance is only computed in a narrow band around the surface.
+
+  :param polyData: closed surface, in the image point coordinate system
+  :param stencil: the surface rasterized on the image (see rasterizePolyData)
+  :param spacing: physical voxel spacing along (i, j, k) axes (margin and featherWidth are in the same unit)
+  See getInsideWeights for margin and featherWidth, clipBricks for the other parameters.
+  """
+  extent = imageData.GetExtent()
+  # Weights only depend on the signed distance within this range, voxels further from the surface
+  # are completely inside or outside
+  minimumDistance = margin - featherWidth / 2.0
+  maximumDistance = margin + featherWidth / 2.0
+  # Bricks are classified using the bounding box of surface cells, which is more than a voxel from the surface
+  # only if the rasterized surface is also more than a voxel away
+  brickMargin = max(abs(minimumDistance), abs(maximumDistance)) / np.array(spacing, dtype=np.float64) + 2.0
+  brickLabels = classifyPolyDataBricks(polyData, imageData, stencil, brickMargin, defaultBrickSize)
+  def getBandWeights(runExtent):
+    signedDistances = getSignedDistances(stencil, runExtent, extent, spacing, minimumDistance, maximumDistance)
+    return getInsideWeights(signedDistances, margin, featherWidth)
+  return clipBricks(inputVoxels, brickLabels, extent, getBandWeights, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+    numberOfThreads=numberOfThreads, outputVoxels=outputVoxels, progressCallback=progressCallback)
@@ -0,0 +1,58 @@
+import concurrent.futures
+import os
+import time
+
+__all__ = ["getDefaultNumberOfThreads", "processInParallel"]
+
+#
+# Thread pool helpers
+#
+# NumPy and VTK (if built with VTK_PYTHON_FULL_THREADSAFE, as in Slicer) release the global interpreter lock
+# while processing large arrays, therefore processing of independent arrays runs concurrently on multiple threads.
+#
+
+def getDefaultNumberOfThreads():
+  return os.cpu_count() or 1
+
+def processInParallel(function, items, numberOfThreads=None, itemCompletedCallback=None):
+  """Call function for each item on a thread pool.
+
+  Returns a list that contains a dictionary for each item (in the same order as items):
+  "result" is the function return value, "error" is the raised exception (None if succeeded),
+  "processingTimeSec" is the time spent in the function.
+  Exceptions do not stop processing of the other items.
+
+  itemCompletedCallback(numberOfCompletedItems, numberOfItems) is called from the calling thread
+  each time an item is completed. If the callback raises an exception (for example, to cancel processing)
+  then items that are not started yet are skipped and the exception is re-raised.
+  """
+  if numberOfThreads is None:
+    numberOfThreads = getDefaultNumberOfThreads()
+
+  def processItem(item):
+    startTime = time.time()
+    try:
+      result, error = function(item), None
+    except Exception as e:
+      result, error = None, e
+    return {"result": result, "error": error, "processingTimeSec": time.time() - startTime}
+
+  items = list(items)
+  if numberOfThreads <= 1 or len(items) <= 1:
+    itemResults = []
+    for item in items:
+      itemResults.append(processItem(item))
+      if itemCompletedCallback:
+        itemCompletedCallback(len(itemResults), len(items))
+    return itemResults
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(numberOfThreads, len(items))) as executor:
+    futures = [executor.submit(processItem, item) for item in items]
+    if itemCompletedCallback:
+      try:
+        for numberOfCompletedItems, future in enumerate(concurrent.futures.as_completed(futures), 1):
+          itemCompletedCallback(numberOfCompletedItems, len(items))
+      except:
+        for future in futures:
+          future.cancel()
+        raise
+    return [future.result() for future in futures]
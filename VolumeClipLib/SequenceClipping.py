@@ -0,0 +1,143 @@
+import vtk
+
+from .FrameCache import FrameCache
+from .MaskFill import applyMask
+from .StencilCache import getImageGeometryKey
+from .VoxelArray import castFillValue, createImageData, getVoxelArray
+
+__all__ = ["SequenceClipping", "getBrowsedSequence", "getOutputSequence", "getSelectedFrameIndex", "updateOutputSequence"]
+
+#
+# Clipping of volume sequences
+#
+# Frames of a sequence (for example, 4D cine MR or CT perfusion) typically share the same voxel grid, therefore
+# the clipping shape is rasterized once and the same mask is applied to all frames. These helpers are shared by
+# the VolumeClip module logics. They work on the sequence, sequence browser, and volume nodes that are passed
+# to them, the slicer package is not imported.
+#
+
+def getBrowsedSequence(sequencesLogic, volumeNode):
+  """
+  Returns the sequence browser node that shows the volume as a proxy node and the sequence that is shown in it.
+  Returns (None, None) if the volume is not browsed.
+  :param sequencesLogic: logic of the Sequences module (slicer.modules.sequences.logic())
+  """
+  sequenceBrowserNode = sequencesLogic.GetFirstBrowserNodeForProxyNode(volumeNode)
+  if not sequenceBrowserNode:
+    return None, None
+  return sequenceBrowserNode, sequenceBrowserNode.GetSequenceNode(volumeNode)
+
+def getOutputSequence(sequenceBrowserNode, outputVolume):
+  """
+  Returns the sequence that the browser shows in the output volume. If there is no such sequence then
+  a new sequence is created and added to the browser, with the output volume as proxy node.
+  """
+  outputSequence = sequenceBrowserNode.GetSequenceNode(outputVolume)
+  if outputSequence:
+    return outputSequence
+  outputSequence = sequenceBrowserNode.GetScene().AddNewNodeByClass("vtkMRMLSequenceNode", outputVolume.GetName() + " sequence")
+  sequenceBrowserNode.AddSynchronizedSequenceNode(outputSequence)
+  sequenceBrowserNode.AddProxyNode(outputVolume, outputSequence, False)
+  return outputSequence
+
+def getSelectedFrameIndex(sequenceBrowserNode, sequenceNode):
+  """Returns index of the frame of the sequence that is selected in the browser, -1 if there is no such frame"""
+  selectedItemNumber = sequenceBrowserNode.GetSelectedItemNumber()
+  masterSequenceNode = sequenceBrowserNode.GetMasterSequenceNode()
+  if selectedItemNumber < 0 or not masterSequenceNode:
+    return -1
+  if masterSequenceNode == sequenceNode:
+    return selectedItemNumber
+  return sequenceNode.GetItemNumberFromIndexValue(masterSequenceNode.GetNthIndexValue(selectedItemNumber))
+
+def updateOutputSequence(outputSequence, inputSequence, inputVolumes, outputVolumes, results):
+  """Replace frames of the output sequence by the successfully clipped volumes, at the index values of the input sequence.
+  results contains a dictionary for each volume, with a "success" item (as returned by clipVolumesWithModel or clipVolumesWithRoi).
+  """
+  # Index values are read before the output is cleared, as it may be the input sequence
+  indexValues = [inputSequence.GetNthIndexValue(frameIndex) for frameIndex in range(len(inputVolumes))]
+  indexName, indexUnit, indexType = inputSequence.GetIndexName(), inputSequence.GetIndexUnit(), inputSequence.GetIndexType()
+  wasModified = outputSequence.StartModify()
+  outputSequence.RemoveAllDataNodes()
+  outputSequence.SetIndexName(indexName)
+  outputSequence.SetIndexUnit(indexUnit)
+  outputSequence.SetIndexType(indexType)
+  for inputVolume, outputVolume, indexValue, result in zip(inputVolumes, outputVolumes, indexValues, results):
+    if result["success"]:
+      outputVolume.SetName(inputVolume.GetName())
+      outputSequence.SetDataNodeAtValue(outputVolume, indexValue)
+  outputSequence.EndModify(wasModified)
+
+#
+# SequenceClipping
+#
+
+class SequenceClipping(object):
+  """Shows the clipped frame that is selected in a sequence browser in an output volume.
+
+  getInsideMask(imageData, ijkToRas) returns the mask of the clipping shape. It is called in the constructor,
+  once for each distinct image geometry (typically once for the whole sequence). Frames are clipped with the masks
+  when they are first shown, while the frames next to the selected frame are clipped in advance on a background
+  thread (see FrameCache), without accessing MRML nodes.
+  updateOutputVolume(outputVolume, outputImageData, ijkToRas) sets the clipped image in the output volume.
+  The output image refers to the cached voxels, therefore it must not be modified.
+  """
+
+  def __init__(self, sequenceBrowserNode, inputSequence, outputVolume, getInsideMask,
+    clipOutside, fillOutsideValue, clipInside, fillInsideValue, updateOutputVolume,
+    memoryBudgetBytes=512*1024*1024, numberOfPrefetchedFrames=2):
+    self.sequenceBrowserNode = sequenceBrowserNode
+    self.inputSequence = inputSequence
+    self.outputVolume = outputVolume
+    self.updateOutputVolume = updateOutputVolume
+    # Index of the frame that is shown in the output volume
+    self.frameIndex = -1
+
+    # (image data, IJK to RAS matrix, inside mask) of each frame
+    self.frames = []
+    insideMasks = {}
+    for frameIndex in range(inputSequence.GetNumberOfDataNodes()):
+      inputVolume = inputSequence.GetNthDataNode(frameIndex)
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+      imageData = inputVolume.GetImageData()
+      geometryKey = getImageGeometryKey(imageData, ijkToRas)
+      if geometryKey not in insideMasks:
+        insideMasks[geometryKey] = getInsideMask(imageData, ijkToRas)
+      self.frames.append((imageData, ijkToRas, insideMasks[geometryKey]))
+
+    def clipFrame(frameIndex):
+      imageData, ijkToRas, insideMask = self.frames[frameIndex]
+      inputVoxels = getVoxelArray(imageData)
+      return applyMask(inputVoxels, insideMask,
+        clipOutside, castFillValue(fillOutsideValue, inputVoxels.dtype),
+        clipInside, castFillValue(fillInsideValue, inputVoxels.dtype))
+    self.frameCache = FrameCache(clipFrame, len(self.frames), memoryBudgetBytes, numberOfPrefetchedFrames)
+
+  def isNumberOfFramesChanged(self):
+    """Returns True if frames were added to or removed from the input sequence since clipping was started"""
+    return self.inputSequence.GetNumberOfDataNodes() != len(self.frames)
+
+  def showSelectedFrame(self):
+    """Show the clipped frame that is selected in the sequence browser. Returns True if the output volume is updated."""
+    frameIndex = getSelectedFrameIndex(self.sequenceBrowserNode, self.inputSequence)
+    if frameIndex < 0 or frameIndex >= len(self.frames) or frameIndex == self.frameIndex:
+      return False
+    imageData, ijkToRas, insideMask = self.frames[frameIndex]
+    # Output image refers to the cached voxels (no copy is made), adjacent frames are clipped in the background
+    outputVoxels = self.frameCache.getFrame(frameIndex)
+    self.updateOutputVolume(self.outputVolume, createImageData(outputVoxels, imageData), ijkToRas)
+    self.frameIndex = frameIndex
+    return True
+
+  def setMemoryBudget(self, memoryBudgetBytes, numberOfPrefetchedFrames):
+    self.frameCache.setMemoryBudget(memoryBudgetBytes)
+    self.frameCache.setNumberOfPrefetchedFrames(numberOfPrefetchedFrames)
+
+  def getStatistics(self):
+    """Returns hit/miss counters and memory usage of the frame cache"""
+    return self.frameCache.getStatistics()
+
+  def shutdown(self):
+    """Stop clipping frames in the background and release the clipped frames. The output volume is kept as it is."""
+    self.frameCache.shutdown()
@@ -0,0 +1,191 @@
+import numpy as np
+import vtk
+
+from .BoxRasterizer import fillBox, fillObliqueBox, getAxisAlignedBoxSlices
+from .MaskFill import applyMask, fillMask
+from .ParallelProcessing import getDefaultNumberOfThreads, processInParallel
+from .VoxelArray import getStencilMask
+
+__all__ = ["getSlabExtents", "processSlabs", "getPolyDataExtent", "rasterizePolyData", "applyStencil", "clipBox"]
+
+#
+# Slab-parallel processing of images
+#
+# The image extent is split into slabs along the K axis and the slabs are processed concurrently on a thread pool.
+# Each slab is a contiguous block of the voxel array, therefore slabs can be read and written by different threads
+# without any locking. Slab functions spend most of their time in NumPy or VTK, which release the global
+# interpreter lock.
+#
+
+def getSlabExtents(extent, numberOfSlabs):
+  """Split the extent along the K axis into at most numberOfSlabs extents of (nearly) equal thickness"""
+  numberOfSlices = extent[5] - extent[4] + 1
+  numberOfSlabs = max(1, min(numberOfSlabs, numberOfSlices))
+  kBoundaries = np.linspace(extent[4], extent[5] + 1, numberOfSlabs + 1).round().astype(int)
+  return [(extent[0], extent[1], extent[2], extent[3], int(kBoundaries[slabIndex]), int(kBoundaries[slabIndex + 1]) - 1)
+    for slabIndex in range(numberOfSlabs)]
+
+def processSlabs(function, extent, numberOfThreads=None, slabsPerThread=4, progressCallback=None):
+  """Call function(slabExtent) for each slab of the extent on a thread pool.
+
+  More slabs than threads are used (slabsPerThread) so that the load is balanced even if processing time
+  is different for each slab. Returns the list of values returned by the function, in slab order.
+  The first exception raised by the function is re-raised after all slabs are processed.
+
+  progressCallback(fraction) is called from the calling thread after each completed slab. It may raise
+  an exception (such as ClipCancelledError) to stop processing of the remaining slabs.
+  """
+  if numberOfThreads is None:
+    numberOfThreads = getDefaultNumberOfThreads()
+  if numberOfThreads > 1:
+    numberOfSlabs = numberOfThreads * slabsPerThread
+  else:
+    # Single slab is the fastest, but multiple slabs are needed for reporting progress
+    numberOfSlabs = 16 if progressCallback else 1
+  itemCompletedCallback = None
+  if progressCallback:
+    itemCompletedCallback = lambda numberOfCompletedSlabs, numberOfSlabs: progressCallback(float(numberOfCompletedSlabs) / numberOfSlabs)
+  slabResults = processInParallel(function, getSlabExtents(extent, numberOfSlabs), numberOfThreads, itemCompletedCallback)
+  for slabResult in slabResults:
+    if slabResult["error"] is not None:
+      raise slabResult["error"]
+  return [slabResult["result"] for slabResult in slabResults]
+
+def getPolyDataExtent(polyData, imageData):
+  """Returns the extent of the image voxels within the bounding box of the polydata, clamped to the image extent.
+
+  :param polyData: surface in the image point coordinate system
+  Returns None if the bounding box does not overlap the image.
+  """
+  extent = imageData.GetExtent()
+  if polyData.GetNumberOfPoints() == 0:
+    return None
+  bounds = polyData.GetBounds()
+  origin = imageData.GetOrigin()
+  spacing = imageData.GetSpacing()
+  polyDataExtent = []
+  for axis in range(3):
+    indices = [(bounds[axis * 2 + side] - origin[axis]) / spacing[axis] for side in range(2)]
+    polyDataExtent.append(max(extent[axis * 2], int(np.floor(min(indices)))))
+    polyDataExtent.append(min(extent[axis * 2 + 1], int(np.ceil(max(indices)))))
+  if any(polyDataExtent[axis * 2] > polyDataExtent[axis * 2 + 1] for axis in range(3)):
+    return None
+  return tuple(polyDataExtent)
+
+def rasterizePolyData(polyData, imageData, numberOfThreads=None, progressCallback=None):
+  """Rasterize a closed surface on the voxel grid of the image, slab by slab.
+
+  Only the voxels within the bounding box of the surface are rasterized, therefore the extent of the returned
+  stencil may be smaller than the image extent (it is empty if the surface is outside the image).
+  Voxels outside the stencil extent are outside the surface.
+
+  :param polyData: closed surface, in the image point coordinate system
+  Returns a vtkImageStencilData that is non-zero inside the surface.
+  """
+  stencilExtent = getPolyDataExtent(polyData, imageData)
+  if stencilExtent is None:
+    stencil = vtk.vtkImageStencilData()
+    stencil.SetSpacing(imageData.GetSpacing())
+    stencil.SetOrigin(imageData.GetOrigin())
+    stencil.SetExtent(0, -1, 0, -1, 0, -1)
+    stencil.AllocateExtents()
+    if progressCallback:
+      progressCallback(1.0)
+    return stencil
+
+  def rasterizeSlab(slabExtent):
+    # Each thread uses its own polydata object, as some polydata methods build cached data structures
+    slabPolyData = vtk.vtkPolyData()
+    slabPolyData.ShallowCopy(polyData)
+    polyToStencil = vtk.vtkPolyDataToImageStencil()
+    polyToStencil.SetInputData(slabPolyData)
+    polyToStencil.SetOutputSpacing(imageData.GetSpacing())
+    polyToStencil.SetOutputOrigin(imageData.GetOrigin())
+    polyToStencil.SetOutputWholeExtent(slabExtent)
+    polyToStencil.Update()
+    return polyToStencil.GetOutput()
+
+  slabStencils = processSlabs(rasterizeSlab, stencilExtent, numberOfThreads, progressCallback=progressCallback)
+  if len(slabStencils) == 1:
+    return slabStencils[0]
+  # Merge slab stencils (only the run-length encoded extents are copied, which is fast)
+  stencil = vtk.vtkImageStencilData()
+  stencil.SetSpacing(imageData.GetSpacing())
+  stencil.SetOrigin(imageData.GetOrigin())
+  stencil.SetExtent(stencilExtent)
+  stencil.AllocateExtents()
+  for slabStencil in slabStencils:
+    stencil.Add(slabStencil)
+  return stencil
+
+def applyStencil(inputVoxels, stencil, extent, clipOutside, fillOutsideValue, clipInside, fillInsideValue, numberOfThreads=None,
+  outputVoxels=None, progressCallback=None):
+  """Returns a voxel array where voxels are filled inside and/or outside the stencil, processed slab by slab.
+
+  :param inputVoxels: numpy array indexed as [k, j, i] (optionally with an additional component axis)
+  :param stencil: vtkImageStencilData, non-zero inside the clipping shape
+  :param extent: voxel extent corresponding to the array
+  :param fillOutsideValue, fillInsideValue: fill values (already cast to the voxel type)
+  :param outputVoxels: array where the result is written, a new array is created if not specified.
+    If it is the input array then voxels are filled in place (only voxels that are filled are written).
+  """
+  inPlace = outputVoxels is inputVoxels
+  if outputVoxels is None:
+    outputVoxels = np.empty_like(inputVoxels)
+  stencilExtent = stencil.GetExtent()
+  def applyStencilToSlab(slabExtent):
+    kSlice = slice(slabExtent[4] - extent[4], slabExtent[5] - extent[4] + 1)
+    slabInputVoxels = inputVoxels[kSlice]
+    slabOutputVoxels = outputVoxels[kSlice]
+    # Voxels outside the stencil extent are all outside the clipping shape, they are filled (or copied) without a mask
+    boxExtent = [max(slabExtent[axis], stencilExtent[axis]) if axis % 2 == 0 else min(slabExtent[axis], stencilExtent[axis])
+      for axis in range(6)]
+    boxSlices = tuple(slice(max(boxExtent[axis * 2] - slabExtent[axis * 2], 0), max(boxExtent[axis * 2 + 1] - slabExtent[axis * 2] + 1, 0))
+      for axis in reversed(range(3)))
+    for outsideIndex in _getOutsideBoxIndices(boxSlices):
+      if clipOutside:
+        slabOutputVoxels[outsideIndex] = fillOutsideValue
+      elif not inPlace:
+        slabOutputVoxels[outsideIndex] = slabInputVoxels[outsideIndex]
+    if any(boxSlice.start >= boxSlice.stop for boxSlice in boxSlices):
+      return
+    insideMask = getStencilMask(stencil, boxExtent)
+    if inPlace:
+      fillMask(slabOutputVoxels[boxSlices], insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue)
+    else:
+      applyMask(slabInputVoxels[boxSlices], insideMask, clipOutside, fillOutsideValue, clipInside, fillInsideValue,
+        slabOutputVoxels[boxSlices])
+  processSlabs(applyStencilToSlab, extent, numberOfThreads, progressCallback=progressCallback)
+  return outputVoxels
+
+def _getOutsideBoxIndices(boxSlices):
+  """Returns indices (tuples of slices) that together cover all voxels outside the box (kSlice, jSlice, iSlice)"""
+  kSlice, jSlice, iSlice = boxSlices
+  if kSlice.start >= kSlice.stop or jSlice.start >= jSlice.stop or iSlice.start >= iSlice.stop:
+    # empty box, all voxels are outside
+    return [(slice(None),)]
+  return [(slice(0, kSlice.start),), (slice(kSlice.stop, None),),
+    (kSlice, slice(0, jSlice.start)), (kSlice, slice(jSlice.stop, None)),
+    (kSlice, jSlice, slice(0, iSlice.start)), (kSlice, jSlice, slice(iSlice.stop, None))]
+
+def clipBox(inputVoxels, ijkToBox, boxBounds, fillValue, fillOutside, extent, numberOfThreads=None, outputVoxels=None,
+  progressCallback=None):
+  """Returns a voxel array where voxels inside or outside the box are filled, processed slab by slab.
+
+  See fillBox for description of the parameters.
+  :param outputVoxels: array where the result is written, a new array is created if not specified.
+    If it is the input array then voxels are filled in place (only voxels that are filled are written).
+  """
+  if getAxisAlignedBoxSlices(ijkToBox, boxBounds, extent) is None:
+    return fillObliqueBox(inputVoxels, ijkToBox, boxBounds, fillValue, fillOutside, extent, numberOfThreads, outputVoxels,
+      progressCallback)
+  inPlace = outputVoxels is inputVoxels
+  if outputVoxels is None:
+    outputVoxels = np.empty_like(inputVoxels)
+  def clipSlab(slabExtent):
+    kSlice = slice(slabExtent[4] - extent[4], slabExtent[5] - extent[4] + 1)
+    if not inPlace:
+      outputVoxels[kSlice] = inputVoxels[kSlice]
+    fillBox(outputVoxels[kSlice], ijkToBox, boxBounds, fillValue, fillOutside, slabExtent)
+  processSlabs(clipSlab, extent, numberOfThreads, progressCallback=progressCallback)
+  return outputVoxels
@@ -0,0 +1,45 @@
+import vtk
+
+__all__ = ["stencilOperations", "combineStencils"]
+
+#
+# Boolean operations on rasterized shapes
+#
+# Stencils store the inside region of each image row as a list of [start, end] runs, therefore combining them
+# only processes the run end points, without visiting every voxel.
+#
+
+stencilOperations = ["union", "intersection", "difference"]
+
+def _createEmptyStencil(extent, spacing, origin):
+  stencil = vtk.vtkImageStencilData()
+  stencil.SetSpacing(spacing)
+  stencil.SetOrigin(origin)
+  stencil.SetExtent(extent)
+  stencil.AllocateExtents()
+  return stencil
+
+def combineStencils(shapeStencils, extent, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
+  """Combine rasterized shapes with boolean operations.
+
+  :param shapeStencils: list of (operation, vtkImageStencilData) pairs, where operation is one of stencilOperations.
+    Shapes are combined from left to right, starting from an empty region (therefore the first operation
+    is normally "union"). All stencils must be rasterized on the same voxel grid.
+  :param extent, spacing, origin: voxel grid of the output stencil
+  Returns a new vtkImageStencilData, the input stencils are not modified (so they may be shared with a stencil cache).
+  """
+  combinedStencil = _createEmptyStencil(extent, spacing, origin)
+  for operation, shapeStencil in shapeStencils:
+    if operation == "union":
+      combinedStencil.Add(shapeStencil)
+    elif operation == "difference":
+      combinedStencil.Subtract(shapeStencil)
+    elif operation == "intersection":
+      # A and B = A - (A - B)
+      outsideShape = _createEmptyStencil(extent, spacing, origin)
+      outsideShape.Add(combinedStencil)
+      outsideShape.Subtract(shapeStencil)
+      combinedStencil.Subtract(outsideShape)
+    else:
+      raise ValueError("Invalid stencil operation: {0}. Valid operations: {1}".format(operation, ", ".join(stencilOperations)))
+  return combinedStencil
@@ -0,0 +1,108 @@
+import collections
+import threading
+
+__all__ = ["StencilCache", "getMatrixKey", "getImageGeometryKey"]
+
+#
+# StencilCache
+#
+
+class StencilCache(object):
+  """Least recently used cache of rasterized clipping shapes (vtkImageStencilData).
+
+  A stencil only depends on the clipping geometry and on the voxel grid of the image,
+  therefore it can be reused when only fill values or inside/outside options change,
+  or when the same shape is applied to another volume that has the same geometry.
+  Keys are tuples, typically created using getMatrixKey and getImageGeometryKey.
+  Stencils stored in the cache are shared, they must not be modified.
+  The cache can be accessed from multiple threads.
+  """
+
+  def __init__(self, memoryBudgetBytes=256*1024*1024):
+    self.memoryBudgetBytes = memoryBudgetBytes
+    self.memoryUsageBytes = 0
+    # key -> (stencil, size in bytes), most recently used item is the last
+    self.stencils = collections.OrderedDict()
+    self.lock = threading.RLock()
+    self.resetStatistics()
+
+  def setMemoryBudget(self, memoryBudgetBytes):
+    """Set maximum total size of cached stencils. Set to 0 to disable caching."""
+    with self.lock:
+      self.memoryBudgetBytes = memoryBudgetBytes
+      self.evict(0)
+
+  def getMemoryBudget(self):
+    return self.memoryBudgetBytes
+
+  def getMemoryUsage(self):
+    return self.memoryUsageBytes
+
+  def get(self, key):
+    """Returns the stencil stored for this key or None if it is not in the cache."""
+    with self.lock:
+      item = self.stencils.get(key)
+      if item is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.stencils.move_to_end(key)
+      return item[0]
+
+  def add(self, key, stencil):
+    """Store a stencil. Least recently used stencils are removed if the memory budget is exceeded."""
+    # GetActualMemorySize returns size in kibibytes
+    sizeBytes = stencil.GetActualMemorySize() * 1024
+    with self.lock:
+      self.remove(key)
+      if sizeBytes > self.memoryBudgetBytes:
+        # would not fit even into an empty cache
+        return
+      self.evict(sizeBytes)
+      self.stencils[key] = (stencil, sizeBytes)
+      self.memoryUsageBytes += sizeBytes
+
+  def remove(self, key):
+    with self.lock:
+      item = self.stencils.pop(key, None)
+      if item is not None:
+        self.memoryUsageBytes -= item[1]
+
+  def evict(self, requiredBytes):
+    """Remove least recently used stencils until requiredBytes fits into the memory budget."""
+    with self.lock:
+      while self.stencils and self.memoryUsageBytes + requiredBytes > self.memoryBudgetBytes:
+        key, item = self.stencils.popitem(last=False)
+        self.memoryUsageBytes -= item[1]
+        self.evictions += 1
+
+  def clear(self):
+    with self.lock:
+      self.stencils.clear()
+      self.memoryUsageBytes = 0
+
+  def resetStatistics(self):
+    with self.lock:
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+
+  def getStatistics(self):
+    """Returns a dictionary containing hit/miss counters and memory usage."""
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "numberOfStencils": len(self.stencils),
+        "memoryUsageBytes": self.memoryUsageBytes,
+        "memoryBudgetBytes": self.memoryBudgetBytes,
+        }
+
+def getMatrixKey(matrix):
+  """Returns a hashable representation of a vtkMatrix4x4"""
+  return tuple(matrix.GetElement(row, column) for row in range(4) for column in range(4))
+
+def getImageGeometryKey(imageData, ijkToRas):
+  """Returns a hashable representation of the voxel grid of an image (vtkImageData and IJK to RAS vtkMatrix4x4)"""
+  return (tuple(imageData.GetOrigin()), tuple(imageData.GetSpacing()), tuple(imageData.GetExtent()), getMatrixKey(ijkToRas))
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from .ImageFile import openVoxelArray, writeNrrdHeader
+from .VoxelArray import createImageData
+
+__all__ = ["clipImageFile"]
+
+#
+# Out-of-core clipping
+#
+# The input image file is memory-mapped and processed slab by slab (along the K axis), and each processed slab
+# is appended to the output file. Only one slab is held in memory at a time, therefore images that are much larger
+# than the available memory can be clipped.
+#
+
+def clipImageFile(inputImageFileInfo, outputFilePath, fillSlab, maxSlabSizeBytes=64 * 1024 * 1024, progressCallback=None):
+  """Clip an image file slab by slab and write the result into a NRRD file.
+
+  :param inputImageFileInfo: ImageFileInfo that describes the input voxel data
+  :param fillSlab: function(slabVoxels, slabImageData) that fills voxels of a slab in place. slabImageData is a
+    vtkImageData that refers to slabVoxels and its extent is the position of the slab in the whole image.
+    Origin and spacing of slabImageData are (0,0,0) and (1,1,1), geometry is defined by inputImageFileInfo.ijkToRas.
+  :param maxSlabSizeBytes: maximum size of a slab (at least one slice is processed at a time)
+  :param progressCallback: function(fraction) called after each slab. If it raises an exception
+    (such as ClipCancelledError) then processing stops and the incomplete output file is removed.
+
+  Voxels are written in native byte order. If the input file specifies intensity scaling then voxel
+  values are converted to intensity values (floating-point) before clipping.
+  Returns the number of processed slabs.
+  """
+  inputVoxels = openVoxelArray(inputImageFileInfo)
+  outputDtype = inputImageFileInfo.dtype.newbyteorder("=")
+  if inputImageFileInfo.hasValueScaling():
+    outputDtype = np.dtype(np.float64 if outputDtype == np.float64 else np.float32)
+  numberOfSlices = inputVoxels.shape[0]
+  sliceSizeBytes = inputVoxels[0].size * outputDtype.itemsize
+  slabThickness = max(1, min(numberOfSlices, maxSlabSizeBytes // max(sliceSizeBytes, 1)))
+  extent = inputImageFileInfo.getExtent()
+
+  numberOfSlabs = 0
+  try:
+    with open(outputFilePath, "wb") as outputFile:
+      writeNrrdHeader(outputFile, inputVoxels.shape, outputDtype, inputImageFileInfo.ijkToRas)
+      for kStart in range(0, numberOfSlices, slabThickness):
+        kStop = min(kStart + slabThickness, numberOfSlices)
+        slabVoxels = inputVoxels[kStart:kStop].astype(outputDtype)
+        if inputImageFileInfo.hasValueScaling():
+          slabVoxels *= inputImageFileInfo.scaleSlope
+          slabVoxels += inputImageFileInfo.scaleIntercept
+        slabImageData = createImageData(slabVoxels)
+        slabImageData.SetExtent(extent[0], extent[1], extent[2], extent[3], kStart, kStop - 1)
+        fillSlab(slabVoxels, slabImageData)
+        slabVoxels.tofile(outputFile)
+        numberOfSlabs += 1
+        if progressCallback:
+          progressCallback(float(kStop) / numberOfSlices)
+  except:
+    # Do not leave an incomplete output file behind
+    if os.path.exists(outputFilePath):
+      os.remove(outputFilePath)
+    raise
+  finally:
+    del inputVoxels
+
+  return numberOfSlabs
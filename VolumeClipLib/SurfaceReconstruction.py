@@ -0,0 +1,119 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+__all__ = ["minimumNumberOfReconstructionPoints", "decimatePoints", "getDecimationVoxelSize", "getPointSpacing",
+  "reconstructSurface"]
+
+#
+# Surface reconstruction from dense point clouds
+#
+# vtkSurfaceReconstructionFilter can create concave surfaces from points that densely sample the surface
+# (for example, acquired by a surface scanner or a tracked stylus), but its computation time grows faster than
+# linearly with the number of points and with the number of samples of the signed distance grid. Therefore
+# the points are decimated on a voxel grid to a bounded number of points (that still evenly cover the surface),
+# and the sample spacing is chosen from the density of the decimated points, with a bounded grid size.
+#
+
+# Surface reconstruction is unreliable if there are fewer points
+minimumNumberOfReconstructionPoints = 10
+
+def _getCellKeys(points, origin, voxelSize):
+  """Returns an integer key for each point that identifies the voxel grid cell that contains the point"""
+  cellIndices = ((points - origin) / voxelSize).astype(np.int64)
+  dimensions = cellIndices.max(axis=0) + 1
+  if np.prod(dimensions.astype(np.float64)) >= 2.0 ** 62:
+    # Keys would overflow, use row index of the unique cells instead
+    return np.unique(cellIndices, axis=0, return_inverse=True)[1].ravel()
+  return (cellIndices[:, 2] * dimensions[1] + cellIndices[:, 1]) * dimensions[0] + cellIndices[:, 0]
+
+def decimatePoints(points, voxelSize):
+  """Returns the centroid of the points in each occupied cell of a voxel grid (N x 3 array)"""
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  if len(points) == 0:
+    return points
+  cellKeys = _getCellKeys(points, points.min(axis=0), voxelSize)
+  cellIndices, pointCounts = np.unique(cellKeys, return_inverse=True, return_counts=True)[1:]
+  cellIndices = cellIndices.ravel()
+  centroids = np.empty((len(pointCounts), 3))
+  for axis in range(3):
+    centroids[:, axis] = np.bincount(cellIndices, weights=points[:, axis], minlength=len(pointCounts)) / pointCounts
+  return centroids
+
+def getDecimationVoxelSize(points, maxNumberOfPoints, numberOfSamples=100000):
+  """Returns voxel size of decimatePoints that reduces the points to at most (approximately) maxNumberOfPoints.
+
+  The number of occupied cells is counted on a random subset of the points, which is accurate as long as
+  there are many sample points in each cell.
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  if len(points) > numberOfSamples:
+    points = points[np.random.RandomState(0).choice(len(points), numberOfSamples, replace=False)]
+  origin = points.min(axis=0)
+  # Start from cells that are smaller than needed for points on a surface and grow them until the number
+  # of occupied cells is small enough (cell count of a surface is inversely proportional to the cell area)
+  voxelSize = max(0.25 * np.linalg.norm(points.max(axis=0) - origin) / np.sqrt(maxNumberOfPoints), 1e-6)
+  for iteration in range(20):
+    numberOfCells = len(np.unique(_getCellKeys(points, origin, voxelSize)))
+    if numberOfCells <= maxNumberOfPoints:
+      break
+    voxelSize *= 1.05 * np.sqrt(float(numberOfCells) / maxNumberOfPoints)
+  return voxelSize
+
+def getPointSpacing(points, numberOfNeighbors=4, numberOfSamples=200):
+  """Returns typical distance between neighbor points: median distance of a random subset of points
+  from their numberOfNeighbors-th nearest neighbor."""
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  numberOfNeighbors = min(numberOfNeighbors, len(points) - 1)
+  if numberOfNeighbors < 1:
+    return 0.0
+  samples = points[np.random.RandomState(0).choice(len(points), min(numberOfSamples, len(points)), replace=False)]
+  neighborDistances = []
+  # Distances are computed in chunks to limit memory usage
+  for sampleChunk in np.array_split(samples, max(1, len(samples) // 50)):
+    squaredDistances = ((sampleChunk[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2).sum(axis=2)
+    # Nearest point (distance 0) is the sample point itself
+    neighborDistances.append(np.sqrt(np.partition(squaredDistances, numberOfNeighbors, axis=1)[:, numberOfNeighbors]))
+  return float(np.median(np.concatenate(neighborDistances)))
+
+def reconstructSurface(points, maxNumberOfPoints=5000, maxGridSize=128, neighborhoodSize=20, sampleSpacing=None):
+  """Returns closed surface (vtkPolyData) reconstructed from points that densely sample it.
+
+  :param points: N x 3 array
+  :param maxNumberOfPoints: points are decimated to about this many points before reconstruction
+  :param maxGridSize: maximum number of samples of the signed distance grid along each axis
+  :param neighborhoodSize: number of neighbor points used for estimating the local tangent plane
+  :param sampleSpacing: spacing of the signed distance grid, computed from the point density by default
+  Computation time is bounded by maxNumberOfPoints and maxGridSize, regardless of the number of input points.
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+  if len(points) > maxNumberOfPoints:
+    points = decimatePoints(points, getDecimationVoxelSize(points, maxNumberOfPoints))
+  if sampleSpacing is None:
+    sampleSpacing = getPointSpacing(points)
+  size = points.max(axis=0) - points.min(axis=0)
+  sampleSpacing = max(sampleSpacing, size.max() / maxGridSize, 1e-6)
+
+  vtkPoints = vtk.vtkPoints()
+  vtkPoints.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+  pointPolyData = vtk.vtkPolyData()
+  pointPolyData.SetPoints(vtkPoints)
+
+  surf = vtk.vtkSurfaceReconstructionFilter()
+  surf.SetInputData(pointPolyData)
+  surf.SetNeighborhoodSize(min(neighborhoodSize, len(points) - 1))
+  surf.SetSampleSpacing(sampleSpacing)
+
+  cf = vtk.vtkContourFilter()
+  cf.SetInputConnection(surf.GetOutputPort())
+  cf.SetValue(0, 0.0)
+
+  # Sometimes the contouring algorithm can create a volume whose gradient
+  # vector and ordering of polygon (using the right hand rule) are
+  # inconsistent. vtkReverseSense cures this problem.
+  reverse = vtk.vtkReverseSense()
+  reverse.SetInputConnection(cf.GetOutputPort())
+  reverse.ReverseCellsOff()
+  reverse.ReverseNormalsOff()
+  reverse.Update()
+  return reverse.GetOutput()
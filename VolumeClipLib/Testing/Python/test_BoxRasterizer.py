@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+def createRandomBox(randomState, extent, oblique=True):
+  """Returns box bounds and a random IJK to box transform (4x4 numpy array) of a box that intersects the extent"""
+  boxToIjk = vtk.vtkTransform()
+  boxToIjk.Translate([randomState.uniform(extent[axis * 2], extent[axis * 2 + 1]) for axis in range(3)])
+  if oblique:
+    boxToIjk.RotateWXYZ(randomState.uniform(0, 360), randomState.uniform(-1, 1, 3))
+  boxToIjk.Scale(randomState.uniform(0.5, 2.0, 3))
+  halfSizes = randomState.uniform(2, 12, 3)
+  boxBounds = [-halfSizes[0], halfSizes[0], -halfSizes[1], halfSizes[1], -halfSizes[2], halfSizes[2]]
+  return boxBounds, np.linalg.inv(VolumeClipLib.getNumpyMatrix(boxToIjk.GetMatrix()))
+
+def getImplicitBoxMask(ijkToBox, boxBounds, extent):
+  """Rasterize the box by evaluating a vtkBox implicit function at each voxel"""
+  box = vtk.vtkBox()
+  box.SetBounds(boxBounds)
+  ijkToBoxTransform = vtk.vtkTransform()
+  ijkToBoxTransform.SetMatrix(VolumeClipLib.getVtkMatrix(ijkToBox))
+  box.SetTransform(ijkToBoxTransform)
+  functionToStencil = vtk.vtkImplicitFunctionToImageStencil()
+  functionToStencil.SetInput(box)
+  functionToStencil.SetOutputOrigin(0, 0, 0)
+  functionToStencil.SetOutputSpacing(1, 1, 1)
+  functionToStencil.SetOutputWholeExtent(extent)
+  functionToStencil.Update()
+  return VolumeClipLib.getStencilMask(functionToStencil.GetOutput(), extent)
+
+class BoxRasterizerTest(unittest.TestCase):
+
+  extent = (2, 31, -3, 20, 5, 22)
+
+  def setUp(self):
+    self.randomState = np.random.RandomState(0)
+    shape = (self.extent[5] - self.extent[4] + 1, self.extent[3] - self.extent[2] + 1, self.extent[1] - self.extent[0] + 1)
+    self.voxels = np.arange(np.prod(shape), dtype=np.int16).reshape(shape)
+
+  def test_BoxMask(self):
+    """Analytic rasterization must give the same mask as evaluating vtkBox at each voxel"""
+    for boxIndex in range(30):
+      boxBounds, ijkToBox = createRandomBox(self.randomState, self.extent, oblique=(boxIndex % 5 != 0))
+      expectedMask = getImplicitBoxMask(ijkToBox, boxBounds, self.extent)
+      self.assertTrue(np.array_equal(VolumeClipLib.getBoxMask(ijkToBox, boxBounds, self.extent), expectedMask), "box {0}".format(boxIndex))
+
+  def test_FillBox(self):
+    """Filling inside or outside the box must only change the voxels inside or outside the box mask"""
+    for boxIndex in range(10):
+      boxBounds, ijkToBox = createRandomBox(self.randomState, self.extent, oblique=(boxIndex % 5 != 0))
+      mask = VolumeClipLib.getBoxMask(ijkToBox, boxBounds, self.extent)
+      for fillOutside in [True, False]:
+        voxels = self.voxels.copy()
+        VolumeClipLib.fillBox(voxels, ijkToBox, boxBounds, -7, fillOutside, self.extent)
+        expectedVoxels = np.where(mask != fillOutside, np.int16(-7), self.voxels)
+        self.assertTrue(np.array_equal(voxels, expectedVoxels), "box {0}".format(boxIndex))
+
+  def test_UpdateBoxClip(self):
+    """Updating a clipped array after the box is changed must give the same result as clipping with the new box"""
+    for boxIndex in range(10):
+      oldBoxBounds, oldIjkToBox = createRandomBox(self.randomState, self.extent)
+      newBoxBounds, newIjkToBox = createRandomBox(self.randomState, self.extent)
+      for fillOutside in [True, False]:
+        voxels = self.voxels.copy()
+        VolumeClipLib.fillBox(voxels, oldIjkToBox, oldBoxBounds, -7, fillOutside, self.extent)
+        VolumeClipLib.updateBoxClip(voxels, self.voxels, VolumeClipLib.getBoxRowSpans(oldIjkToBox, oldBoxBounds, self.extent),
+          VolumeClipLib.getBoxRowSpans(newIjkToBox, newBoxBounds, self.extent), -7, fillOutside)
+        expectedVoxels = self.voxels.copy()
+        VolumeClipLib.fillBox(expectedVoxels, newIjkToBox, newBoxBounds, -7, fillOutside, self.extent)
+        self.assertTrue(np.array_equal(voxels, expectedVoxels), "box {0}".format(boxIndex))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+from VolumeClipLib import ConvexHull
+
+def getFacetSet(hull):
+  """Returns facets of the hull as a set of triangles of point positions, each rotated to start with its smallest position.
+  Positions are used instead of point indices, because indices change when points are inserted or removed."""
+  facets = set()
+  for triangle in hull.getTriangles():
+    positions = [hull.points[index] for index in triangle]
+    rotation = positions.index(min(positions))
+    facets.add(tuple(positions[rotation:] + positions[:rotation]))
+  return facets
+
+class ConvexHullTest(unittest.TestCase):
+
+  def test_RandomEdits(self):
+    """Hull updated by random edits must have the same facets as the hull computed from the final point list"""
+    randomGenerator = random.Random(0)
+    def randomPoint():
+      return tuple(randomGenerator.uniform(-50, 50) for axis in range(3))
+    hull = ConvexHull()
+    points = []
+    for editIndex in range(300):
+      points = list(points)
+      edit = randomGenerator.choice(["add", "insert", "move", "remove"]) if len(points) > 6 else "add"
+      if edit == "add":
+        points.append(randomPoint())
+      elif edit == "insert":
+        points.insert(randomGenerator.randrange(len(points)), randomPoint())
+      elif edit == "move":
+        points[randomGenerator.randrange(len(points))] = randomPoint()
+      else:
+        del points[randomGenerator.randrange(len(points))]
+      facetsBefore = getFacetSet(hull)
+      hullChanged = hull.update(points)
+
+      referenceHull = ConvexHull()
+      referenceHull.setPoints(points)
+      self.assertEqual(hull.isValid(), referenceHull.isValid())
+      self.assertEqual(getFacetSet(hull), getFacetSet(referenceHull), "edit {0} ({1})".format(editIndex, edit))
+      if not hullChanged:
+        self.assertEqual(getFacetSet(hull), facetsBefore, "edit {0} ({1})".format(editIndex, edit))
+
+  def test_MoveInteriorPoint(self):
+    """Moving a point that stays inside the hull must not change the hull"""
+    points = [(0, 0, 0), (10, 0, 0), (0, 10, 0), (0, 0, 10), (10, 10, 10), (3, 3, 3)]
+    hull = ConvexHull()
+    hull.setPoints(points)
+    facets = getFacetSet(hull)
+    self.assertFalse(hull.isHullVertex(5))
+
+    points[5] = (4, 2, 3)
+    self.assertFalse(hull.update(points))
+    self.assertEqual(getFacetSet(hull), facets)
+
+    # Moving it outside changes the hull
+    points[5] = (-5, -5, -5)
+    self.assertTrue(hull.update(points))
+    self.assertTrue(hull.isHullVertex(5))
+
+if __name__ == "__main__":
+  unittest.main()
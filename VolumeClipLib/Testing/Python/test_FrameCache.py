@@ -0,0 +1,110 @@
+import os
+import sys
+import threading
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+class FrameCacheTest(unittest.TestCase):
+
+  frameSizeBytes = 200
+
+  def setUp(self):
+    self.clippedFrameIndices = []
+    self.clippedFrameIndicesLock = threading.Lock()
+
+  def clipFrame(self, frameIndex):
+    with self.clippedFrameIndicesLock:
+      self.clippedFrameIndices.append(frameIndex)
+    return np.full(self.frameSizeBytes // 2, frameIndex, dtype=np.int16)
+
+  def waitForPendingFrames(self, frameCache):
+    with frameCache.lock:
+      futures = list(frameCache.pendingFrames.values())
+    for future in futures:
+      if not future.cancelled():
+        future.result()
+
+  def test_PrefetchFrameIndices(self):
+    """Next frames come first, indices wrap around at the end of the sequence and are not repeated"""
+    self.assertEqual(VolumeClipLib.getPrefetchFrameIndices(0, 5, 2), [1, 4, 2, 3])
+    self.assertEqual(VolumeClipLib.getPrefetchFrameIndices(4, 5, 1), [0, 3])
+    self.assertEqual(VolumeClipLib.getPrefetchFrameIndices(0, 2, 2), [1])
+    self.assertEqual(VolumeClipLib.getPrefetchFrameIndices(0, 1, 2), [])
+    self.assertEqual(VolumeClipLib.getPrefetchFrameIndices(3, 10, 0), [])
+
+  def test_Prefetch(self):
+    """Requested frame is clipped on the calling thread, adjacent frames in the background"""
+    frameCache = VolumeClipLib.FrameCache(self.clipFrame, 6, numberOfPrefetchedFrames=1)
+    try:
+      self.assertTrue((frameCache.getFrame(0) == 0).all())
+      self.waitForPendingFrames(frameCache)
+      self.assertEqual(self.clippedFrameIndices, [0, 1, 5])
+      self.assertEqual(sorted(frameCache.frames.keys()), [0, 1, 5])
+
+      # Prefetched frame is not clipped again
+      self.assertTrue((frameCache.getFrame(5) == 5).all())
+      self.waitForPendingFrames(frameCache)
+      self.assertEqual(self.clippedFrameIndices, [0, 1, 5, 4])
+      statistics = frameCache.getStatistics()
+      self.assertEqual(statistics["misses"], 1)
+      self.assertEqual(statistics["hits"] + statistics["prefetchHits"], 1)
+      self.assertEqual(statistics["numberOfFrames"], 4)
+      self.assertEqual(statistics["memoryUsageBytes"], 4 * self.frameSizeBytes)
+    finally:
+      frameCache.shutdown()
+    self.assertEqual(frameCache.getStatistics()["numberOfFrames"], 0)
+    self.assertEqual(frameCache.getMemoryUsage(), 0)
+
+  def test_Eviction(self):
+    """Least recently used frames are removed when the memory budget is exceeded"""
+    frameCache = VolumeClipLib.FrameCache(self.clipFrame, 5, memoryBudgetBytes=2 * self.frameSizeBytes, numberOfPrefetchedFrames=0)
+    for frameIndex in [0, 1, 0, 2]:
+      frameCache.getFrame(frameIndex)
+    # Frame 1 was used least recently
+    self.assertEqual(list(frameCache.frames.keys()), [0, 2])
+    statistics = frameCache.getStatistics()
+    self.assertEqual((statistics["hits"], statistics["misses"], statistics["evictions"]), (1, 3, 1))
+    self.assertEqual(statistics["memoryUsageBytes"], 2 * self.frameSizeBytes)
+    frameCache.getFrame(1)
+    self.assertEqual(self.clippedFrameIndices, [0, 1, 2, 1])
+
+    # Frames are not stored if caching is disabled
+    frameCache.setMemoryBudget(0)
+    self.assertEqual(frameCache.getMemoryUsage(), 0)
+    self.assertTrue((frameCache.getFrame(3) == 3).all())
+    self.assertEqual(len(frameCache.frames), 0)
+    frameCache.shutdown()
+
+  def test_CancelStalePrefetch(self):
+    """Scheduled frames that are not adjacent to the requested frame anymore are not clipped"""
+    frameStarted = threading.Event()
+    releaseFrame = threading.Event()
+    def clipFrame(frameIndex):
+      if frameIndex == 1:
+        # Keep the background thread busy, so that the other prefetched frame stays scheduled
+        frameStarted.set()
+        releaseFrame.wait(10)
+      return self.clipFrame(frameIndex)
+
+    frameCache = VolumeClipLib.FrameCache(clipFrame, 10, numberOfPrefetchedFrames=1)
+    try:
+      frameCache.getFrame(0)
+      self.assertTrue(frameStarted.wait(10))
+      frameCache.getFrame(5)
+      with frameCache.lock:
+        # Frame 1 is being clipped, it cannot be cancelled. Frame 9 is not adjacent anymore, it is cancelled.
+        self.assertEqual(sorted(frameCache.pendingFrames.keys()), [1, 4, 6])
+      releaseFrame.set()
+      self.waitForPendingFrames(frameCache)
+    finally:
+      releaseFrame.set()
+      frameCache.shutdown()
+    self.assertNotIn(9, self.clippedFrameIndices)
+    self.assertEqual(sorted(self.clippedFrameIndices), [0, 1, 4, 5, 6])
+
+if __name__ == "__main__":
+  unittest.main()
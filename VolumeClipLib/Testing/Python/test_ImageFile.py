@@ -0,0 +1,76 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+class ImageFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def writeNrrdFile(self, headerLines, voxels):
+    """Write a NRRD file with the specified header fields (after the magic line) and attached raw voxel data"""
+    filePath = os.path.join(self.tempDir, "image.nrrd")
+    with open(filePath, "wb") as imageFile:
+      imageFile.write(("\n".join(["NRRD0004"] + headerLines) + "\n\n").encode("ascii"))
+      imageFile.write(np.ascontiguousarray(voxels, dtype="<i2").tobytes())
+    return filePath
+
+  def test_NrrdRoundTrip(self):
+    """Header written by writeNrrdHeader must be read back with the same voxel layout and geometry"""
+    ijkToRas = np.array([[-0.8, 0.1, 0.0, 10.0], [0.0, -0.9, 0.2, 12.0], [0.05, 0.0, 1.5, -15.0], [0.0, 0.0, 0.0, 1.0]])
+    randomState = np.random.RandomState(0)
+    for voxels in [
+      np.arange(4*5*6, dtype="<i2").reshape(4, 5, 6),
+      randomState.uniform(-100, 100, (4, 5, 6)).astype(">f4"),
+      randomState.randint(0, 255, (4, 5, 6, 3)).astype(np.uint8)]:
+      filePath = os.path.join(self.tempDir, "image.nrrd")
+      with open(filePath, "wb") as imageFile:
+        VolumeClipLib.writeNrrdHeader(imageFile, voxels.shape, voxels.dtype, ijkToRas)
+        imageFile.write(voxels.tobytes())
+      imageFileInfo = VolumeClipLib.readImageFileInfo(filePath)
+      self.assertEqual(imageFileInfo.shape, voxels.shape)
+      self.assertEqual(imageFileInfo.dtype, voxels.dtype)
+      self.assertTrue(np.allclose(imageFileInfo.ijkToRas, ijkToRas))
+      self.assertEqual(imageFileInfo.getExtent(), (0, 5, 0, 4, 0, 3))
+      readVoxels = VolumeClipLib.openVoxelArray(imageFileInfo)
+      self.assertTrue(np.array_equal(readVoxels, voxels))
+      del readVoxels
+
+  def test_AxisKinds(self):
+    """4-axis NRRD files are only accepted if the first axis is the voxel component axis"""
+    voxels = np.zeros((4, 5, 6, 3), dtype=np.int16)
+    directions = "(1,0,0) (0,1,0) (0,0,1)"
+    componentsFirst = self.writeNrrdFile(["type: short", "dimension: 4", "sizes: 3 6 5 4", "encoding: raw",
+      "space: left-posterior-superior", "space directions: none " + directions, "kinds: vector domain domain domain"], voxels)
+    self.assertEqual(VolumeClipLib.readImageFileInfo(componentsFirst).shape, (4, 5, 6, 3))
+    componentsFirstNoKinds = self.writeNrrdFile(["type: short", "dimension: 4", "sizes: 3 6 5 4", "encoding: raw",
+      "space: left-posterior-superior", "space directions: none " + directions], voxels)
+    self.assertEqual(VolumeClipLib.readImageFileInfo(componentsFirstNoKinds).shape, (4, 5, 6, 3))
+
+    # Time series along the last axis
+    timeLast = self.writeNrrdFile(["type: short", "dimension: 4", "sizes: 6 5 4 3", "encoding: raw",
+      "kinds: domain domain domain time"], voxels)
+    with self.assertRaises(ValueError):
+      VolumeClipLib.readImageFileInfo(timeLast)
+    # Layout of the axes is not known
+    unknownKinds = self.writeNrrdFile(["type: short", "dimension: 4", "sizes: 3 6 5 4", "encoding: raw"], voxels)
+    with self.assertRaises(ValueError):
+      VolumeClipLib.readImageFileInfo(unknownKinds)
+    # 2D vector image
+    vector2D = self.writeNrrdFile(["type: short", "dimension: 3", "sizes: 3 6 20", "encoding: raw",
+      "kinds: vector domain domain"], voxels)
+    with self.assertRaises(ValueError):
+      VolumeClipLib.readImageFileInfo(vector2D)
+
+if __name__ == "__main__":
+  unittest.main()
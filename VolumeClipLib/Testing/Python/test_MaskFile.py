@@ -0,0 +1,41 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+class MaskFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def test_RoundTrip(self):
+    """Mask packed slab by slab and written to a file must be read back unchanged, with its voxel grid"""
+    # Row length is not a multiple of 8, so that partially used bytes are tested
+    extent = (3, 31, -2, 20, 4, 18)
+    mask = np.random.RandomState(0).uniform(size=(15, 23, 29)) > 0.5
+    ijkToRas = np.array([[-0.8, 0.1, 0.0, 10.0], [0.0, -0.9, 0.2, 12.0], [0.0, 0.0, 1.5, -15.0], [0.0, 0.0, 0.0, 1.0]])
+    def getSlabMask(slabExtent):
+      return mask[slabExtent[4] - extent[4]:slabExtent[5] - extent[4] + 1]
+    # Small slabs to test packing of multiple slabs
+    packedMask = VolumeClipLib.packMask(getSlabMask, extent, maxSlabSizeBytes=23*29*4)
+    self.assertEqual(packedMask.shape, (15, 23, 4))
+    maskFilePath = os.path.join(self.tempDir, "mask.npz")
+    VolumeClipLib.writeMaskFile(maskFilePath, packedMask, extent, ijkToRas)
+
+    readMask, readExtent, readIjkToRas = VolumeClipLib.readMaskFile(maskFilePath)
+    self.assertEqual(readMask.dtype, np.dtype(bool))
+    self.assertTrue(np.array_equal(readMask, mask))
+    self.assertEqual(readExtent, extent)
+    self.assertTrue(np.array_equal(readIjkToRas, ijkToRas))
+
+if __name__ == "__main__":
+  unittest.main()
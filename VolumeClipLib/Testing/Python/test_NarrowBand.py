@@ -0,0 +1,107 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+narrowBandModule = sys.modules["VolumeClipLib.NarrowBand"]
+
+class NarrowBandTest(unittest.TestCase):
+
+  shape = (40, 50, 60)
+  spacing = (0.8, 0.9, 1.5)
+  origin = (-20.0, -30.0, 10.0)
+  center = np.array([3.0, -8.0, 40.0])
+  radius = 18.0
+
+  def setUp(self):
+    self.ijkToRas = np.diag(list(self.spacing) + [1.0])
+    self.ijkToRas[:3, 3] = self.origin
+    self.extent = (0, self.shape[2] - 1, 0, self.shape[1] - 1, 0, self.shape[0] - 1)
+    self.vertices, self.faces = self.createSphereSurface(self.center, self.radius)
+    # Signed distance of voxel centers from the sphere (negative inside)
+    k, j, i = np.mgrid[0:self.shape[0], 0:self.shape[1], 0:self.shape[2]]
+    positions = np.stack([i * self.spacing[0] + self.origin[0], j * self.spacing[1] + self.origin[1],
+      k * self.spacing[2] + self.origin[2]], axis=-1)
+    self.sphereDistances = np.linalg.norm(positions - self.center, axis=-1) - self.radius
+    # Distances are computed from the rasterized surface, which is accurate to about half a voxel
+    self.halfVoxel = 0.5 * max(self.spacing)
+
+  def createSphereSurface(self, center, radius, resolution=120):
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(center)
+    sphere.SetRadius(radius)
+    sphere.SetPhiResolution(resolution)
+    sphere.SetThetaResolution(resolution)
+    sphere.Update()
+    return VolumeClipLib.getSurfaceArrays(sphere.GetOutput())
+
+  def test_SignedDistances(self):
+    """Signed distance from the rasterized surface is close to the analytic distance within the requested range"""
+    stencil = VolumeClipLib.rasterizeSurface(self.vertices, self.faces, self.ijkToRas, self.extent)
+    signedDistances = VolumeClipLib.getSignedDistances(stencil, self.extent, self.extent, self.spacing, -3.0, 3.0)
+    self.assertEqual(signedDistances.shape, self.shape)
+
+    band = np.abs(self.sphereDistances) <= 3.0
+    errors = np.abs(signedDistances - self.sphereDistances)[band]
+    self.assertLessEqual(errors.max(), 2 * self.halfVoxel)
+    self.assertLess(errors.mean(), 0.5 * self.halfVoxel)
+    # Sign only differs next to the surface
+    signDiffers = (signedDistances > 0) != (self.sphereDistances > 0)
+    self.assertFalse(signDiffers[np.abs(self.sphereDistances) > 2 * self.halfVoxel].any())
+    # Voxels further from the surface are only guaranteed to be outside the requested range
+    self.assertTrue((signedDistances[self.sphereDistances > 3.0 + 2 * self.halfVoxel] > 3.0).all())
+    self.assertTrue((signedDistances[self.sphereDistances < -3.0 - 2 * self.halfVoxel] < -3.0).all())
+
+    # Distance within the requested range is the same when computed for a region of the image
+    regionExtent = (10, 29, 5, 40, 20, 35)
+    regionDistances = VolumeClipLib.getSignedDistances(stencil, regionExtent, self.extent, self.spacing, -3.0, 3.0)
+    imageDistances = signedDistances[20:36, 5:41, 10:30]
+    inRange = np.abs(imageDistances) <= 3.0
+    self.assertTrue(inRange.any())
+    self.assertTrue(np.array_equal(regionDistances[inRange], imageDistances[inRange]))
+
+  def test_Margin(self):
+    """Voxels are filled outside the grown or shrunk sphere, mismatches are only next to the grown surface"""
+    inputVoxels = np.ones(self.shape, dtype=np.int16)
+    for margin in [-3.0, 3.0]:
+      outputVoxels = VolumeClipLib.clipVoxelsWithSurface(inputVoxels, self.ijkToRas, self.vertices, self.faces,
+        True, 0, False, 0, margin=margin)
+      mismatches = (outputVoxels == 1) != (self.sphereDistances <= margin)
+      self.assertLessEqual(np.abs(self.sphereDistances[mismatches] - margin).max(initial=0.0), self.halfVoxel)
+
+  def test_Feather(self):
+    """Blended voxel values follow the analytic inside weight"""
+    inputVoxels = np.ones(self.shape, dtype=np.float32)
+    margin = 2.0
+    featherWidth = 6.0
+    outputVoxels = VolumeClipLib.clipVoxelsWithSurface(inputVoxels, self.ijkToRas, self.vertices, self.faces,
+      True, 0, False, 0, margin=margin, featherWidth=featherWidth)
+    expectedWeights = VolumeClipLib.getInsideWeights(self.sphereDistances, margin, featherWidth)
+    self.assertLessEqual(np.abs(outputVoxels - expectedWeights).max(), 2 * self.halfVoxel / featherWidth)
+    self.assertTrue(((outputVoxels > 0) & (outputVoxels < 1)).any())
+
+  def test_BandSize(self):
+    """Distance is only computed near the surface, the same number of voxels regardless of the volume size"""
+    vertices, faces = self.createSphereSurface([20.0, 20.0, 20.0], 10.0, 30)
+    numbersOfDistanceVoxels = []
+    for size in [96, 192]:
+      inputVoxels = np.zeros((size, size, size), dtype=np.int16)
+      with mock.patch.object(narrowBandModule, "getSignedDistances", wraps=narrowBandModule.getSignedDistances) as getSignedDistances:
+        VolumeClipLib.clipVoxelsWithSurface(inputVoxels, np.eye(4), vertices, faces, True, 0, False, 0, margin=3.0)
+      numberOfDistanceVoxels = 0
+      for call in getSignedDistances.call_args_list:
+        regionExtent = call[0][1]
+        numberOfDistanceVoxels += np.prod([regionExtent[axis * 2 + 1] - regionExtent[axis * 2] + 1 for axis in range(3)])
+      numbersOfDistanceVoxels.append(numberOfDistanceVoxels)
+    self.assertGreater(numbersOfDistanceVoxels[0], 0)
+    self.assertLess(numbersOfDistanceVoxels[0], 96 ** 3 / 2)
+    self.assertEqual(numbersOfDistanceVoxels[0], numbersOfDistanceVoxels[1])
+
+if __name__ == "__main__":
+  unittest.main()
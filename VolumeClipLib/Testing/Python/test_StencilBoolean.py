@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+
+class StencilBooleanTest(unittest.TestCase):
+
+  extent = (0, 29, -2, 21, 3, 20)
+  spacing = (0.8, 0.9, 1.5)
+  origin = (-10.0, 5.0, 2.0)
+
+  def createSphereStencil(self, randomState):
+    """Returns stencil of a random sphere that intersects the voxel grid"""
+    sphere = vtk.vtkSphere()
+    sphere.SetCenter([self.origin[axis] + self.spacing[axis] * randomState.uniform(self.extent[axis * 2], self.extent[axis * 2 + 1])
+      for axis in range(3)])
+    sphere.SetRadius(randomState.uniform(3, 12))
+    functionToStencil = vtk.vtkImplicitFunctionToImageStencil()
+    functionToStencil.SetInput(sphere)
+    functionToStencil.SetOutputOrigin(self.origin)
+    functionToStencil.SetOutputSpacing(self.spacing)
+    functionToStencil.SetOutputWholeExtent(self.extent)
+    functionToStencil.Update()
+    return functionToStencil.GetOutput()
+
+  def test_CombineStencils(self):
+    """Combined stencil must be the same as combining the masks of the shapes with numpy boolean operations"""
+    randomState = np.random.RandomState(0)
+    maskOperations = {"union": np.logical_or, "intersection": np.logical_and,
+      "difference": lambda mask, shapeMask: mask & ~shapeMask}
+    for combinationIndex in range(20):
+      shapeStencils = [("union", self.createSphereStencil(randomState))]
+      for shapeIndex in range(randomState.randint(1, 5)):
+        shapeStencils.append((VolumeClipLib.stencilOperations[randomState.randint(3)], self.createSphereStencil(randomState)))
+      expectedMask = np.zeros((self.extent[5] - self.extent[4] + 1, self.extent[3] - self.extent[2] + 1,
+        self.extent[1] - self.extent[0] + 1), dtype=bool)
+      for operation, shapeStencil in shapeStencils:
+        expectedMask = maskOperations[operation](expectedMask, VolumeClipLib.getStencilMask(shapeStencil, self.extent))
+      stencilMTimes = [shapeStencil.GetMTime() for operation, shapeStencil in shapeStencils]
+
+      combinedStencil = VolumeClipLib.combineStencils(shapeStencils, self.extent, self.spacing, self.origin)
+      self.assertTrue(np.array_equal(VolumeClipLib.getStencilMask(combinedStencil, self.extent), expectedMask),
+        "combination {0}: {1}".format(combinationIndex, [operation for operation, shapeStencil in shapeStencils]))
+      # Input stencils are not modified
+      self.assertEqual([shapeStencil.GetMTime() for operation, shapeStencil in shapeStencils], stencilMTimes)
+
+  def test_InvalidOperation(self):
+    randomState = np.random.RandomState(0)
+    with self.assertRaises(ValueError):
+      VolumeClipLib.combineStencils([("xor", self.createSphereStencil(randomState))], self.extent, self.spacing, self.origin)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,107 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".."))
+import VolumeClipLib
+from VolumeClipLib import VolumeClipBatch
+
+class VolumeClipBatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tempDir = tempfile.mkdtemp()
+    self.voxels = np.arange(20*25*30, dtype=np.int16).reshape(20, 25, 30)
+    self.ijkToRas = np.array([
+      [-0.8, 0.0, 0.0, 10.0],
+      [0.0, -0.9, 0.0, 12.0],
+      [0.0, 0.0, 1.5, -15.0],
+      [0.0, 0.0, 0.0, 1.0]])
+    with open(os.path.join(self.tempDir, "input.nrrd"), "wb") as inputFile:
+      VolumeClipLib.writeNrrdHeader(inputFile, self.voxels.shape, self.voxels.dtype, self.ijkToRas)
+      inputFile.write(self.voxels.tobytes())
+
+  def tearDown(self):
+    shutil.rmtree(self.tempDir)
+
+  def writeRoiFile(self, fileName, centerLps, orientationLps, size):
+    roi = {"type": "ROI", "coordinateSystem": "LPS", "center": centerLps, "orientation": orientationLps, "size": size}
+    with open(os.path.join(self.tempDir, fileName), "w") as roiFile:
+      json.dump({"markups": [roi]}, roiFile)
+    return os.path.join(self.tempDir, fileName)
+
+  def readOutputVoxels(self, fileName):
+    imageFileInfo = VolumeClipLib.readImageFileInfo(os.path.join(self.tempDir, fileName))
+    self.assertTrue(np.allclose(imageFileInfo.ijkToRas, self.ijkToRas))
+    return np.array(VolumeClipLib.openVoxelArray(imageFileInfo))
+
+  def test_ReadRoiFile(self):
+    """ROI in LPS coordinate system is converted to RAS"""
+    # Box x axis is LPS (0,1,0) (posterior), y axis is LPS (-1,0,0) (right)
+    roiFilePath = self.writeRoiFile("roi.mrk.json", [10, 20, 30], [0, -1, 0, 1, 0, 0, 0, 0, 1], [4, 6, 8])
+    boxBounds, rasToBox = VolumeClipBatch.readRoiFile(roiFilePath)
+    self.assertEqual(list(boxBounds), [-2, 2, -3, 3, -4, 4])
+    boxToRas = np.linalg.inv(rasToBox)
+    self.assertTrue(np.allclose(np.dot(boxToRas, [0, 0, 0, 1]), [-10, -20, 30, 1]))
+    self.assertTrue(np.allclose(np.dot(boxToRas, [1, 0, 0, 0]), [0, -1, 0, 0]))
+    self.assertTrue(np.allclose(np.dot(boxToRas, [0, 1, 0, 0]), [1, 0, 0, 0]))
+
+  def test_Main(self):
+    """Cases are clipped on multiple processes, failures are reported for each case"""
+    self.writeRoiFile("roi.mrk.json", [-2, -8, 0], [0.8, -0.6, 0, 0.6, 0.8, 0, 0, 0, 1], [10, 12, 14])
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(-2, -8, 0)
+    sphere.SetRadius(7)
+    sphere.SetPhiResolution(20)
+    sphere.SetThetaResolution(20)
+    modelWriter = vtk.vtkSTLWriter()
+    modelWriter.SetInputConnection(sphere.GetOutputPort())
+    modelWriter.SetFileName(os.path.join(self.tempDir, "model.stl"))
+    modelWriter.Write()
+    manifest = {
+      "defaults": {"clipOutside": True, "fillOutsideValue": -7, "maxSlabSizeBytes": 25*30*2*6},
+      "cases": [
+        {"input": "input.nrrd", "roi": "roi.mrk.json", "output": "clipped/roi.nrrd"},
+        {"input": "input.nrrd", "model": "model.stl", "output": "clipped/model.nrrd", "clipInside": True, "fillInsideValue": 5},
+        {"input": "missing.nrrd", "roi": "roi.mrk.json", "output": "clipped/missing.nrrd"},
+        ]
+      }
+    manifestFilePath = os.path.join(self.tempDir, "manifest.json")
+    with open(manifestFilePath, "w") as manifestFile:
+      json.dump(manifest, manifestFile)
+    reportFilePath = os.path.join(self.tempDir, "report.json")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+      exitCode = VolumeClipBatch.main([manifestFilePath, "--processes", "2", "--report", reportFilePath])
+    self.assertEqual(exitCode, 1)
+    with open(reportFilePath) as reportFile:
+      report = json.load(reportFile)
+    self.assertEqual(report["numberOfCases"], 3)
+    self.assertEqual(report["numberOfFailures"], 1)
+    self.assertEqual([result["success"] for result in report["cases"]], [True, True, False])
+    self.assertEqual(report["cases"][2]["input"], os.path.join(self.tempDir, "missing.nrrd"))
+    self.assertIsNotNone(report["cases"][2]["error"])
+    self.assertFalse(os.path.exists(os.path.join(self.tempDir, "clipped", "missing.nrrd")))
+
+    # ROI case
+    roiBounds, rasToBox = VolumeClipBatch.readRoiFile(os.path.join(self.tempDir, "roi.mrk.json"))
+    insideMask = VolumeClipLib.getBoxMask(VolumeClipLib.getIjkToBox(self.ijkToRas, rasToBox), roiBounds,
+      VolumeClipLib.getVoxelExtent(self.voxels))
+    self.assertTrue(insideMask.any() and not insideMask.all())
+    self.assertTrue(np.array_equal(self.readOutputVoxels(os.path.join("clipped", "roi.nrrd")), np.where(insideMask, self.voxels, -7)))
+
+    # Model case (STL file is in LPS coordinate system)
+    vertices, faces = VolumeClipLib.getSurfaceArrays(VolumeClipBatch.readModelFile(os.path.join(self.tempDir, "model.stl")))
+    self.assertTrue(np.allclose(vertices.mean(axis=0), [2, 8, 0], atol=0.5))
+    expectedVoxels = VolumeClipLib.clipVoxelsWithSurface(self.voxels, self.ijkToRas, vertices, faces, True, -7, True, 5)
+    self.assertTrue(np.array_equal(self.readOutputVoxels(os.path.join("clipped", "model.nrrd")), expectedVoxels))
+
+if __name__ == "__main__":
+  unittest.main()
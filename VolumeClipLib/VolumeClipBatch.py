@@ -0,0 +1,246 @@
+"""
+Clip many volume files with models or ROIs, without Slicer GUI or scene.
+
+Usage (PythonSlicer is the Python interpreter of Slicer, any Python with numpy and vtk can be used):
+
+  PythonSlicer -m VolumeClipLib.VolumeClipBatch manifest.json --processes 8 --report report.json
+
+The manifest is a JSON file that lists the cases. Relative paths are relative to the manifest file.
+Values in "defaults" are used for all cases that do not specify them:
+
+  {
+    "defaults": {"clipOutside": true, "fillOutsideValue": 0, "clipInside": false, "fillInsideValue": 0},
+    "cases": [
+      {"input": "case001.nrrd", "model": "case001-tumor.stl", "output": "clipped/case001.nrrd"},
+      {"input": "case002.nii", "roi": "case002-roi.mrk.json", "output": "clipped/case002.nrrd", "fillOutsideValue": -1000}
+    ]
+  }
+
+Input volumes must be uncompressed NRRD or NIfTI files (they are memory-mapped and clipped slab by slab),
+outputs are written as NRRD files. Models can be VTK, VTP, STL, PLY, or OBJ files. Model files are assumed
+to be in LPS coordinate system, unless the file header specifies RAS (as Slicer does) or the case
+sets "modelCoordinateSystem" to "RAS". ROIs are Slicer markups ROI JSON files.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import vtk
+
+import VolumeClipLib
+
+__all__ = ["readManifest", "clipCase", "clipCases"]
+
+_caseDefaults = {
+  "clipOutside": True,
+  "fillOutsideValue": 0,
+  "clipInside": False,
+  "fillInsideValue": 0,
+  "modelCoordinateSystem": None,
+  "maxSlabSizeBytes": 64 * 1024 * 1024,
+  "numberOfThreads": 1,
+  }
+
+_lpsToRas = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+def readManifest(manifestFilePath):
+  """Returns list of cases (dictionaries) with absolute file paths and all parameters set"""
+  with open(manifestFilePath) as manifestFile:
+    manifest = json.load(manifestFile)
+  manifestDir = os.path.dirname(os.path.abspath(manifestFilePath))
+  defaults = dict(_caseDefaults)
+  defaults.update(manifest.get("defaults", {}))
+  cases = []
+  for caseIndex, caseParameters in enumerate(manifest["cases"]):
+    case = dict(defaults)
+    case.update(caseParameters)
+    for requiredKey in ["input", "output"]:
+      if requiredKey not in case:
+        raise ValueError("Case {0} in {1} does not specify '{2}'".format(caseIndex, manifestFilePath, requiredKey))
+    if ("model" in case) == ("roi" in case):
+      raise ValueError("Case {0} in {1} must specify either 'model' or 'roi'".format(caseIndex, manifestFilePath))
+    for pathKey in ["input", "output", "model", "roi"]:
+      if pathKey in case:
+        case[pathKey] = os.path.join(manifestDir, case[pathKey])
+    cases.append(case)
+  return cases
+
+def readModelFile(modelFilePath, coordinateSystem=None):
+  """Read a surface mesh file. Returns vtkPolyData in RAS coordinate system."""
+  extension = os.path.splitext(modelFilePath)[1].lower()
+  readers = {".vtk": vtk.vtkPolyDataReader, ".vtp": vtk.vtkXMLPolyDataReader, ".stl": vtk.vtkSTLReader,
+    ".ply": vtk.vtkPLYReader, ".obj": vtk.vtkOBJReader}
+  if extension not in readers:
+    raise ValueError("Unsupported model file format: {0}".format(modelFilePath))
+  reader = readers[extension]()
+  reader.SetFileName(modelFilePath)
+  reader.Update()
+  if reader.GetOutput().GetNumberOfPoints() == 0:
+    raise ValueError("Failed to read model file: {0}".format(modelFilePath))
+
+  if coordinateSystem is None:
+    # Slicer stores the coordinate system in the header of VTK files. Files without this information are LPS.
+    coordinateSystem = "LPS"
+    if extension in [".vtk", ".vtp"]:
+      with open(modelFilePath, "rb") as modelFile:
+        if b"SPACE=RAS" in modelFile.read(1024):
+          coordinateSystem = "RAS"
+  if coordinateSystem.upper() == "RAS":
+    return reader.GetOutput()
+  if coordinateSystem.upper() != "LPS":
+    raise ValueError("Unsupported model coordinate system: {0}".format(coordinateSystem))
+  return transformPolyData(reader.GetOutput(), _lpsToRas)
+
+def readRoiFile(roiFilePath):
+  """Read the first ROI from a Slicer markups JSON file.
+  Returns box bounds (xmin, xmax, ymin, ymax, zmin, zmax) and the RAS to box transform (4x4 numpy array).
+  """
+  with open(roiFilePath) as roiFile:
+    markups = json.load(roiFile)
+  rois = [markup for markup in markups.get("markups", []) if markup.get("type") == "ROI"]
+  if not rois:
+    raise ValueError("No ROI found in file: {0}".format(roiFilePath))
+  roi = rois[0]
+  boxToWorld = np.eye(4)
+  boxToWorld[:3, :3] = np.array(roi.get("orientation", [1, 0, 0, 0, 1, 0, 0, 0, 1]), dtype=np.float64).reshape(3, 3)
+  boxToWorld[:3, 3] = roi["center"]
+  if roi.get("coordinateSystem", "LPS").upper() == "LPS":
+    boxToWorld = np.dot(_lpsToRas, boxToWorld)
+  size = roi["size"]
+  boxBounds = [-size[0] / 2.0, size[0] / 2.0, -size[1] / 2.0, size[1] / 2.0, -size[2] / 2.0, size[2] / 2.0]
+  return boxBounds, np.linalg.inv(boxToWorld)
+
+def transformPolyData(polyData, matrix):
+  """Returns polydata transformed by a 4x4 numpy array"""
+  transform = vtk.vtkTransform()
+  transform.SetMatrix(VolumeClipLib.getVtkMatrix(matrix))
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetTransform(transform)
+  transformFilter.SetInputData(polyData)
+  transformFilter.Update()
+  return transformFilter.GetOutput()
+
+def clipCase(case):
+  """Clip one volume file as specified in the case dictionary (see readManifest).
+
+  Returns a dictionary with "input", "output", "success", "error", "processingTimeSec", "numberOfVoxels",
+  and "voxelsPerSec".
+  Exceptions are not raised but reported in the result.
+  """
+  startTime = time.time()
+  result = {"input": case["input"], "output": case["output"], "success": False, "error": None, "numberOfVoxels": 0}
+  try:
+    imageFileInfo = VolumeClipLib.readImageFileInfo(case["input"])
+    result["numberOfVoxels"] = int(np.prod(imageFileInfo.shape[:3]))
+    ijkToRas = imageFileInfo.ijkToRas
+    numberOfThreads = case["numberOfThreads"]
+    clipOutside = case["clipOutside"]
+    clipInside = case["clipInside"]
+
+    # Slabs are clipped in place
+    if "model" in case:
+      vertices, faces = VolumeClipLib.getSurfaceArrays(readModelFile(case["model"], case["modelCoordinateSystem"]))
+      def fillSlab(slabVoxels, slabImageData):
+        if not clipOutside and not clipInside:
+          return
+        VolumeClipLib.clipVoxelsWithSurface(slabVoxels, ijkToRas, vertices, faces,
+          clipOutside, case["fillOutsideValue"], clipInside, case["fillInsideValue"],
+          extent=slabImageData.GetExtent(), numberOfThreads=numberOfThreads, outputVoxels=slabVoxels)
+    else:
+      roiBounds, rasToBox = readRoiFile(case["roi"])
+      def fillSlab(slabVoxels, slabImageData):
+        # The ROI has a single fill value, inside and outside are filled separately
+        extent = slabImageData.GetExtent()
+        if clipOutside:
+          VolumeClipLib.clipVoxelsWithRoi(slabVoxels, ijkToRas, roiBounds, rasToBox, case["fillOutsideValue"], True,
+            extent, numberOfThreads, outputVoxels=slabVoxels)
+        if clipInside:
+          VolumeClipLib.clipVoxelsWithRoi(slabVoxels, ijkToRas, roiBounds, rasToBox, case["fillInsideValue"], False,
+            extent, numberOfThreads, outputVoxels=slabVoxels)
+
+    outputDir = os.path.dirname(case["output"])
+    if outputDir and not os.path.exists(outputDir):
+      os.makedirs(outputDir)
+    VolumeClipLib.clipImageFile(imageFileInfo, case["output"], fillSlab, case["maxSlabSizeBytes"])
+    result["success"] = True
+  except Exception as e:
+    result["error"] = "{0}: {1}".format(type(e).__name__, e)
+  result["processingTimeSec"] = time.time() - startTime
+  result["voxelsPerSec"] = result["numberOfVoxels"] / result["processingTimeSec"] if result["success"] else 0.0
+  return result
+
+def clipCases(cases, numberOfProcesses=None, progressCallback=None):
+  """Clip all cases on a process pool.
+
+  :param progressCallback: function(result) that is called when a case is completed
+  Returns a report dictionary with the results of all cases (in the order of cases) and summary statistics.
+  """
+  if numberOfProcesses is None:
+    numberOfProcesses = VolumeClipLib.getDefaultNumberOfThreads()
+  startTime = time.time()
+  results = [None] * len(cases)
+  if numberOfProcesses <= 1:
+    for caseIndex, case in enumerate(cases):
+      results[caseIndex] = clipCase(case)
+      if progressCallback:
+        progressCallback(results[caseIndex])
+  else:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numberOfProcesses) as executor:
+      futureToCaseIndex = {executor.submit(clipCase, case): caseIndex for caseIndex, case in enumerate(cases)}
+      for future in concurrent.futures.as_completed(futureToCaseIndex):
+        caseIndex = futureToCaseIndex[future]
+        try:
+          results[caseIndex] = future.result()
+        except Exception as e:
+          # Worker process failed (for example, it was terminated)
+          results[caseIndex] = {"input": cases[caseIndex]["input"], "output": cases[caseIndex]["output"], "success": False,
+            "error": "{0}: {1}".format(type(e).__name__, e), "processingTimeSec": 0.0, "numberOfVoxels": 0, "voxelsPerSec": 0.0}
+        if progressCallback:
+          progressCallback(results[caseIndex])
+  totalTimeSec = time.time() - startTime
+
+  succeededResults = [result for result in results if result["success"]]
+  numberOfVoxels = sum(result["numberOfVoxels"] for result in succeededResults)
+  return {
+    "numberOfCases": len(cases),
+    "numberOfFailures": len(cases) - len(succeededResults),
+    "numberOfProcesses": numberOfProcesses,
+    "totalTimeSec": totalTimeSec,
+    "casesPerSec": len(succeededResults) / totalTimeSec if totalTimeSec > 0 else 0.0,
+    "voxelsPerSec": numberOfVoxels / totalTimeSec if totalTimeSec > 0 else 0.0,
+    "cases": results,
+    }
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Clip volume files with models or ROIs listed in a manifest file.")
+  parser.add_argument("manifest", help="JSON file that lists the cases")
+  parser.add_argument("--processes", type=int, default=VolumeClipLib.getDefaultNumberOfThreads(),
+    help="number of worker processes (default: number of CPUs)")
+  parser.add_argument("--report", help="write per-case results and summary to this JSON file")
+  args = parser.parse_args(argv)
+
+  cases = readManifest(args.manifest)
+  numberOfCompletedCases = [0]
+  def printProgress(result):
+    numberOfCompletedCases[0] += 1
+    status = "OK" if result["success"] else "FAILED: " + result["error"]
+    print("[{0}/{1}] {2} ({3:.2f}s) {4}".format(numberOfCompletedCases[0], len(cases), result["input"],
+      result["processingTimeSec"], status))
+    sys.stdout.flush()
+
+  report = clipCases(cases, args.processes, printProgress)
+  print("Clipped {0} of {1} cases in {2:.1f}s ({3:.2f} cases/s, {4:.3g} voxels/s), {5} failed".format(
+    report["numberOfCases"] - report["numberOfFailures"], report["numberOfCases"], report["totalTimeSec"],
+    report["casesPerSec"], report["voxelsPerSec"], report["numberOfFailures"]))
+  if args.report:
+    with open(args.report, "w") as reportFile:
+      json.dump(report, reportFile, indent=2)
+  return 1 if report["numberOfFailures"] else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
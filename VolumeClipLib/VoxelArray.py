@@ -0,0 +1,94 @@
+import numpy as np
+import vtk
+from vtk.util import numpy_support
+
+__all__ = ["getVoxelArray", "createImageData", "getStencilMask", "castFillValue", "getIndexToPointMatrix", "getNumpyMatrix", "getVtkMatrix"]
+
+#
+# Conversion between vtkImageData and numpy voxel arrays
+#
+# Voxel arrays are indexed as [k, j, i] (or [k, j, i, component] for multi-component images),
+# same as slicer.util.arrayFromVolume.
+#
+
+def getVoxelArray(imageData):
+  """Returns the scalars of the image as a numpy array. The array shares memory with the image."""
+  scalars = imageData.GetPointData().GetScalars()
+  dimensions = imageData.GetDimensions()
+  shape = (dimensions[2], dimensions[1], dimensions[0])
+  if scalars.GetNumberOfComponents() > 1:
+    shape += (scalars.GetNumberOfComponents(),)
+  return numpy_support.vtk_to_numpy(scalars).reshape(shape)
+
+def createImageData(voxels, referenceImageData=None):
+  """Create a vtkImageData from a voxel array.
+
+  If the array is C-contiguous then the image refers to the array memory, without making a copy.
+  Origin, spacing and extent start index are copied from referenceImageData (if specified).
+  """
+  voxels = np.ascontiguousarray(voxels)
+  numberOfComponents = voxels.shape[3] if voxels.ndim > 3 else 1
+  imageData = vtk.vtkImageData()
+  if referenceImageData is not None:
+    imageData.SetOrigin(referenceImageData.GetOrigin())
+    imageData.SetSpacing(referenceImageData.GetSpacing())
+    referenceExtent = referenceImageData.GetExtent()
+  else:
+    referenceExtent = (0, 0, 0, 0, 0, 0)
+  imageData.SetExtent(referenceExtent[0], referenceExtent[0] + voxels.shape[2] - 1,
+    referenceExtent[2], referenceExtent[2] + voxels.shape[1] - 1,
+    referenceExtent[4], referenceExtent[4] + voxels.shape[0] - 1)
+  scalars = numpy_support.numpy_to_vtk(voxels.reshape(-1, numberOfComponents), deep=False,
+    array_type=numpy_support.get_vtk_array_type(voxels.dtype))
+  scalars.SetName("ImageScalars")
+  imageData.GetPointData().SetScalars(scalars)
+  return imageData
+
+def getStencilMask(stencil, extent):
+  """Returns a boolean voxel array for the specified extent that is True inside the stencil (vtkImageStencilData)"""
+  stencilExtent = stencil.GetExtent()
+  start = [max(extent[axis * 2], stencilExtent[axis * 2]) for axis in range(3)]
+  stop = [min(extent[axis * 2 + 1], stencilExtent[axis * 2 + 1]) + 1 for axis in range(3)]
+  if not all(start[axis] < stop[axis] for axis in range(3)):
+    # Requested extent is completely outside the stencil
+    return np.zeros((extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1), dtype=bool)
+  # Only convert the part of the stencil that is in the requested extent
+  stencilToImage = vtk.vtkImageStencilToImage()
+  stencilToImage.SetInputData(stencil)
+  stencilToImage.SetInsideValue(1)
+  stencilToImage.SetOutsideValue(0)
+  stencilToImage.SetOutputScalarTypeToUnsignedChar()
+  stencilToImage.UpdateExtent((start[0], stop[0] - 1, start[1], stop[1] - 1, start[2], stop[2] - 1))
+  stencilImage = stencilToImage.GetOutput()
+  stencilMask = getVoxelArray(stencilImage).view(bool)
+  if tuple(stencilImage.GetExtent()) == tuple(extent):
+    return stencilMask
+  # Stencil extent is smaller than the requested extent, voxels outside the stencil extent are outside
+  mask = np.zeros((extent[5] - extent[4] + 1, extent[3] - extent[2] + 1, extent[1] - extent[0] + 1), dtype=bool)
+  mask[start[2] - extent[4]:stop[2] - extent[4], start[1] - extent[2]:stop[1] - extent[2], start[0] - extent[0]:stop[0] - extent[0]] = stencilMask
+  return mask
+
+def castFillValue(fillValue, dtype):
+  """Convert fill value to the voxel type the same way as vtkImageStencil does (round to nearest integer, wrap around)"""
+  dtype = np.dtype(dtype)
+  if dtype.kind in "iu":
+    return np.array(int(np.floor(fillValue + 0.5))).astype(dtype)
+  return dtype.type(fillValue)
+
+def getIndexToPointMatrix(imageData):
+  """Returns 4x4 numpy array that maps voxel index to image point coordinates (using image origin and spacing)"""
+  indexToPoint = np.diag(list(imageData.GetSpacing()) + [1.0])
+  indexToPoint[:3, 3] = imageData.GetOrigin()
+  return indexToPoint
+
+def getNumpyMatrix(vtkMatrix):
+  """Returns a vtkMatrix4x4 as a 4x4 numpy array"""
+  return np.array([[vtkMatrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+def getVtkMatrix(numpyMatrix):
+  """Returns a 4x4 numpy array as a vtkMatrix4x4"""
+  vtkMatrix = vtk.vtkMatrix4x4()
+  for row in range(4):
+    for column in range(4):
+      vtkMatrix.SetElement(row, column, numpyMatrix[row][column])
+  return vtkMatrix
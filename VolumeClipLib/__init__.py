@@ -0,0 +1,24 @@
+"""
+Helper classes and functions shared by the VolumeClip modules.
+This package must not depend on Qt or on the MRML scene.
+ClipLogic (shared by the module logics) requires Slicer, therefore it is not imported here.
+"""
+
+from .BoxRasterizer import *
+from .BrickClassifier import *
+from .ClipCore import *
+from .ClipOperation import *
+from .ConvexHull import *
+from .FrameCache import *
+from .ImageFile import *
+from .MaskFile import *
+from .MaskFill import *
+from .NarrowBand import *
+from .ParallelProcessing import *
+from .SequenceClipping import *
+from .SlabProcessing import *
+from .StencilBoolean import *
+from .StencilCache import *
+from .StreamingClip import *
+from .SurfaceReconstruction import *
+from .VoxelArray import *
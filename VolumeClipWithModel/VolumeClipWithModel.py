@@ -1,8 +1,13 @@
+import logging
 import os
 import string
 import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+import numpy as np
+from vtk.util import numpy_support
+import VolumeClipLib
+from VolumeClipLib.ClipLogic import ClipLogicMixin
 
 #
 # VolumeClipWithModel
@@ -13,7 +18,8 @@ class VolumeClipWithModel(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "Volume clip with model"
     self.parent.categories = ["Segmentation"]
-    self.parent.dependencies = []
+    # ROI logic is used for clipping with combination of models and ROIs
+    self.parent.dependencies = ["VolumeClipWithRoi"]
     self.parent.contributors = ["Andras Lasso, Matt Lougheed (PerkLab, Queen's University)"]
     self.parent.helpText = string.Template("""
       Clip volume with a surface model. Optionally the surface model can be automatically generated from a set of sample markup points.
@@ -38,6 +44,29 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     self.parameterNodeObserver = None
     self.clippingMarkupNode = None
     self.clippingMarkupNodeObservers = []
+    # Markup modifications are coalesced: the clipping surface is regenerated at most once per update interval
+    self.clippingModelUpdateIntervalMsec = 30
+    self.clippingModelUpdateTimer = None
+    self.clippingMarkupEventCount = 0
+    self.clippingModelUpdateCount = 0
+    # While a markup point is dragged only a coarse clipping surface is generated
+    self.clippingMarkupInteractionInProgress = False
+    # Clipping runs on a background thread, its completion is checked periodically
+    self.clipTask = None
+    self.clipTaskOutputVolume = None
+    # Sequence browser that shows the output volume, if all frames of a sequence are clipped
+    self.clipTaskSequenceBrowserNode = None
+    self.clipTaskProgress = 0.0
+    self.clipTaskTimer = None
+    # In live update mode the frame that is selected in the sequence browser is clipped when it is browsed and the output
+    # is updated when the model is modified. Model modifications are coalesced: the output is updated at most once per update interval.
+    self.liveClippingSettings = None
+    self.liveClippingModelNode = None
+    self.liveClippingModelNodeObservers = []
+    self.liveClippingUpdateIntervalMsec = 30
+    self.liveClippingUpdateTimer = None
+    self.liveClippingSequenceBrowserNode = None
+    self.liveClippingSequenceBrowserNodeObserver = None
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
@@ -98,6 +127,17 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     self.clippingMarkupSelector.setToolTip("If markups are selected then the clipping surface will be generated from the markup points. The surface is updated automatically when markups are moved.")
     parametersFormLayout.addRow("Clipping surface from markups: ", self.clippingMarkupSelector)
 
+    #
+    # surface generation method for markups
+    #
+    self.markupSurfaceModeComboBox = qt.QComboBox()
+    self.markupSurfaceModeComboBox.addItem("Convex hull", "convexHull")
+    self.markupSurfaceModeComboBox.addItem("Surface reconstruction", "surfaceReconstruction")
+    self.markupSurfaceModeComboBox.setToolTip("Convex hull is robust for a few points but it is always convex."
+      " Surface reconstruction can follow concave surfaces, but it requires many points that densely cover the surface"
+      " (for example, acquired by a tracked stylus). Dense point sets are decimated, so that the surface is updated quickly.")
+    parametersFormLayout.addRow("Surface from markups: ", self.markupSurfaceModeComboBox)
+
     #
     # clip outside the surface
     #
@@ -134,6 +174,26 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     self.fillInsideValueEdit.value = 255
     parametersFormLayout.addRow("Inside Fill value: ", self.fillInsideValueEdit)
 
+    #
+    # clip all frames of a sequence
+    #
+    self.clipSequenceCheckBox = qt.QCheckBox()
+    self.clipSequenceCheckBox.checked = False
+    self.clipSequenceCheckBox.setToolTip("If checked and the input volume is browsed by a sequence browser (for example, 4D cine MR or CT perfusion)"
+      " then all frames are clipped into a sequence that is browsed with the output volume. The model is rasterized once for all frames."
+      " In live update mode frames are clipped while they are browsed and the next and previous frames are clipped in advance in the background.")
+    parametersFormLayout.addRow("Clip all frames: ", self.clipSequenceCheckBox)
+
+    #
+    # live update of browsed frames
+    #
+    self.liveUpdateCheckBox = qt.QCheckBox()
+    self.liveUpdateCheckBox.checked = False
+    self.liveUpdateCheckBox.setToolTip("If checked and all frames are clipped, the frame that is selected in the sequence browser"
+      " is clipped into the output volume while the sequence is browsed or played, and the output is updated when the clipping surface is modified."
+      " Not available if the output volume is the same as the input volume.")
+    parametersFormLayout.addRow("Live update: ", self.liveUpdateCheckBox)
+
     #
     # output volume selector
     #
@@ -156,19 +216,60 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     self.applyButton.enabled = False
     parametersFormLayout.addRow(self.applyButton)
 
+    #
+    # progress of clipping, shown while clipping is in progress
+    #
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.minimum = 0
+    self.progressBar.maximum = 100
+    self.progressBar.visible = False
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop clipping. The output volume is not modified."
+    self.cancelButton.visible = False
+    progressLayout = qt.QHBoxLayout()
+    progressLayout.addWidget(self.progressBar)
+    progressLayout.addWidget(self.cancelButton)
+    parametersFormLayout.addRow(progressLayout)
+
+    # Timer for checking completion of clipping on the background thread
+    self.clipTaskTimer = qt.QTimer()
+    self.clipTaskTimer.setInterval(100)
+    self.clipTaskTimer.connect('timeout()', self.onClipTaskTimer)
+    self.logic.setProgressCallback(self.onClipProgress)
+
+    # Timer for delayed update of the output volume in live update mode
+    self.liveClippingUpdateTimer = qt.QTimer()
+    self.liveClippingUpdateTimer.setSingleShot(True)
+    self.liveClippingUpdateTimer.setInterval(self.liveClippingUpdateIntervalMsec)
+    self.liveClippingUpdateTimer.connect('timeout()', self.onLiveClippingUpdateTimer)
+
+    # Timer for delayed update of the clipping surface from markups
+    self.clippingModelUpdateTimer = qt.QTimer()
+    self.clippingModelUpdateTimer.setSingleShot(True)
+    self.clippingModelUpdateTimer.setInterval(self.clippingModelUpdateIntervalMsec)
+    self.clippingModelUpdateTimer.connect('timeout()', self.updateModelFromClippingMarkupNode)
+
     # connections
     self.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
     self.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputVolumeSelect)
     self.clippingModelSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onClippingModelSelect)
     self.clippingMarkupSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onClippingMarkupSelect)
+    self.markupSurfaceModeComboBox.connect("currentIndexChanged(int)", self.onMarkupSurfaceModeChanged)
     self.outputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onOutputVolumeSelect)
 
     # Define list of widgets for updateGUIFromParameterNode, updateParameterNodeFromGUI, and addGUIObservers
-    self.valueEditWidgets = {"clipOutsideSurface": self.clipOutsideSurfaceCheckBox, "fillOutsideValue": self.fillOutsideValueEdit, "clipInsideSurface": self.clipInsideSurfaceCheckBox, "fillInsideValue": self.fillInsideValueEdit}
+    self.valueEditWidgets = {"clipOutsideSurface": self.clipOutsideSurfaceCheckBox, "fillOutsideValue": self.fillOutsideValueEdit, "clipInsideSurface": self.clipInsideSurfaceCheckBox, "fillInsideValue": self.fillInsideValueEdit, "markupSurfaceMode": self.markupSurfaceModeComboBox,
+      "clipSequence": self.clipSequenceCheckBox, "liveUpdate": self.liveUpdateCheckBox}
     self.nodeSelectorWidgets = {"InputVolume": self.inputVolumeSelector, "ClippingModel": self.clippingModelSelector, "ClippingMarkup": self.clippingMarkupSelector, "OutputVolume": self.outputVolumeSelector}
 
     # Use singleton parameter node (it is created if does not exist yet)
     parameterNode = self.logic.getParameterNode()
+    # Parameter node may have been created by an earlier version of the module
+    if not parameterNode.GetParameter("clipSequence"):
+      parameterNode.SetParameter("clipSequence", "0")
+    if not parameterNode.GetParameter("liveUpdate"):
+      parameterNode.SetParameter("liveUpdate", "0")
     # Set parameter node (widget will observe it and also updates GUI)
     self.setAndObserveParameterNode(parameterNode)
 
@@ -185,7 +286,18 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     self.removeGUIObservers()
     self.setAndObserveParameterNode(None)
     self.setAndObserveClippingMarkupNode(None)
-    pass
+    self.setAndObserveLiveClippingModelNode(None)
+    self.setAndObserveLiveClippingSequenceBrowserNode(None)
+    if self.clippingModelUpdateTimer:
+      self.clippingModelUpdateTimer.stop()
+    if self.liveClippingUpdateTimer:
+      self.liveClippingUpdateTimer.stop()
+    if self.clipTaskTimer:
+      self.clipTaskTimer.stop()
+    if self.clipTask:
+      self.logic.cancel()
+      self.clipTask = None
+    self.logic.stopSequenceClipping()
 
   def setAndObserveParameterNode(self, parameterNode):
     if parameterNode == self.parameterNode and self.parameterNodeObserver:
@@ -223,24 +335,56 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
         eventIds = [ vtk.vtkCommand.ModifiedEvent ]
       for eventId in eventIds:
         self.clippingMarkupNodeObservers.append(self.clippingMarkupNode.AddObserver(eventId, self.onClippingMarkupNodeModified))
-
-      self.clippingMarkupNodeObserver = self.clippingMarkupNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onClippingMarkupNodeModified)
-    # Update GUI
+      if (slicer.app.majorVersion >= 5) or (slicer.app.majorVersion >= 4 and slicer.app.minorVersion >= 11):
+        self.clippingMarkupNodeObservers.append(self.clippingMarkupNode.AddObserver(
+          slicer.vtkMRMLMarkupsNode.PointStartInteractionEvent, self.onClippingMarkupInteractionStarted))
+        self.clippingMarkupNodeObservers.append(self.clippingMarkupNode.AddObserver(
+          slicer.vtkMRMLMarkupsNode.PointEndInteractionEvent, self.onClippingMarkupInteractionEnded))
+    self.clippingMarkupInteractionInProgress = False
+    # Update GUI (pending update requested for the previous markup node is no longer needed)
     self.updateModelFromClippingMarkupNode()
 
   def getParameterNode(self):
     return self.parameterNode
 
   def onClippingMarkupNodeModified(self, observer, eventid):
+    # A single point drag emits several events, the surface is only regenerated once
+    # when the update timer times out (it uses the markup positions at that time).
+    self.clippingMarkupEventCount += 1
+    if not self.clippingModelUpdateTimer:
+      self.updateModelFromClippingMarkupNode()
+      return
+    if not self.clippingModelUpdateTimer.isActive():
+      self.clippingModelUpdateTimer.start()
+
+  def onClippingMarkupInteractionStarted(self, observer, eventid):
+    self.clippingMarkupInteractionInProgress = True
+
+  def onClippingMarkupInteractionEnded(self, observer, eventid):
+    # Generate full-quality surface now that the interaction is completed
+    self.clippingMarkupInteractionInProgress = False
     self.updateModelFromClippingMarkupNode()
 
   def onParameterNodeModified(self, observer, eventid):
     self.updateGUIFromParameterNode()
 
   def updateModelFromClippingMarkupNode(self):
+    # Cancel pending update request, the surface is regenerated now
+    if self.clippingModelUpdateTimer:
+      self.clippingModelUpdateTimer.stop()
     if not self.clippingMarkupNode or not self.clippingModelSelector.currentNode():
       return
-    self.logic.updateModelFromMarkup(self.clippingMarkupNode, self.clippingModelSelector.currentNode())
+    self.clippingModelUpdateCount += 1
+    self.logic.setMarkupSurfaceMode(self.markupSurfaceModeComboBox.itemData(self.markupSurfaceModeComboBox.currentIndex))
+    self.logic.updateModelFromMarkup(self.clippingMarkupNode, self.clippingModelSelector.currentNode(),
+      self.clippingMarkupInteractionInProgress)
+
+  def getClippingModelUpdateStatistics(self):
+    """Returns number of received markup modification events and number of actual surface updates"""
+    return {
+      "markupEvents": self.clippingMarkupEventCount,
+      "modelUpdates": self.clippingModelUpdateCount,
+      }
 
   def getClassName(self, widget):
     import sys
@@ -261,6 +405,10 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
         self.valueEditWidgets[parameterName].setChecked(checked)
       elif widgetClassName=="QSpinBox":
         self.valueEditWidgets[parameterName].setValue(float(parameterNode.GetParameter(parameterName)))
+      elif widgetClassName=="QComboBox":
+        index = self.valueEditWidgets[parameterName].findData(parameterNode.GetParameter(parameterName) or "convexHull")
+        if index >= 0:
+          self.valueEditWidgets[parameterName].setCurrentIndex(index)
       else:
         raise Exception("Unexpected widget class: {0}".format(widgetClassName))
       self.valueEditWidgets[parameterName].blockSignals(oldBlockSignalsState)
@@ -281,11 +429,15 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
           parameterNode.SetParameter(parameterName, "0")
       elif widgetClassName=="QSpinBox":
         parameterNode.SetParameter(parameterName, str(self.valueEditWidgets[parameterName].value))
+      elif widgetClassName=="QComboBox":
+        widget = self.valueEditWidgets[parameterName]
+        parameterNode.SetParameter(parameterName, widget.itemData(widget.currentIndex))
       else:
         raise Exception("Unexpected widget class: {0}".format(widgetClassName))
     for parameterName in self.nodeSelectorWidgets:
       parameterNode.SetNodeReferenceID(parameterName, self.nodeSelectorWidgets[parameterName].currentNodeID)
     parameterNode.EndModify(oldModifiedState)
+    self.updateLiveClippingState()
 
   def addGUIObservers(self):
     for parameterName in self.valueEditWidgets:
@@ -294,6 +446,8 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
         self.valueEditWidgets[parameterName].connect("valueChanged(int)", self.updateParameterNodeFromGUI)
       elif widgetClassName=="QCheckBox":
         self.valueEditWidgets[parameterName].connect("clicked()", self.updateParameterNodeFromGUI)
+      elif widgetClassName=="QComboBox":
+        self.valueEditWidgets[parameterName].connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
     for parameterName in self.nodeSelectorWidgets:
       self.nodeSelectorWidgets[parameterName].connect("currentNodeIDChanged(QString)", self.updateParameterNodeFromGUI)
 
@@ -304,11 +458,16 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
         self.valueEditWidgets[parameterName].disconnect("valueChanged(int)", self.updateParameterNodeFromGUI)
       elif widgetClassName=="QCheckBox":
         self.valueEditWidgets[parameterName].disconnect("clicked()", self.updateParameterNodeFromGUI)
+      elif widgetClassName=="QComboBox":
+        self.valueEditWidgets[parameterName].disconnect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
     for parameterName in self.nodeSelectorWidgets:
       self.nodeSelectorWidgets[parameterName].disconnect("currentNodeIDChanged(QString)", self.updateParameterNodeFromGUI)
 
   def updateApplyButtonState(self):
-    if not self.inputVolumeSelector.currentNode():
+    if self.clipTask:
+      self.applyButton.toolTip = "Clipping is in progress."
+      self.applyButton.enabled = False
+    elif not self.inputVolumeSelector.currentNode():
       self.applyButton.toolTip = "Input volume is required. Clip volume with surface model is disabled."
       self.applyButton.enabled = False
     elif not self.clippingModelSelector.currentNode():
@@ -330,6 +489,10 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
   def onClippingMarkupSelect(self, node):
     self.setAndObserveClippingMarkupNode(self.clippingMarkupSelector.currentNode())
 
+  def onMarkupSurfaceModeChanged(self, index):
+    # Regenerate the surface with the selected method
+    self.updateModelFromClippingMarkupNode()
+
   def onOutputVolumeSelect(self, node):
     self.updateApplyButtonState()
 
@@ -341,14 +504,159 @@ class VolumeClipWithModelWidget(ScriptedLoadableModuleWidget):
     clipInsideSurface = self.clipInsideSurfaceCheckBox.checked
     fillOutsideValue = self.fillOutsideValueEdit.value
     fillInsideValue = self.fillInsideValueEdit.value
-    self.logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume)
-    self.logic.showInSliceViewers(outputVolume, ["Red", "Yellow", "Green"])
+    if self.clippingMarkupNode and clippingModel and self.logic.isMarkupSurfaceCoarse(clippingModel):
+      # Make sure the volume is clipped with the full-quality surface
+      self.clippingMarkupInteractionInProgress = False
+      self.updateModelFromClippingMarkupNode()
+    if self.clipSequenceCheckBox.checked:
+      sequenceBrowserNode, inputSequence = VolumeClipLib.getBrowsedSequence(slicer.modules.sequences.logic(), inputVolume)
+      if inputSequence:
+        self.clipSequence(inputSequence, sequenceBrowserNode, clippingModel, clipOutsideSurface, fillOutsideValue,
+          clipInsideSurface, fillInsideValue, outputVolume)
+        return
+    try:
+      clipTask = self.logic.startClipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue,
+        clipInsideSurface, fillInsideValue, outputVolume)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip volume: {0}".format(e))
+      return
+    self.runClipTask(clipTask, outputVolume)
+
+  def clipSequence(self, inputSequence, sequenceBrowserNode, clippingModel, clipOutsideSurface, fillOutsideValue,
+    clipInsideSurface, fillInsideValue, outputVolume):
+    """Clip all frames of the input sequence into the sequence that the browser shows in the output volume"""
+    try:
+      outputSequence = VolumeClipLib.getOutputSequence(sequenceBrowserNode, outputVolume)
+      clipTask = self.logic.startClipSequenceWithModel(inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue,
+        clipInsideSurface, fillInsideValue, outputSequence)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip sequence: {0}".format(e))
+      return
+    self.runClipTask(clipTask, outputVolume, sequenceBrowserNode)
+
+  def runClipTask(self, clipTask, outputVolume, sequenceBrowserNode=None):
+    """Process voxels on a background thread, the output volume (or sequence) is updated when processing is completed"""
+    self.clipTask = clipTask
+    self.clipTaskOutputVolume = outputVolume
+    self.clipTaskSequenceBrowserNode = sequenceBrowserNode
+    self.setClipTaskInProgress(True)
+    self.clipTask.runInBackground()
+    self.clipTaskTimer.start()
+
+  def onCancelButton(self):
+    self.cancelButton.enabled = False
+    self.logic.cancel()
+
+  def onClipProgress(self, operationName, progress, stageName):
+    # Called from the processing thread, therefore GUI is updated in onClipTaskTimer
+    self.clipTaskProgress = progress
+
+  def onClipTaskTimer(self):
+    self.progressBar.value = int(self.clipTaskProgress * 100)
+    if self.clipTask.isRunning():
+      return
+    self.clipTaskTimer.stop()
+    try:
+      if self.clipTask.finish():
+        if self.clipTaskSequenceBrowserNode:
+          # Show the clipped frame that is selected in the browser
+          slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(self.clipTaskSequenceBrowserNode)
+        self.logic.showInSliceViewers(self.clipTaskOutputVolume, ["Red", "Yellow", "Green"])
+    except VolumeClipLib.ClipCancelledError:
+      logging.info("Clipping was cancelled")
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip volume: {0}".format(e))
+    finally:
+      self.clipTask = None
+      self.clipTaskOutputVolume = None
+      self.clipTaskSequenceBrowserNode = None
+      self.setClipTaskInProgress(False)
+      # Apply live clipping settings that were changed while clipping was in progress
+      self.updateLiveClippingState()
+
+  def updateLiveClippingState(self):
+    """Start, restart, or stop clipping of the browsed frames to match the current settings"""
+    if self.clipTask:
+      # output volume is being updated by Apply, settings are applied when it is completed
+      return
+    liveClippingSettings = None
+    sequenceBrowserNode = None
+    if self.liveUpdateCheckBox.checked and self.clipSequenceCheckBox.checked:
+      clippingModel = self.clippingModelSelector.currentNode()
+      inputVolume = self.inputVolumeSelector.currentNode()
+      outputVolume = self.outputVolumeSelector.currentNode()
+      if clippingModel and inputVolume and outputVolume and inputVolume != outputVolume:
+        sequenceBrowserNode, inputSequence = VolumeClipLib.getBrowsedSequence(slicer.modules.sequences.logic(), inputVolume)
+        if inputSequence:
+          liveClippingSettings = (clippingModel, sequenceBrowserNode, inputSequence, self.clipOutsideSurfaceCheckBox.checked,
+            self.fillOutsideValueEdit.value, self.clipInsideSurfaceCheckBox.checked, self.fillInsideValueEdit.value, outputVolume)
+    if liveClippingSettings == self.liveClippingSettings:
+      return
+    self.liveClippingSettings = liveClippingSettings
+    self.setAndObserveLiveClippingModelNode(None)
+    self.setAndObserveLiveClippingSequenceBrowserNode(None)
+    self.logic.stopSequenceClipping()
+    if not liveClippingSettings:
+      return
+    try:
+      self.logic.startSequenceClipping(*liveClippingSettings)
+    except Exception as e:
+      self.liveClippingSettings = None
+      slicer.util.errorDisplay("Failed to clip sequence: {0}".format(e))
+      return
+    self.logic.showInSliceViewers(liveClippingSettings[-1], ["Red", "Yellow", "Green"])
+    self.setAndObserveLiveClippingModelNode(liveClippingSettings[0])
+    self.setAndObserveLiveClippingSequenceBrowserNode(sequenceBrowserNode)
+
+  def setAndObserveLiveClippingModelNode(self, modelNode):
+    for observer in self.liveClippingModelNodeObservers:
+      self.liveClippingModelNode.RemoveObserver(observer)
+    self.liveClippingModelNodeObservers = []
+    self.liveClippingModelNode = modelNode
+    if self.liveClippingModelNode:
+      for event in [vtk.vtkCommand.ModifiedEvent, slicer.vtkMRMLModelNode.MeshModifiedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent]:
+        self.liveClippingModelNodeObservers.append(self.liveClippingModelNode.AddObserver(event, self.onLiveClippingModelNodeModified))
+
+  def setAndObserveLiveClippingSequenceBrowserNode(self, sequenceBrowserNode):
+    if self.liveClippingSequenceBrowserNodeObserver:
+      self.liveClippingSequenceBrowserNode.RemoveObserver(self.liveClippingSequenceBrowserNodeObserver)
+      self.liveClippingSequenceBrowserNodeObserver = None
+    self.liveClippingSequenceBrowserNode = sequenceBrowserNode
+    if self.liveClippingSequenceBrowserNode:
+      self.liveClippingSequenceBrowserNodeObserver = self.liveClippingSequenceBrowserNode.AddObserver(
+        vtk.vtkCommand.ModifiedEvent, self.onLiveClippingSequenceBrowserNodeModified)
+
+  def onLiveClippingSequenceBrowserNodeModified(self, observer, eventid):
+    # Output is updated immediately (not coalesced by the update timer), so that it keeps up with playback
+    if self.clipTask:
+      return
+    self.logic.updateSequenceClipping()
+
+  def onLiveClippingModelNodeModified(self, observer, eventid):
+    if not self.liveClippingUpdateTimer.isActive():
+      self.liveClippingUpdateTimer.start()
+
+  def onLiveClippingUpdateTimer(self):
+    if self.clipTask:
+      # output volume is being updated by Apply, try again later
+      self.liveClippingUpdateTimer.start()
+      return
+    self.logic.updateSequenceClipping()
+
+  def setClipTaskInProgress(self, inProgress):
+    self.clipTaskProgress = 0.0
+    self.progressBar.value = 0
+    self.progressBar.visible = inProgress
+    self.cancelButton.visible = inProgress
+    self.cancelButton.enabled = inProgress
+    self.applyButton.text = "Working..." if inProgress else "Apply"
+    self.updateApplyButtonState()
 
 #
 # VolumeClipWithModelLogic
 #
 
-class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
+class VolumeClipWithModelLogic(ClipLogicMixin, ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
@@ -356,6 +664,27 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
   requiring an instance of the Widget
   """
 
+  def __init__(self, parent = None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    # Worker threads, progress reporting, cancellation and sequence clipping
+    ClipLogicMixin.__init__(self)
+    # Rasterized clipping models (and ROIs combined with models) are reused while the shape and the image geometry are unchanged
+    self.stencilCache = VolumeClipLib.StencilCache()
+    # Convex hull of the points that the model is generated from, updated incrementally. Key is the model node ID.
+    self.markupHulls = {}
+    # Number of subdivisions applied to the surface generated from markups
+    self.markupSurfaceSubdivisionLevel = 3
+    # Subdivision level of the current surface of each model generated from points
+    self.markupSurfaceSubdivisionLevels = {}
+    # Method of generating the surface from markup points: "convexHull" or "surfaceReconstruction"
+    self.markupSurfaceMode = "convexHull"
+    # Dense point sets are decimated to this number of points before surface reconstruction
+    # (fewer points are used for the coarse surface during interaction)
+    self.markupSurfaceReconstructionMaxNumberOfPoints = 5000
+    self.markupSurfaceReconstructionInteractiveMaxNumberOfPoints = 1000
+    # Logic of the VolumeClipWithRoi module, created when ROIs are used as clipping shapes
+    self.roiLogic = None
+
   def createParameterNode(self):
     # Set default parameters
     node = ScriptedLoadableModuleLogic.createParameterNode(self)
@@ -364,15 +693,486 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
     node.SetParameter("fillOutsideValue", "0")
     node.SetParameter("clipInsideSurface", "1")
     node.SetParameter("fillInsideValue", "255")
+    node.SetParameter("markupSurfaceMode", "convexHull")
+    node.SetParameter("clipSequence", "0")
+    node.SetParameter("liveUpdate", "0")
     return node
 
-  def clipVolumeWithModel(self, inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume):
+  def clipVolumeWithModel(self, inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume,
+    margin=0.0, featherWidth=0.0):
     """
-    Fill voxels of the input volume inside/outside the clipping model with the provided fill value
+    Fill voxels of the input volume inside/outside the clipping model with the provided fill value.
+    Stage timings are available in getLastClipResult(). Raises VolumeClipLib.ClipCancelledError
+    (and leaves the output volume unchanged) if cancel() is called during processing.
+    :param margin: the clipping surface is grown by this distance (in mm), shrunk if negative
+    :param featherWidth: width (in mm) of a linear transition between voxel and fill values, centered on the
+      (grown) clipping surface. Distance from the surface is only computed in a narrow band around the surface.
     """
+    return self.startClipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolume, margin, featherWidth).finish()
+
+  def startClipVolumeWithModel(self, inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume,
+    margin=0.0, featherWidth=0.0):
+    """
+    Prepare clipping of a volume (see clipVolumeWithModel) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask: call its runInBackground() method to process the voxels, then
+    call its finish() method on the main thread to update the output volume.
+    """
+    return VolumeClipLib.ClipTask(self.clipVolumeWithModelSteps(inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolume, margin, featherWidth))
+
+  def clipVolumeWithModelSteps(self, inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume,
+    margin=0.0, featherWidth=0.0):
+    with self.startOperation("clipVolumeWithModel") as operation:
+
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+
+      inputImageData = inputVolume.GetImageData()
+
+      # Get model in IJK coordinate system (if it has not been rasterized already, or it is needed
+      # for finding voxels near the surface)
+      stencilKey, stencil = self.getCachedModelStencil(clippingModel, inputImageData, ijkToRas, operation)
+      modelPolyDataInIjk = None
+      if stencil is None or margin or featherWidth:
+        modelPolyDataInIjk = self.transformModelToIjk(clippingModel, ijkToRas, operation)
+
+      # Process voxels (MRML nodes are not accessed until the next yield)
+      yield
+
+      # Convert model to stencil (the surface is rasterized only once, regardless of clipping options)
+      if stencil is None:
+        stencil = self.rasterizeModel(modelPolyDataInIjk, inputImageData, stencilKey, operation, operation.getProgressCallback(0.0, 0.5))
+
+      return (yield from self.clipVolumeWithStencilSteps(operation, inputVolume, inputImageData, ijkToRas, stencil,
+        clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume,
+        modelPolyDataInIjk if margin or featherWidth else None, margin, featherWidth))
+
+  def clipVolumeWithShapes(self, inputVolume, shapes, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume):
+    """
+    Fill voxels of the input volume inside/outside a combination of clipping models and ROIs.
+    :param shapes: list of (operation, node) pairs, where node is a model or ROI node and operation is
+      "union", "intersection", or "difference". Shapes are combined from left to right, starting from
+      an empty region, therefore the first operation is normally "union". For example,
+      [("union", model1), ("union", model2), ("difference", roi)] is inside if inside any of the models but not in the ROI.
+    Each shape is rasterized only once (or reused from the stencil cache) and the shapes are combined
+    as stencils, then the volume is filled in a single pass, regardless of the number of shapes.
+    """
+    return self.startClipVolumeWithShapes(inputVolume, shapes, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolume).finish()
+
+  def startClipVolumeWithShapes(self, inputVolume, shapes, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume):
+    """
+    Prepare clipping of a volume with multiple shapes (see clipVolumeWithShapes) so that voxels can be processed
+    on a background thread. Returns a VolumeClipLib.ClipTask (see startClipVolumeWithModel).
+    """
+    return VolumeClipLib.ClipTask(self.clipVolumeWithShapesSteps(inputVolume, shapes, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolume))
+
+  def clipVolumeWithShapesSteps(self, inputVolume, shapes, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume):
+    with self.startOperation("clipVolumeWithShapes") as operation:
+
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+
+      inputImageData = inputVolume.GetImageData()
+
+      # Get cached stencils and models in IJK coordinate system. ROIs are rasterized here, as it requires access
+      # to the ROI node (rasterization of a box is fast).
+      shapeInputs = []
+      for shapeOperation, shapeNode in shapes:
+        if shapeOperation not in VolumeClipLib.stencilOperations:
+          raise ValueError("clipVolumeWithShapes failed: invalid operation {0}".format(shapeOperation))
+        if shapeNode.IsA("vtkMRMLModelNode"):
+          stencilKey, stencil = self.getCachedModelStencil(shapeNode, inputImageData, ijkToRas, operation)
+          modelPolyDataInIjk = self.transformModelToIjk(shapeNode, ijkToRas, operation) if stencil is None else None
+          shapeInputs.append((shapeOperation, stencil, stencilKey, modelPolyDataInIjk))
+        else:
+          with operation.stage("rasterizeRoi") as stage:
+            stencil = self.getRoiLogic().createStencilFromRoi(shapeNode, inputImageData, ijkToRas, self.stencilCache)
+            stage["bytes"] = stencil.GetActualMemorySize() * 1024
+          shapeInputs.append((shapeOperation, stencil, None, None))
+
+      # Process voxels (MRML nodes are not accessed until the next yield)
+      yield
+
+      shapeStencils = []
+      for shapeIndex, (shapeOperation, stencil, stencilKey, modelPolyDataInIjk) in enumerate(shapeInputs):
+        if stencil is None:
+          stencil = self.rasterizeModel(modelPolyDataInIjk, inputImageData, stencilKey, operation,
+            operation.getProgressCallback(0.45 * shapeIndex / len(shapeInputs), 0.45 * (shapeIndex + 1) / len(shapeInputs)))
+        shapeStencils.append((shapeOperation, stencil))
+
+      # Combine the shapes, only the run-length encoded stencils are processed (not the voxels)
+      with operation.stage("combineStencils") as stage:
+        stencil = VolumeClipLib.combineStencils(shapeStencils, inputImageData.GetExtent(), inputImageData.GetSpacing(), inputImageData.GetOrigin())
+        stage["bytes"] = stencil.GetActualMemorySize() * 1024
+      operation.setProgress(0.5)
+
+      return (yield from self.clipVolumeWithStencilSteps(operation, inputVolume, inputImageData, ijkToRas, stencil,
+        clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume))
+
+  def clipVolumeWithStencilSteps(self, operation, inputVolume, inputImageData, ijkToRas, stencil,
+    clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume,
+    modelPolyDataInIjk=None, margin=0.0, featherWidth=0.0):
+    """Fill voxels of the input image inside/outside the stencil (on any thread), then update the output volume (on the main thread).
+    If modelPolyDataInIjk is specified then the stencil is grown by margin and feathered using distance from the stencil
+    boundary, computed near the model surface.
+    """
+    def fillVoxels(inputVoxels, outputVoxels=None):
+      return VolumeClipLib.clipVoxelsWithStencil(inputVoxels, VolumeClipLib.getNumpyMatrix(ijkToRas), stencil,
+        clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, modelPolyDataInIjk, margin, featherWidth,
+        inputImageData.GetExtent(), self.numberOfWorkerThreads, outputVoxels=outputVoxels,
+        progressCallback=operation.getProgressCallback(0.5, 0.95))
+
+    if outputVolume == inputVolume:
+      # Cumulative clipping: voxels are filled in the existing image of the volume. No image is allocated
+      # and only the filled voxels are written.
+      if clipOutsideSurface or clipInsideSurface:
+        # Filling in place cannot be cancelled, as it would leave the volume partially clipped
+        operation.setCancellable(False)
+        with operation.stage("fillVoxels") as stage:
+          inputVoxels = VolumeClipLib.getVoxelArray(inputImageData)
+          fillVoxels(inputVoxels, outputVoxels=inputVoxels)
+          stage["bytes"] = inputVoxels.nbytes
+        # Update the volume on the main thread
+        yield
+        with operation.stage("updateOutputVolume"):
+          self.notifyVoxelsModified(inputVolume)
+      operation.setProgress(1.0)
+      return True
+
+    # Compute the clipped image depending on user choices.
+    # Voxels are filled slab by slab on multiple threads, in a single pass (the input is read only once
+    # and the output is written only once).
+    with operation.stage("fillVoxels") as stage:
+      if clipOutsideSurface or clipInsideSurface:
+        outputVoxels = fillVoxels(VolumeClipLib.getVoxelArray(inputImageData))
+        # Output image refers to the numpy array, no copy is made
+        outputImageData = VolumeClipLib.createImageData(outputVoxels, inputImageData)
+      else:
+        # Nothing to clip, output is a copy of the input
+        outputImageData = vtk.vtkImageData()
+        outputImageData.DeepCopy(inputImageData)
+      stage["bytes"] = outputImageData.GetActualMemorySize() * 1024
+
+    # Update the output volume on the main thread
+    yield
 
-    # Determine the transform between the box and the image IJK coordinate systems
+    # The output volume is only modified if the operation was not cancelled
+    operation.setProgress(0.95)
+    operation.setCancellable(False)
+    with operation.stage("updateOutputVolume"):
+      self.updateOutputVolume(outputVolume, outputImageData, ijkToRas)
+    operation.setProgress(1.0)
 
+    return True
+
+  def clipVolumesWithModel(self, inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolumes):
+    """
+    Clip multiple volumes (for example, frames of a time sequence or multiple contrasts) with the same model.
+    The model is rasterized only once for each distinct image geometry, then the volumes are clipped concurrently,
+    using the number of threads set by setNumberOfWorkerThreads.
+    Returns a list that contains a dictionary for each input volume: "success" (bool),
+    "error" (error message or None), "processingTimeSec" (time spent with filling the voxels).
+    Output volumes that could not be computed are not modified.
+    If cancel() is called then VolumeClipLib.ClipCancelledError is raised and no output volumes are modified.
+    """
+    return self.startClipVolumesWithModel(inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolumes).finish()
+
+  def startClipVolumesWithModel(self, inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolumes):
+    """
+    Prepare clipping of multiple volumes (see clipVolumesWithModel) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask, see startClipVolumeWithModel.
+    """
+    if len(inputVolumes) != len(outputVolumes):
+      raise ValueError("clipVolumesWithModel failed: number of input and output volumes must be the same")
+    return VolumeClipLib.ClipTask(self.clipVolumesWithModelSteps(inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolumes))
+
+  def clipVolumesWithModelSteps(self, inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolumes):
+    with self.startOperation("clipVolumesWithModel") as operation:
+
+      # Rasterize the model for each distinct image geometry (on the main thread, as it accesses MRML nodes)
+      insideMasks = {}
+      clippingTasks = []
+      for volumeIndex, inputVolume in enumerate(inputVolumes):
+        ijkToRas = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix( ijkToRas )
+        imageData = inputVolume.GetImageData()
+        geometryKey = VolumeClipLib.getImageGeometryKey(imageData, ijkToRas)
+        if geometryKey not in insideMasks:
+          stencil = self.createStencilFromModel(clippingModel, imageData, ijkToRas, operation)
+          with operation.stage("convertStencilToMask") as stage:
+            insideMasks[geometryKey] = VolumeClipLib.getStencilMask(stencil, imageData.GetExtent())
+            stage["bytes"] = insideMasks[geometryKey].nbytes
+        clippingTasks.append((imageData, insideMasks[geometryKey]))
+        operation.setProgress(0.3 * (volumeIndex + 1) / len(inputVolumes))
+
+      # Fill voxels on worker threads (MRML nodes are not accessed until the next yield)
+      yield
+
+      def clipVoxels(clippingTask):
+        imageData, insideMask = clippingTask
+        inputVoxels = VolumeClipLib.getVoxelArray(imageData)
+        return VolumeClipLib.applyMask(inputVoxels, insideMask,
+          clipOutsideSurface, VolumeClipLib.castFillValue(fillOutsideValue, inputVoxels.dtype),
+          clipInsideSurface, VolumeClipLib.castFillValue(fillInsideValue, inputVoxels.dtype))
+      fillProgressCallback = operation.getProgressCallback(0.3, 0.95)
+      with operation.stage("fillVoxels") as stage:
+        taskResults = VolumeClipLib.processInParallel(clipVoxels, clippingTasks, self.numberOfWorkerThreads,
+          lambda numberOfCompletedVolumes, numberOfVolumes: fillProgressCallback(float(numberOfCompletedVolumes) / numberOfVolumes))
+        stage["bytes"] = sum(taskResult["result"].nbytes for taskResult in taskResults if taskResult["error"] is None)
+
+      # Update output volumes on the main thread
+      yield
+
+      operation.setCancellable(False)
+      results = []
+      with operation.stage("updateOutputVolume"):
+        for inputVolume, outputVolume, clippingTask, taskResult in zip(inputVolumes, outputVolumes, clippingTasks, taskResults):
+          if taskResult["error"] is None:
+            ijkToRas = vtk.vtkMatrix4x4()
+            inputVolume.GetIJKToRASMatrix( ijkToRas )
+            self.updateOutputVolume(outputVolume, VolumeClipLib.createImageData(taskResult["result"], clippingTask[0]), ijkToRas)
+          else:
+            logging.error("Failed to clip volume {0}: {1}".format(inputVolume.GetName(), taskResult["error"]))
+          results.append({
+            "success": taskResult["error"] is None,
+            "error": str(taskResult["error"]) if taskResult["error"] is not None else None,
+            "processingTimeSec": taskResult["processingTimeSec"],
+            })
+      operation.setProgress(1.0)
+
+    return results
+
+  def clipSequenceWithModel(self, inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+    outputSequence):
+    """
+    Clip all frames of a sequence (for example, 4D cine MR or CT perfusion) with the same model and store them
+    in the output sequence, with the index values of the input sequence. The model is rasterized once and shared
+    by all frames (see clipVolumesWithModel). Previous frames of the output sequence are removed.
+    The output sequence may be the same as the input sequence.
+    Returns a list that contains a dictionary for each frame (see clipVolumesWithModel), frames that could not be
+    clipped are left out from the output sequence.
+    """
+    return self.startClipSequenceWithModel(inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+      outputSequence).finish()
+
+  def startClipSequenceWithModel(self, inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+    outputSequence):
+    """
+    Prepare clipping of all frames of a sequence (see clipSequenceWithModel) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask, see startClipVolumeWithModel. The output sequence is updated by its finish() method.
+    """
+    return VolumeClipLib.ClipTask(self.clipSequenceWithModelSteps(inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputSequence))
+
+  def clipSequenceWithModelSteps(self, inputSequence, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+    outputSequence):
+    inputVolumes = [inputSequence.GetNthDataNode(frameIndex) for frameIndex in range(inputSequence.GetNumberOfDataNodes())]
+    outputVolumes = [slicer.vtkMRMLScalarVolumeNode() for inputVolume in inputVolumes]
+    results = yield from self.clipVolumesWithModelSteps(inputVolumes, clippingModel, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolumes)
+    VolumeClipLib.updateOutputSequence(outputSequence, inputSequence, inputVolumes, outputVolumes, results)
+    return results
+
+  def startSequenceClipping(self, clippingModel, sequenceBrowserNode, inputSequence, clipOutsideSurface, fillOutsideValue,
+    clipInsideSurface, fillInsideValue, outputVolume):
+    """
+    Show the clipped current frame of a browsed sequence in the output volume. Call updateSequenceClipping()
+    when the browser node is modified (a new frame is selected) or the model is changed.
+    The model is rasterized once for the whole sequence. Frames are clipped when they are first shown, while
+    the frames next to the current frame are clipped in advance on a background thread, so that clipped frames
+    can be played back at the acquisition frame rate. Clipped frames are kept in a frame cache, see
+    setFrameCacheMemoryBudget. The output volume refers to the cached voxels, therefore it must not be modified.
+    """
+    def getInsideMask(imageData, ijkToRas):
+      return VolumeClipLib.getStencilMask(self.createStencilFromModel(clippingModel, imageData, ijkToRas), imageData.GetExtent())
+    self.startSequenceClippingWithMask((clippingModel, sequenceBrowserNode, inputSequence, clipOutsideSurface, fillOutsideValue,
+      clipInsideSurface, fillInsideValue, outputVolume), self.getSequenceClippingShapeKey(clippingModel),
+      sequenceBrowserNode, inputSequence, outputVolume, getInsideMask, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue)
+
+  def getSequenceClippingShapeKey(self, clippingModel):
+    """Returns a hashable key that changes when the model surface or its transform is changed"""
+    return self.getModelKey(clippingModel)
+
+  def clipVolumeFileWithModel(self, inputImageFile, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+    outputFilePath, maxSlabSizeBytes=64*1024*1024):
+    """
+    Clip a volume stored in a file, without loading it into the scene. The input file is memory-mapped and
+    the model is rasterized and applied slab by slab, and the result is written into a NRRD file slab by slab,
+    therefore memory usage is limited by maxSlabSizeBytes, regardless of the image size.
+    :param inputImageFile: uncompressed NRRD or NIfTI file path, or VolumeClipLib.ImageFileInfo that describes a raw file
+    Raises ValueError if the input file cannot be memory-mapped. If cancel() is called then
+    VolumeClipLib.ClipCancelledError is raised and the incomplete output file is removed.
+    """
+    with self.startOperation("clipVolumeFileWithModel") as operation:
+      if isinstance(inputImageFile, VolumeClipLib.ImageFileInfo):
+        imageFileInfo = inputImageFile
+      else:
+        imageFileInfo = VolumeClipLib.readImageFileInfo(inputImageFile)
+      ijkToRas = VolumeClipLib.getVtkMatrix(imageFileInfo.ijkToRas)
+      with operation.stage("transformModel"):
+        modelPolyDataInIjk = self.getModelPolyDataInIjk(clippingModel, ijkToRas)
+
+      def fillSlab(slabVoxels, slabImageData):
+        if not clipOutsideSurface and not clipInsideSurface:
+          return
+        with operation.stage("rasterizeModel") as stage:
+          stencil = VolumeClipLib.rasterizePolyData(modelPolyDataInIjk, slabImageData, self.numberOfWorkerThreads)
+          stage["bytes"] = stencil.GetActualMemorySize() * 1024
+        with operation.stage("fillVoxels") as stage:
+          VolumeClipLib.clipVoxelsWithStencil(slabVoxels, imageFileInfo.ijkToRas, stencil,
+            clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue,
+            extent=slabImageData.GetExtent(), numberOfThreads=self.numberOfWorkerThreads, outputVoxels=slabVoxels)
+          stage["bytes"] = slabVoxels.nbytes
+
+      with operation.stage("clipFile") as stage:
+        VolumeClipLib.clipImageFile(imageFileInfo, outputFilePath, fillSlab, maxSlabSizeBytes, operation.setProgress)
+        stage["bytes"] = os.path.getsize(outputFilePath)
+
+    return True
+
+  def createMaskWithModel(self, inputVolume, clippingModel, outputNode, segmentName=None):
+    """
+    Store only the clipping mask instead of a clipped copy of the input volume: voxels inside the model are 1,
+    voxels outside are 0. The mask has the same geometry as the input volume, input voxels are not read.
+    :param outputNode: labelmap volume node (the mask is stored as an unsigned char image, 1 byte per voxel)
+      or segmentation node (the mask is stored in the segment named segmentName, which is added if it does not exist yet;
+      by default the name of the model is used)
+    """
+    with self.startOperation("createMaskWithModel") as operation:
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+      inputImageData = inputVolume.GetImageData()
+      stencil = self.createStencilFromModel(clippingModel, inputImageData, ijkToRas, operation, operation.getProgressCallback(0.0, 0.8))
+      with operation.stage("createMask") as stage:
+        maskVoxels = VolumeClipLib.getStencilMask(stencil, inputImageData.GetExtent()).view(np.uint8)
+        stage["bytes"] = maskVoxels.nbytes
+      operation.setProgress(0.9)
+      operation.setCancellable(False)
+      with operation.stage("updateOutputNode"):
+        self.updateMaskNode(outputNode, maskVoxels, inputVolume, segmentName if segmentName else clippingModel.GetName())
+      operation.setProgress(1.0)
+    return True
+
+  def writeMaskFileWithModel(self, inputVolume, clippingModel, maskFilePath):
+    """
+    Write the clipping mask of the input volume into a compact file (1 bit per voxel, compressed),
+    see VolumeClipLib.writeMaskFile. The mask can be applied later using clipVolumeWithMaskFile,
+    without rasterizing the model again.
+    """
+    with self.startOperation("writeMaskFileWithModel") as operation:
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+      inputImageData = inputVolume.GetImageData()
+      extent = inputImageData.GetExtent()
+      stencil = self.createStencilFromModel(clippingModel, inputImageData, ijkToRas, operation, operation.getProgressCallback(0.0, 0.8))
+      with operation.stage("packMask") as stage:
+        packedMask = VolumeClipLib.packMask(lambda slabExtent: VolumeClipLib.getStencilMask(stencil, slabExtent), extent)
+        stage["bytes"] = packedMask.nbytes
+      operation.setProgress(0.9)
+      with operation.stage("writeMaskFile") as stage:
+        VolumeClipLib.writeMaskFile(maskFilePath, packedMask, extent, VolumeClipLib.getNumpyMatrix(ijkToRas))
+        stage["bytes"] = os.path.getsize(maskFilePath)
+      operation.setProgress(1.0)
+    return True
+
+  def clipVolumeWithMaskFile(self, inputVolume, maskFilePath, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume):
+    """
+    Fill voxels of the input volume inside/outside a mask that was saved by writeMaskFileWithModel
+    (or by writeMaskFileWithRoi of the VolumeClipWithRoi module), without rasterizing the clipping shape again.
+    Raises ValueError if the mask was created for a volume with different geometry.
+    """
+    with self.startOperation("clipVolumeWithMaskFile") as operation:
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix( ijkToRas )
+      inputImageData = inputVolume.GetImageData()
+      with operation.stage("readMaskFile") as stage:
+        insideMask, maskExtent, maskIjkToRas = VolumeClipLib.readMaskFile(maskFilePath)
+        stage["bytes"] = insideMask.nbytes
+      if maskExtent != tuple(inputImageData.GetExtent()) or not np.allclose(maskIjkToRas, VolumeClipLib.getNumpyMatrix(ijkToRas)):
+        raise ValueError("clipVolumeWithMaskFile failed: geometry of the mask is different from the geometry of the input volume")
+      operation.setProgress(0.3)
+
+      inputVoxels = VolumeClipLib.getVoxelArray(inputImageData)
+      castedFillOutsideValue = VolumeClipLib.castFillValue(fillOutsideValue, inputVoxels.dtype)
+      castedFillInsideValue = VolumeClipLib.castFillValue(fillInsideValue, inputVoxels.dtype)
+      if outputVolume == inputVolume:
+        # Filling in place cannot be cancelled, as it would leave the volume partially clipped
+        operation.setCancellable(False)
+        with operation.stage("fillVoxels") as stage:
+          VolumeClipLib.fillMask(inputVoxels, insideMask, clipOutsideSurface, castedFillOutsideValue, clipInsideSurface, castedFillInsideValue)
+          stage["bytes"] = inputVoxels.nbytes
+        with operation.stage("updateOutputVolume"):
+          self.notifyVoxelsModified(inputVolume)
+      else:
+        with operation.stage("fillVoxels") as stage:
+          outputVoxels = VolumeClipLib.applyMask(inputVoxels, insideMask,
+            clipOutsideSurface, castedFillOutsideValue, clipInsideSurface, castedFillInsideValue)
+          stage["bytes"] = outputVoxels.nbytes
+        operation.setProgress(0.95)
+        operation.setCancellable(False)
+        with operation.stage("updateOutputVolume"):
+          self.updateOutputVolume(outputVolume, VolumeClipLib.createImageData(outputVoxels, inputImageData), ijkToRas)
+      operation.setProgress(1.0)
+    return True
+
+  def createStencilFromModel(self, clippingModel, imageData, ijkToRas, operation=None, progressCallback=None):
+    """
+    Rasterize the clipping model on the voxel grid of the image.
+    Returns a vtkImageStencilData that is non-zero inside the model.
+    The returned stencil may be shared with the stencil cache, therefore it must not be modified.
+    If a VolumeClipLib.ClipOperation is specified then stage timings are recorded in it.
+    """
+    if operation is None:
+      operation = VolumeClipLib.ClipOperation("createStencilFromModel")
+    stencilKey, stencil = self.getCachedModelStencil(clippingModel, imageData, ijkToRas, operation)
+    if stencil is not None:
+      return stencil
+    modelPolyDataInIjk = self.transformModelToIjk(clippingModel, ijkToRas, operation)
+    return self.rasterizeModel(modelPolyDataInIjk, imageData, stencilKey, operation, progressCallback)
+
+  def getCachedModelStencil(self, clippingModel, imageData, ijkToRas, operation):
+    """
+    Returns the stencil cache key of the model rasterized on the image, and the stencil if it is found in the cache
+    (None otherwise). The previously rasterized stencil is reused if the model and the image geometry are the same.
+    """
+    stencilKey = self.getModelKey(clippingModel) + (VolumeClipLib.getImageGeometryKey(imageData, ijkToRas),)
+    with operation.stage("getCachedStencil"):
+      stencil = self.stencilCache.get(stencilKey)
+    return stencilKey, stencil
+
+  def getModelKey(self, clippingModel):
+    """Returns a hashable key that changes when the model surface or its transform is changed"""
+    polyData = clippingModel.GetPolyData()
+    return ("model", clippingModel.GetID(), polyData.GetMTime() if polyData else 0,
+      VolumeClipLib.getMatrixKey(self.getRasToModelMatrix(clippingModel)))
+
+  def transformModelToIjk(self, clippingModel, ijkToRas, operation):
+    with operation.stage("transformModel") as stage:
+      modelPolyDataInIjk = self.getModelPolyDataInIjk(clippingModel, ijkToRas)
+      stage["bytes"] = modelPolyDataInIjk.GetActualMemorySize() * 1024
+    return modelPolyDataInIjk
+
+  def rasterizeModel(self, modelPolyDataInIjk, imageData, stencilKey, operation, progressCallback=None):
+    """Convert model to stencil and store it in the stencil cache. Does not access MRML nodes."""
+    # Slabs of the image are rasterized on multiple threads
+    with operation.stage("rasterizeModel") as stage:
+      stencil = VolumeClipLib.rasterizePolyData(modelPolyDataInIjk, imageData, self.numberOfWorkerThreads, progressCallback)
+      stage["bytes"] = stencil.GetActualMemorySize() * 1024
+    self.stencilCache.add(stencilKey, stencil)
+    return stencil
+
+  def getRoiLogic(self):
+    """Returns the logic of the VolumeClipWithRoi module, which is used for rasterizing ROI nodes"""
+    if self.roiLogic is None:
+      import VolumeClipWithRoi
+      self.roiLogic = VolumeClipWithRoi.VolumeClipWithRoiLogic()
+    return self.roiLogic
+
+  def getRasToModelMatrix(self, clippingModel):
+    """Returns the transform from world (RAS) coordinate system to the model coordinate system as vtkMatrix4x4"""
     rasToModel = vtk.vtkMatrix4x4()
     if clippingModel.GetTransformNodeID() != None:
       modelTransformNode = slicer.mrmlScene.GetNodeByID(clippingModel.GetTransformNodeID())
@@ -380,10 +1180,11 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
       modelTransformNode.GetMatrixTransformToWorld(boxToRas)
       rasToModel.DeepCopy(boxToRas)
       rasToModel.Invert()
+    return rasToModel
 
-    ijkToRas = vtk.vtkMatrix4x4()
-    inputVolume.GetIJKToRASMatrix( ijkToRas )
-
+  def getModelPolyDataInIjk(self, clippingModel, ijkToRas):
+    """Returns the clipping model surface transformed to the image IJK coordinate system"""
+    rasToModel = self.getRasToModelMatrix(clippingModel)
     ijkToModel = vtk.vtkMatrix4x4()
     vtk.vtkMatrix4x4.Multiply4x4(rasToModel,ijkToRas,ijkToModel)
     modelToIjkTransform = vtk.vtkTransform()
@@ -393,88 +1194,73 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
     transformModelToIjk=vtk.vtkTransformPolyDataFilter()
     transformModelToIjk.SetTransform(modelToIjkTransform)
     transformModelToIjk.SetInputConnection(clippingModel.GetPolyDataConnection())
+    transformModelToIjk.Update()
+    return transformModelToIjk.GetOutput()
 
-    # Use the stencil to fill the volume
-
-    # Convert model to stencil
-    polyToStencil = vtk.vtkPolyDataToImageStencil()
-    polyToStencil.SetInputConnection(transformModelToIjk.GetOutputPort())
-    polyToStencil.SetOutputSpacing(inputVolume.GetImageData().GetSpacing())
-    polyToStencil.SetOutputOrigin(inputVolume.GetImageData().GetOrigin())
-    polyToStencil.SetOutputWholeExtent(inputVolume.GetImageData().GetExtent())
-
-    # Apply the stencil to the volume
-    stencilToImage=vtk.vtkImageStencil()
-    stencilToImage.SetInputConnection(inputVolume.GetImageDataConnection())
-    stencilToImage.SetStencilConnection(polyToStencil.GetOutputPort())
-
-    # Create a copy of the input volume to work on
-    outputImageData = vtk.vtkImageData()
-    outputImageData.DeepCopy(inputVolume.GetImageData())
-    outputVolume.SetAndObserveImageData(outputImageData);
-    outputVolume.SetIJKToRASMatrix(ijkToRas)
-
-    # Update volume with the stencil operation result depending on user choices
-    if clipOutsideSurface:
-      stencilToImage.ReverseStencilOff()
-      stencilToImage.SetBackgroundValue(fillOutsideValue)
-      stencilToImage.Update()
-      outputImageData.DeepCopy(stencilToImage.GetOutput())
-      outputVolume.SetAndObserveImageData(outputImageData);
-      outputVolume.SetIJKToRASMatrix(ijkToRas)
-
-    if clipInsideSurface:
-      stencilToImage.SetInputConnection(outputVolume.GetImageDataConnection())
-      stencilToImage.ReverseStencilOn()
-      stencilToImage.SetBackgroundValue(fillInsideValue)
-      stencilToImage.Update()
-      outputImageData.DeepCopy(stencilToImage.GetOutput())
-      outputVolume.SetAndObserveImageData(outputImageData);
-      outputVolume.SetIJKToRASMatrix(ijkToRas)
-
-    # Add a default display node to output volume node if it does not exist yet
-    if not outputVolume.GetDisplayNode:
-      displayNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeDisplayNode")
-      displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeGrey")
-      outputVolume.SetAndObserveDisplayNodeID(displayNode.GetID())
+  def getStencilCacheStatistics(self):
+    """Returns hit/miss counters and memory usage of the stencil cache"""
+    return self.stencilCache.getStatistics()
 
-    return True
+  def updateModelFromMarkup(self, inputMarkup, outputModel, interactive=False):
+    """
+    Update model to enclose all points in the input markup list.
+    If interactive is True then a coarse (not subdivided) surface is generated, which is much faster
+    to compute and to rasterize. It is intended to be used while markup points are being dragged.
+    """
+    self.updateModelFromPoints(self.getMarkupPointsAsArray(inputMarkup), outputModel, interactive)
 
-  def updateModelFromMarkup(self, inputMarkup, outputModel):
+  def getMarkupPointsAsArray(self, inputMarkup):
     """
-    Update model to enclose all points in the input markup list
+    Returns positions of all markup points (in the markup node's coordinate system) as a numpy array (N x 3).
     """
+    if inputMarkup.GetTransformNodeID() is None and hasattr(inputMarkup, "GetControlPointPositionsWorld"):
+      # Get all points in one call, world coordinates are the same as node coordinates if there is no parent transform
+      points = vtk.vtkPoints()
+      points.SetDataTypeToDouble()
+      inputMarkup.GetControlPointPositionsWorld(points)
+      if points.GetNumberOfPoints() == 0:
+        return np.zeros([0, 3])
+      return numpy_support.vtk_to_numpy(points.GetData())
+    numberOfPoints = inputMarkup.GetNumberOfFiducials()
+    pointPositions = np.zeros([numberOfPoints, 3])
+    new_coord = [0.0, 0.0, 0.0]
+    for i in range(numberOfPoints):
+      inputMarkup.GetNthFiducialPosition(i,new_coord)
+      pointPositions[i] = new_coord
+    return pointPositions
 
-    # Delaunay triangulation is robust and creates nice smooth surfaces from a small number of points,
-    # however it can only generate convex surfaces robustly.
-    useDelaunay = True
+  def updateModelFromPoints(self, pointPositions, outputModel, interactive=False):
+    """
+    Update model to enclose all points (N x 3 numpy array). Points are passed to VTK without copying them,
+    so this method can be used with large point clouds (for example, acquired by a tracked stylus).
+    If interactive is True then a coarse (not subdivided) surface is generated.
+    The surface is the convex hull of the points or it is reconstructed from the points, see setMarkupSurfaceMode.
+    """
 
-    # Create polydata point set from markup points
+    # Create polydata point set from the points
 
-    points = vtk.vtkPoints()
-    cellArray = vtk.vtkCellArray()
+    pointPositions = np.ascontiguousarray(pointPositions, dtype=np.float64).reshape(-1, 3)
+    numberOfPoints = pointPositions.shape[0]
 
-    numberOfPoints = inputMarkup.GetNumberOfFiducials()
+    # Delaunay triangulation is robust and creates nice smooth surfaces from a small number of points,
+    # however it can only generate convex surfaces robustly. Surface reconstruction can generate concave
+    # surfaces, but it needs dense point sets.
+    useDelaunay = (self.markupSurfaceMode == "convexHull"
+      or numberOfPoints < VolumeClipLib.minimumNumberOfReconstructionPoints)
 
     # Surface generation algorithms behave unpredictably when there are not enough points
     # return if there are very few points
-    if useDelaunay:
-      if numberOfPoints<3:
-        return
-    else:
-      if numberOfPoints<10:
-        return
-
-    points.SetNumberOfPoints(numberOfPoints)
-    new_coord = [0.0, 0.0, 0.0]
+    if numberOfPoints<3:
+      return
 
-    for i in range(numberOfPoints):
-      inputMarkup.GetNthFiducialPosition(i,new_coord)
-      points.SetPoint(i, new_coord)
+    # VTK array refers to the numpy array memory (it also keeps a reference to the numpy array)
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(pointPositions, deep=False))
 
-    cellArray.InsertNextCell(numberOfPoints)
-    for i in range(numberOfPoints):
-      cellArray.InsertCellPoint(i)
+    # Single polyline cell connecting all the points, in legacy cell array format: [n, 0, 1, ..., n-1]
+    cellArray = vtk.vtkCellArray()
+    cellArray.SetCells(1, numpy_support.numpy_to_vtkIdTypeArray(
+      np.concatenate(([numberOfPoints], np.arange(numberOfPoints))).astype(numpy_support.ID_TYPE_CODE), deep=True))
 
     pointPolyData = vtk.vtkPolyData()
     pointPolyData.SetLines(cellArray)
@@ -485,39 +1271,69 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 
     if useDelaunay:
 
-      delaunay = vtk.vtkDelaunay3D()
-      delaunay.SetInputData(pointPolyData)
+      # The surface of the Delaunay triangulation is the convex hull of the points. The hull is updated
+      # incrementally: only facets affected by added/moved/removed points are recomputed.
+      hullKey = outputModel.GetID()
+      hull = self.markupHulls.get(hullKey)
+      if hull is None:
+        hull = VolumeClipLib.ConvexHull()
+        self.markupHulls[hullKey] = hull
+        hullChanged = hull.setPoints(pointPositions.tolist())
+      else:
+        hullChanged = hull.update(pointPositions.tolist())
+
+      # Subdivision multiplies the number of triangles by 4 at each level, therefore it is skipped
+      # during interactive editing and only the coarse hull is shown.
+      subdivisionLevel = 0 if interactive else self.markupSurfaceSubdivisionLevel
+
+      if hull.isValid():
+        currentSubdivisionLevel = self.markupSurfaceSubdivisionLevels.get(hullKey)
+        if (not hullChanged and currentSubdivisionLevel is not None and currentSubdivisionLevel >= subdivisionLevel
+          and outputModel.GetPolyData()):
+          # Hull is not changed (e.g., an interior point is moved) and the current surface is at least as fine
+          # as requested (e.g., full-quality surface during interactive editing), no need to regenerate the surface
+          return
+        hullPolys = vtk.vtkCellArray()
+        for triangle in hull.getTriangles():
+          hullPolys.InsertNextCell(3, triangle)
+        hullPolyData = vtk.vtkPolyData()
+        hullPolyData.SetPoints(points)
+        hullPolyData.SetPolys(hullPolys)
+        surfaceFilter = vtk.vtkTrivialProducer()
+        surfaceFilter.SetOutput(hullPolyData)
+      else:
+        # Points are coplanar, hull cannot be computed
+        delaunay = vtk.vtkDelaunay3D()
+        delaunay.SetInputData(pointPolyData)
 
-      surfaceFilter = vtk.vtkDataSetSurfaceFilter()
-      surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+        surfaceFilter = vtk.vtkDataSetSurfaceFilter()
+        surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
 
-      smoother = vtk.vtkButterflySubdivisionFilter()
-      smoother.SetInputConnection(surfaceFilter.GetOutputPort())
-      smoother.SetNumberOfSubdivisions(3)
-      smoother.Update()
+      self.markupSurfaceSubdivisionLevels[hullKey] = subdivisionLevel
 
-      outputModel.SetPolyDataConnection(smoother.GetOutputPort())
+      if subdivisionLevel > 0:
+        smoother = vtk.vtkButterflySubdivisionFilter()
+        smoother.SetInputConnection(surfaceFilter.GetOutputPort())
+        smoother.SetNumberOfSubdivisions(subdivisionLevel)
+        smoother.Update()
+        outputModel.SetPolyDataConnection(smoother.GetOutputPort())
+      else:
+        surfaceFilter.Update()
+        outputModel.SetPolyDataConnection(surfaceFilter.GetOutputPort())
 
     else:
 
-      surf = vtk.vtkSurfaceReconstructionFilter()
-      surf.SetInputData(pointPolyData)
-      surf.SetNeighborhoodSize(20)
-      surf.SetSampleSpacing(80) # lower value follows the small details more closely but more dense pointset is needed as input
-
-      cf = vtk.vtkContourFilter()
-      cf.SetInputConnection(surf.GetOutputPort())
-      cf.SetValue(0, 0.0)
-
-      # Sometimes the contouring algorithm can create a volume whose gradient
-      # vector and ordering of polygon (using the right hand rule) are
-      # inconsistent. vtkReverseSense cures this problem.
-      reverse = vtk.vtkReverseSense()
-      reverse.SetInputConnection(cf.GetOutputPort())
-      reverse.ReverseCellsOff()
-      reverse.ReverseNormalsOff()
+      # Dense point sets are decimated and the sample spacing is chosen from the point density,
+      # therefore reconstruction time is bounded, regardless of the number of points
+      maxNumberOfPoints = (self.markupSurfaceReconstructionInteractiveMaxNumberOfPoints if interactive
+        else self.markupSurfaceReconstructionMaxNumberOfPoints)
+      outputModel.SetAndObservePolyData(VolumeClipLib.reconstructSurface(pointPositions, maxNumberOfPoints))
 
-      outputModel.SetPolyDataConnection(reverse.GetOutputPort())
+      # Hull is recomputed if the mode is changed back to convex hull. Reconstructed surfaces are not subdivided,
+      # but the subdivision level is recorded to indicate if the surface is coarse.
+      hullKey = outputModel.GetID()
+      self.markupHulls.pop(hullKey, None)
+      self.markupSurfaceSubdivisionLevels[hullKey] = 0 if interactive else self.markupSurfaceSubdivisionLevel
 
     # Create default model display node if does not exist yet
     if not outputModel.GetDisplayNode():
@@ -538,25 +1354,33 @@ class VolumeClipWithModelLogic(ScriptedLoadableModuleLogic):
 
     outputModel.Modified()
 
-  def showInSliceViewers(self, volumeNode, sliceWidgetNames):
-    # Displays volumeNode in the selected slice viewers as background volume
-    # Existing background volume is pushed to foreground, existing foreground volume will not be shown anymore
-    # sliceWidgetNames is a list of slice view names, such as ["Yellow", "Green"]
-    if not volumeNode:
-      return
-    newVolumeNodeID = volumeNode.GetID()
-    for sliceWidgetName in sliceWidgetNames:
-      sliceLogic = slicer.app.layoutManager().sliceWidget(sliceWidgetName).sliceLogic()
-      foregroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetForegroundVolumeID()
-      backgroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetBackgroundVolumeID()
-      if foregroundVolumeNodeID == newVolumeNodeID or backgroundVolumeNodeID == newVolumeNodeID:
-        # new volume is already shown as foreground or background
-        continue
-      if backgroundVolumeNodeID:
-        # there is a background volume, push it to the foreground because we will replace the background volume
-        sliceLogic.GetSliceCompositeNode().SetForegroundVolumeID(backgroundVolumeNodeID)
-      # show the new volume as background
-      sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(newVolumeNodeID)
+  def setMarkupSurfaceSubdivisionLevel(self, subdivisionLevel):
+    """Set number of butterfly subdivisions of the full-quality surface generated from markups (0 = no subdivision)"""
+    self.markupSurfaceSubdivisionLevel = subdivisionLevel
+    # Surfaces are regenerated at the next update, even if they are finer than the new subdivision level
+    self.markupSurfaceSubdivisionLevels.clear()
+
+  def getMarkupSurfaceSubdivisionLevel(self):
+    return self.markupSurfaceSubdivisionLevel
+
+  def setMarkupSurfaceMode(self, mode):
+    """
+    Set method of generating the surface from markup points: "convexHull" (default, robust for a few points,
+    always convex) or "surfaceReconstruction" (for dense point sets, such as 10k-1M points acquired by
+    a surface scanner or a tracked stylus; the surface may be concave). If there are less than 10 points
+    then the convex hull is used.
+    """
+    if mode not in ["convexHull", "surfaceReconstruction"]:
+      raise ValueError("setMarkupSurfaceMode failed: invalid mode {0}".format(mode))
+    self.markupSurfaceMode = mode
+
+  def getMarkupSurfaceMode(self):
+    return self.markupSurfaceMode
+
+  def isMarkupSurfaceCoarse(self, outputModel):
+    """Returns True if the model was last generated from points in interactive (coarse) mode"""
+    subdivisionLevel = self.markupSurfaceSubdivisionLevels.get(outputModel.GetID())
+    return subdivisionLevel is not None and subdivisionLevel < self.markupSurfaceSubdivisionLevel
 
 class VolumeClipWithModelTest(ScriptedLoadableModuleTest):
   """
@@ -573,6 +1397,48 @@ class VolumeClipWithModelTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_VolumeClipWithModel1()
+    self.setUp()
+    self.test_VolumeClipWithModelSinglePassFill()
+    self.setUp()
+    self.test_VolumeClipWithModelInPlace()
+    self.setUp()
+    self.test_VolumeClipWithModelBoundingBox()
+    self.setUp()
+    self.test_VolumeClipWithModelCore()
+    self.setUp()
+    self.test_VolumeClipWithModelMultipleVolumes()
+    self.setUp()
+    self.test_VolumeClipWithModelSequence()
+    self.setUp()
+    self.test_VolumeClipWithModelFile()
+    self.setUp()
+    self.test_VolumeClipWithModelMaskFile()
+    self.setUp()
+    self.test_VolumeClipWithModelShapes()
+    self.setUp()
+    self.test_VolumeClipWithModelMargin()
+    self.setUp()
+    self.test_VolumeClipWithModelSurfaceReconstruction()
+
+  def createSyntheticVolume(self, dtype=np.int16):
+    """Returns a volume with non-uniform spacing and voxel values that vary along all axes"""
+    inputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    inputVolume.SetSpacing(0.8, 0.9, 1.5)
+    inputVolume.SetOrigin(-20, -30, 10)
+    slicer.util.updateVolumeFromArray(inputVolume, np.arange(40*50*60).reshape(40, 50, 60).astype(dtype))
+    return inputVolume
+
+  def createSphereModel(self, center=(3, -8, 40), radius=18):
+    """Returns a model node of a closed sphere surface that partially covers the synthetic volume"""
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(center)
+    sphere.SetRadius(radius)
+    sphere.SetPhiResolution(30)
+    sphere.SetThetaResolution(30)
+    sphere.Update()
+    clippingModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+    clippingModel.SetAndObservePolyData(sphere.GetOutput())
+    return clippingModel
 
   def test_VolumeClipWithModel1(self):
 
@@ -612,3 +1478,366 @@ class VolumeClipWithModelTest(ScriptedLoadableModuleTest):
     logic.showInSliceViewers(outputVolume, ["Red", "Yellow", "Green"])
 
     self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelSinglePassFill(self):
+    """Single-pass fill must give the same result as filling outside and then inside with two vtkImageStencil passes"""
+
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    # Fill values are fractional and out of range for some voxel types to test casting to the voxel type
+    fillOutsideValue = -3.6
+    fillInsideValue = 300.4
+
+    for dtype in [np.int16, np.uint8, np.uint16, np.int32, np.float32, np.float64]:
+      inputVolume = self.createSyntheticVolume(dtype)
+      ijkToRas = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix(ijkToRas)
+      imageData = inputVolume.GetImageData()
+      polyToStencil = vtk.vtkPolyDataToImageStencil()
+      polyToStencil.SetInputData(logic.getModelPolyDataInIjk(clippingModel, ijkToRas))
+      polyToStencil.SetOutputSpacing(imageData.GetSpacing())
+      polyToStencil.SetOutputOrigin(imageData.GetOrigin())
+      polyToStencil.SetOutputWholeExtent(imageData.GetExtent())
+      polyToStencil.Update()
+
+      for clipOutsideSurface, clipInsideSurface in [(True, False), (False, True), (True, True)]:
+        expectedImageData = imageData
+        for fillEnabled, reverseStencil, fillValue in [(clipOutsideSurface, False, fillOutsideValue), (clipInsideSurface, True, fillInsideValue)]:
+          if not fillEnabled:
+            continue
+          stencilToImage = vtk.vtkImageStencil()
+          stencilToImage.SetInputData(expectedImageData)
+          stencilToImage.SetStencilData(polyToStencil.GetOutput())
+          stencilToImage.SetReverseStencil(reverseStencil)
+          stencilToImage.SetBackgroundValue(fillValue)
+          stencilToImage.Update()
+          expectedImageData = stencilToImage.GetOutput()
+
+        logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillOutsideValue, clipInsideSurface, fillInsideValue, outputVolume)
+        outputVoxels = slicer.util.arrayFromVolume(outputVolume)
+        self.assertEqual(outputVoxels.dtype, np.dtype(dtype))
+        self.assertTrue(np.array_equal(outputVoxels, VolumeClipLib.getVoxelArray(expectedImageData)))
+
+    # Default display node is added to the output volume
+    self.assertIsNotNone(outputVolume.GetDisplayNode())
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelInPlace(self):
+    """In-place clipping must give the same result as clipping into another volume, without replacing the image of the volume"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    fillValue = -7
+
+    for clipOutsideSurface, clipInsideSurface in [(True, False), (False, True), (True, True)]:
+      expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillValue, clipInsideSurface, fillValue + 1, expectedVolume)
+      inputImageData = inputVolume.GetImageData()
+      logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, fillValue, clipInsideSurface, fillValue + 1, inputVolume)
+      self.assertEqual(inputVolume.GetImageData(), inputImageData)
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(inputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelBoundingBox(self):
+    """Only the bounding box of the model is rasterized, the mask must be the same as rasterizing the whole image"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    imageData = inputVolume.GetImageData()
+    stencil = logic.createStencilFromModel(clippingModel, imageData, ijkToRas)
+    polyToStencil = vtk.vtkPolyDataToImageStencil()
+    polyToStencil.SetInputData(logic.getModelPolyDataInIjk(clippingModel, ijkToRas))
+    polyToStencil.SetOutputSpacing(imageData.GetSpacing())
+    polyToStencil.SetOutputOrigin(imageData.GetOrigin())
+    polyToStencil.SetOutputWholeExtent(imageData.GetExtent())
+    polyToStencil.Update()
+    mask = VolumeClipLib.getStencilMask(stencil, imageData.GetExtent())
+    self.assertTrue(mask.any())
+    self.assertTrue(np.array_equal(mask, VolumeClipLib.getStencilMask(polyToStencil.GetOutput(), imageData.GetExtent())))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelCore(self):
+    """Clipping core works on numpy arrays (vertices and faces of the model in RAS), without MRML nodes"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, 0, True, 255, outputVolume)
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    vertices, faces = VolumeClipLib.getSurfaceArrays(clippingModel.GetPolyData())
+    coreVoxels = VolumeClipLib.clipVoxelsWithSurface(slicer.util.arrayFromVolume(inputVolume), VolumeClipLib.getNumpyMatrix(ijkToRas),
+      vertices, faces, True, 0, True, 255)
+    # (voxels whose center is exactly on the surface may differ due to rounding of the transformed points)
+    self.assertTrue(np.count_nonzero(coreVoxels != slicer.util.arrayFromVolume(outputVolume)) < 0.001 * coreVoxels.size)
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelMultipleVolumes(self):
+    """Model is rasterized once for each image geometry, failures are reported for each volume, cancelling modifies no outputs"""
+
+    clippingModel = self.createSphereModel()
+    # Two volumes with the same geometry (different voxel types), one with different spacing
+    inputVolumes = [self.createSyntheticVolume(), self.createSyntheticVolume(np.float32), self.createSyntheticVolume()]
+    inputVolumes[2].SetSpacing(1.0, 1.2, 1.0)
+    # Volume that has the same geometry as the first volume but its voxels cannot be read (too few scalars)
+    failingImageData = vtk.vtkImageData()
+    failingImageData.DeepCopy(inputVolumes[0].GetImageData())
+    failingScalars = vtk.vtkShortArray()
+    failingScalars.SetNumberOfTuples(10)
+    failingImageData.GetPointData().SetScalars(failingScalars)
+    failingVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    failingVolume.SetSpacing(0.8, 0.9, 1.5)
+    failingVolume.SetOrigin(-20, -30, 10)
+    failingVolume.SetAndObserveImageData(failingImageData)
+    inputVolumes.append(failingVolume)
+    outputVolumes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode") for inputVolume in inputVolumes]
+
+    logic = VolumeClipWithModelLogic()
+    results = logic.clipVolumesWithModel(inputVolumes, clippingModel, True, 0, True, 255, outputVolumes)
+    self.assertEqual(logic.getStencilCacheStatistics()["misses"], 2)
+    self.assertEqual([result["success"] for result in results], [True, True, True, False])
+    self.assertIsNone(results[0]["error"])
+    self.assertIsNotNone(results[3]["error"])
+    self.assertIsNone(outputVolumes[3].GetImageData())
+
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    for inputVolume, outputVolume in zip(inputVolumes[:3], outputVolumes[:3]):
+      VolumeClipWithModelLogic().clipVolumeWithModel(inputVolume, clippingModel, True, 0, True, 255, expectedVolume)
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    # Cancel while voxels are filled
+    outputImages = [outputVolume.GetImageData() for outputVolume in outputVolumes]
+    outputVoxels = [slicer.util.arrayFromVolume(outputVolume).copy() for outputVolume in outputVolumes[:3]]
+    logic.setProgressCallback(lambda operationName, progress, stageName: logic.cancel() if stageName == "fillVoxels" else None)
+    with self.assertRaises(VolumeClipLib.ClipCancelledError):
+      logic.clipVolumesWithModel(inputVolumes[:3], clippingModel, True, 10, True, 20, outputVolumes[:3])
+    logic.setProgressCallback(None)
+    self.assertTrue(logic.getLastClipResult().cancelled)
+    self.assertEqual([outputVolume.GetImageData() for outputVolume in outputVolumes], outputImages)
+    for outputVolume, voxels in zip(outputVolumes[:3], outputVoxels):
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), voxels))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelSequence(self):
+    """Frames of a sequence are clipped with the shared model mask, at once, on a background thread, and while browsing"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    inputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    for frameIndex in range(3):
+      inputSequence.SetDataNodeAtValue(inputVolume, str(frameIndex))
+      slicer.util.arrayFromVolume(inputSequence.GetNthDataNode(frameIndex))[:] += frameIndex
+
+    logic = VolumeClipWithModelLogic()
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    expectedFrames = []
+    for frameIndex in range(3):
+      VolumeClipWithModelLogic().clipVolumeWithModel(inputSequence.GetNthDataNode(frameIndex), clippingModel, True, -7, True, 300, expectedVolume)
+      expectedFrames.append(slicer.util.arrayFromVolume(expectedVolume).copy())
+
+    outputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    logic.clipSequenceWithModel(inputSequence, clippingModel, True, -7, True, 300, outputSequence)
+    self.assertEqual(outputSequence.GetNumberOfDataNodes(), 3)
+    for frameIndex in range(3):
+      self.assertEqual(outputSequence.GetNthIndexValue(frameIndex), str(frameIndex))
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputSequence.GetNthDataNode(frameIndex)), expectedFrames[frameIndex]))
+
+    # Frames are clipped on a background thread, the output sequence is updated when the task is finished
+    backgroundOutputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    clipTask = logic.startClipSequenceWithModel(inputSequence, clippingModel, True, -7, True, 300, backgroundOutputSequence)
+    clipTask.runInBackground()
+    self.assertEqual(len(clipTask.finish()), 3)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(backgroundOutputSequence.GetNthDataNode(2)), expectedFrames[2]))
+    # Output sequence is not modified if clipping is cancelled
+    clipTask = logic.startClipSequenceWithModel(inputSequence, clippingModel, True, 0, True, 0, backgroundOutputSequence)
+    logic.cancel()
+    clipTask.runInBackground()
+    with self.assertRaises(VolumeClipLib.ClipCancelledError):
+      clipTask.finish()
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(backgroundOutputSequence.GetNthDataNode(2)), expectedFrames[2]))
+
+    sequenceBrowserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+    sequenceBrowserNode.SetAndObserveMasterSequenceNodeID(inputSequence.GetID())
+    sequenceBrowserNode.SetSelectedItemNumber(1)
+    sequenceOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.startSequenceClipping(clippingModel, sequenceBrowserNode, inputSequence, True, -7, True, 300, sequenceOutputVolume)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(sequenceOutputVolume), expectedFrames[1]))
+    # Output volume is updated by this logic, the ROI logic is not needed for sequence clipping
+    self.assertIsNone(logic.roiLogic)
+    self.assertIsNotNone(sequenceOutputVolume.GetDisplayNode())
+    # Next frame is clipped in advance, it is not clipped again when it is selected
+    sequenceBrowserNode.SetSelectedItemNumber(2)
+    self.assertTrue(logic.updateSequenceClipping())
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(sequenceOutputVolume), expectedFrames[2]))
+    self.assertEqual(logic.getFrameCacheStatistics()["misses"], 1)
+    self.assertFalse(logic.updateSequenceClipping())
+
+    # Frames are clipped again when the model is changed
+    movedSphere = vtk.vtkSphereSource()
+    movedSphere.SetCenter(0, -5, 35)
+    movedSphere.SetRadius(12)
+    movedSphere.Update()
+    clippingModel.SetAndObservePolyData(movedSphere.GetOutput())
+    self.assertTrue(logic.updateSequenceClipping())
+    VolumeClipWithModelLogic().clipVolumeWithModel(inputSequence.GetNthDataNode(2), clippingModel, True, -7, True, 300, expectedVolume)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(sequenceOutputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+    logic.stopSequenceClipping()
+    self.assertIsNone(logic.getFrameCacheStatistics())
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelFile(self):
+    """Clipping a volume file slab by slab must give the same result as clipping the loaded volume"""
+
+    self.delayDisplay("Creating synthetic volume file")
+    inputVolume = self.createSyntheticVolume()
+    inputFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithModelFileInput.nrrd")
+    outputFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithModelFileOutput.nrrd")
+    slicer.util.saveNode(inputVolume, inputFilePath, {"useCompression": False})
+
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, -7, True, 300, expectedVolume)
+
+    self.delayDisplay("Clipping volume file")
+    # Use small slabs to test processing of multiple slabs
+    logic.clipVolumeFileWithModel(inputFilePath, clippingModel, True, -7, True, 300, outputFilePath, maxSlabSizeBytes=50*60*2*7)
+    outputVolume = slicer.util.loadVolume(outputFilePath)
+
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+    outputIjkToRas = vtk.vtkMatrix4x4()
+    outputVolume.GetIJKToRASMatrix(outputIjkToRas)
+    expectedIjkToRas = vtk.vtkMatrix4x4()
+    expectedVolume.GetIJKToRASMatrix(expectedIjkToRas)
+    self.assertTrue(np.allclose(VolumeClipLib.getNumpyMatrix(outputIjkToRas), VolumeClipLib.getNumpyMatrix(expectedIjkToRas)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelMaskFile(self):
+    """Mask stored in a node or in a file must give the same result as clipping with the model"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    clippingModel.SetName("Sphere")
+    logic = VolumeClipWithModelLogic()
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    expectedMask = VolumeClipLib.getStencilMask(logic.createStencilFromModel(clippingModel, inputVolume.GetImageData(), ijkToRas),
+      inputVolume.GetImageData().GetExtent())
+
+    # Mask in a labelmap volume and in a segment
+    maskVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    self.assertTrue(logic.createMaskWithModel(inputVolume, clippingModel, maskVolume))
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(maskVolume), expectedMask.view(np.uint8)))
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    self.assertTrue(logic.createMaskWithModel(inputVolume, clippingModel, segmentationNode))
+    segmentId = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("Sphere")
+    self.assertTrue(segmentId)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentId, inputVolume) != 0, expectedMask))
+
+    # Mask in a file
+    maskFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithModelTestMask.npz")
+    self.assertTrue(logic.writeMaskFileWithModel(inputVolume, clippingModel, maskFilePath))
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    for clipOutsideSurface, clipInsideSurface in [(True, False), (False, True), (True, True)]:
+      logic.clipVolumeWithModel(inputVolume, clippingModel, clipOutsideSurface, -7, clipInsideSurface, 300, expectedVolume)
+      self.assertTrue(logic.clipVolumeWithMaskFile(inputVolume, maskFilePath, clipOutsideSurface, -7, clipInsideSurface, 300, outputVolume))
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    # Mask cannot be applied to a volume with different geometry
+    shiftedVolume = self.createSyntheticVolume()
+    shiftedVolume.SetOrigin(-20, -30, 11)
+    with self.assertRaises(ValueError):
+      logic.clipVolumeWithMaskFile(shiftedVolume, maskFilePath, True, -7, False, 0, outputVolume)
+    resizedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    resizedVolume.SetSpacing(0.8, 0.9, 1.5)
+    resizedVolume.SetOrigin(-20, -30, 10)
+    slicer.util.updateVolumeFromArray(resizedVolume, np.zeros((40, 50, 61), dtype=np.int16))
+    with self.assertRaises(ValueError):
+      logic.clipVolumeWithMaskFile(resizedVolume, maskFilePath, True, -7, False, 0, outputVolume)
+    # Output volume is not modified if the mask cannot be applied
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+    os.remove(maskFilePath)
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelShapes(self):
+    """Union of a single model is the same as the model, difference of a model and itself is empty (all voxels are outside),
+    ROI stencils are cached"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, 0, True, 255, outputVolume)
+
+    shapesOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithShapes(inputVolume, [("union", clippingModel)], True, 0, True, 255, shapesOutputVolume)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(shapesOutputVolume), slicer.util.arrayFromVolume(outputVolume)))
+    logic.clipVolumeWithShapes(inputVolume, [("union", clippingModel), ("difference", clippingModel)], True, 0, True, 255, shapesOutputVolume)
+    self.assertTrue((slicer.util.arrayFromVolume(shapesOutputVolume) == 0).all())
+
+    # ROIs combined with models are rasterized once and then reused from the stencil cache of this logic
+    roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+    roiNode.SetCenter(0, -5, 35)
+    roiNode.SetSize(30, 20, 25)
+    statistics = logic.getStencilCacheStatistics()
+    for repeatIndex in range(2):
+      logic.clipVolumeWithShapes(inputVolume, [("union", clippingModel), ("intersection", roiNode)], True, 0, True, 255, shapesOutputVolume)
+    self.assertEqual(logic.getStencilCacheStatistics()["misses"], statistics["misses"] + 1)
+    self.assertEqual(logic.getStencilCacheStatistics()["hits"], statistics["hits"] + 3)
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelMargin(self):
+    """Margin grows the surface (less voxels are filled outside), feathering blends voxel and fill values"""
+
+    inputVolume = self.createSyntheticVolume()
+    clippingModel = self.createSphereModel()
+    logic = VolumeClipWithModelLogic()
+    fillValue = -7
+    inputVoxels = slicer.util.arrayFromVolume(inputVolume)
+
+    marginOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, fillValue, False, fillValue, marginOutputVolume, margin=5.0)
+    marginFilled = slicer.util.arrayFromVolume(marginOutputVolume) != inputVoxels
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, fillValue, False, fillValue, marginOutputVolume)
+    filled = slicer.util.arrayFromVolume(marginOutputVolume) != inputVoxels
+    self.assertTrue(marginFilled.sum() < filled.sum())
+    self.assertFalse((marginFilled & ~filled).any())
+
+    logic.clipVolumeWithModel(inputVolume, clippingModel, True, fillValue, False, fillValue, marginOutputVolume, featherWidth=10.0)
+    blendedVoxels = slicer.util.arrayFromVolume(marginOutputVolume)
+    self.assertTrue(((blendedVoxels != inputVoxels) & (blendedVoxels != fillValue)).any())
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithModelSurfaceReconstruction(self):
+    """Points of a dense point set (sphere surface) are decimated and the reconstructed surface is approximately the sphere"""
+
+    logic = VolumeClipWithModelLogic()
+    randomDirections = np.random.RandomState(0).normal(size=(100000, 3))
+    spherePoints = 40.0 * randomDirections / np.linalg.norm(randomDirections, axis=1)[:, np.newaxis]
+    reconstructedModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLModelNode")
+    logic.setMarkupSurfaceMode("surfaceReconstruction")
+    logic.updateModelFromPoints(spherePoints, reconstructedModel)
+    reconstructedPoints = slicer.util.arrayFromModelPoints(reconstructedModel)
+    self.assertTrue(len(reconstructedPoints) > 0)
+    self.assertTrue(np.allclose(np.linalg.norm(reconstructedPoints, axis=1), 40.0, atol=4.0))
+
+    self.delayDisplay("Test passed!")
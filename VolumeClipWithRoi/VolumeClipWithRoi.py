@@ -1,8 +1,12 @@
+import logging
 import os
 import string
 import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+import numpy as np
+import VolumeClipLib
+from VolumeClipLib.ClipLogic import ClipLogicMixin
 
 #
 # VolumeClipWithRoi
@@ -35,6 +39,23 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     ScriptedLoadableModuleWidget.__init__(self, parent)
     self.logic = VolumeClipWithRoiLogic()
     self.parameterNode = None
+    # Clipping runs on a background thread, its completion is checked periodically
+    self.clipTask = None
+    self.clipTaskOutputVolume = None
+    # Sequence browser that shows the output volume, if all frames of a sequence are clipped
+    self.clipTaskSequenceBrowserNode = None
+    self.clipTaskProgress = 0.0
+    self.clipTaskTimer = None
+    # In live update mode the output is updated when the ROI is modified. ROI modifications are coalesced:
+    # the output is updated at most once per update interval.
+    self.liveClippingSettings = None
+    self.liveClippingRoiNode = None
+    self.liveClippingRoiNodeObservers = []
+    self.liveClippingUpdateIntervalMsec = 30
+    self.liveClippingUpdateTimer = None
+    # Sequence browser that selects the frame that is shown in live update mode, if all frames of a sequence are clipped
+    self.liveClippingSequenceBrowserNode = None
+    self.liveClippingSequenceBrowserNodeObserver = None
 
   def setup(self):
     ScriptedLoadableModuleWidget.setup(self)
@@ -89,6 +110,34 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     self.fillValueEdit.maximum = 65535
     parametersFormLayout.addRow(self.fillValueLabel, self.fillValueEdit)
 
+    #
+    # crop output to ROI
+    #
+    self.cropToRoiCheckBox = qt.QCheckBox()
+    self.cropToRoiCheckBox.checked = False
+    self.cropToRoiCheckBox.setToolTip("If checked, the output volume only contains the region of the input volume that is covered by the ROI.")
+    parametersFormLayout.addRow("Crop to ROI: ", self.cropToRoiCheckBox)
+
+    #
+    # live update
+    #
+    self.liveUpdateCheckBox = qt.QCheckBox()
+    self.liveUpdateCheckBox.checked = False
+    self.liveUpdateCheckBox.setToolTip("If checked, the output volume is updated while the ROI is moved or resized."
+      " Only the voxels that entered or left the ROI are updated. Not available if the output volume is the same as the input volume"
+      " or the output is cropped to the ROI.")
+    parametersFormLayout.addRow("Live update: ", self.liveUpdateCheckBox)
+
+    #
+    # clip all frames of a sequence
+    #
+    self.clipSequenceCheckBox = qt.QCheckBox()
+    self.clipSequenceCheckBox.checked = False
+    self.clipSequenceCheckBox.setToolTip("If checked and the input volume is browsed by a sequence browser (for example, 4D cine MR or CT perfusion)"
+      " then all frames are clipped into a sequence that is browsed with the output volume. In live update mode frames are clipped"
+      " while they are browsed and the next and previous frames are clipped in advance in the background. Not available with crop to ROI.")
+    parametersFormLayout.addRow("Clip all frames: ", self.clipSequenceCheckBox)
+
     #
     # output volume selector
     #
@@ -107,21 +156,53 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     self.applyButton = qt.QPushButton("Apply")
     self.applyButton.toolTip = "Clip volume with ROI"
     parametersFormLayout.addWidget(self.applyButton)
+
+    # Progress of clipping, shown while clipping is in progress
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.minimum = 0
+    self.progressBar.maximum = 100
+    self.progressBar.visible = False
+    self.cancelButton = qt.QPushButton("Cancel")
+    self.cancelButton.toolTip = "Stop clipping. The output volume is not modified."
+    self.cancelButton.visible = False
+    progressLayout = qt.QHBoxLayout()
+    progressLayout.addWidget(self.progressBar)
+    progressLayout.addWidget(self.cancelButton)
+    parametersFormLayout.addRow(progressLayout)
     self.updateApplyButtonState()
 
+    self.clipTaskTimer = qt.QTimer()
+    self.clipTaskTimer.setInterval(100)
+    self.clipTaskTimer.connect('timeout()', self.onClipTaskTimer)
+    self.logic.setProgressCallback(self.onClipProgress)
+
+    self.liveClippingUpdateTimer = qt.QTimer()
+    self.liveClippingUpdateTimer.setSingleShot(True)
+    self.liveClippingUpdateTimer.setInterval(self.liveClippingUpdateIntervalMsec)
+    self.liveClippingUpdateTimer.connect('timeout()', self.onLiveClippingUpdateTimer)
+
     # connections
     self.applyButton.connect("clicked()", self.onApply)
+    self.cancelButton.connect("clicked()", self.onCancel)
 
     self.inputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onInputVolumeSelect)
     self.clippingRoiSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onClippingRoiSelect)
     self.outputVolumeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onOutputVolumeSelect)
 
     # Define list of widgets for updateGUIFromParameterNode, updateParameterNodeFromGUI, and addGUIObservers
-    self.valueEditWidgets = {"ClipOutsideSurface": self.clipOutsideSurfaceCheckBox, "FillValue": self.fillValueEdit}
+    self.valueEditWidgets = {"ClipOutsideSurface": self.clipOutsideSurfaceCheckBox, "FillValue": self.fillValueEdit, "CropToRoi": self.cropToRoiCheckBox,
+      "LiveUpdate": self.liveUpdateCheckBox, "ClipSequence": self.clipSequenceCheckBox}
     self.nodeSelectorWidgets = {"InputVolume": self.inputVolumeSelector, "ClippingRoi": self.clippingRoiSelector, "OutputVolume": self.outputVolumeSelector}
 
     # Use singleton parameter node (it is created if does not exist yet)
     parameterNode = self.logic.getParameterNode()
+    # Parameter node may have been created by an earlier version of the module
+    if not parameterNode.GetParameter("CropToRoi"):
+      parameterNode.SetParameter("CropToRoi", "0")
+    if not parameterNode.GetParameter("LiveUpdate"):
+      parameterNode.SetParameter("LiveUpdate", "0")
+    if not parameterNode.GetParameter("ClipSequence"):
+      parameterNode.SetParameter("ClipSequence", "0")
     # Set parameter node (widget will observe it and also updates GUI)
     self.setAndObserveParameterNode(parameterNode)
 
@@ -130,6 +211,19 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     # Add vertical spacer
     self.layout.addStretch(1)
 
+  def cleanup(self):
+    self.setAndObserveLiveClippingRoiNode(None)
+    self.setAndObserveLiveClippingSequenceBrowserNode(None)
+    self.logic.stopLiveClipping()
+    self.logic.stopSequenceClipping()
+    if self.liveClippingUpdateTimer:
+      self.liveClippingUpdateTimer.stop()
+    if self.clipTaskTimer:
+      self.clipTaskTimer.stop()
+    if self.clipTask:
+      self.logic.cancel()
+      self.clipTask = None
+
   def setAndObserveParameterNode(self, parameterNode):
     if parameterNode == self.parameterNode and self.parameterNodeObserver:
       # no change and node is already observed
@@ -193,6 +287,7 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     for parameterName in self.nodeSelectorWidgets:
       parameterNode.SetNodeReferenceID(parameterName, self.nodeSelectorWidgets[parameterName].currentNodeID)
     parameterNode.EndModify(oldModifiedState)
+    self.updateLiveClippingState()
 
   def addGUIObservers(self):
     for parameterName in self.valueEditWidgets:
@@ -207,7 +302,10 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
       self.nodeSelectorWidgets[parameterName].connect("currentNodeIDChanged(QString)", self.updateParameterNodeFromGUI)
 
   def updateApplyButtonState(self):
-    if self.clippingRoiSelector.currentNode() and self.inputVolumeSelector.currentNode() and self.outputVolumeSelector.currentNode():
+    if self.clipTask:
+      # clipping is in progress
+      self.applyButton.enabled = False
+    elif self.clippingRoiSelector.currentNode() and self.inputVolumeSelector.currentNode() and self.outputVolumeSelector.currentNode():
       self.applyButton.enabled = True
     else:
       self.applyButton.enabled = False
@@ -222,24 +320,166 @@ class VolumeClipWithRoiWidget(ScriptedLoadableModuleWidget):
     self.updateApplyButtonState()
 
   def onApply(self):
-    self.applyButton.text = "Working..."
-    self.applyButton.repaint()
-    slicer.app.processEvents()
     clipOutsideSurface = self.clipOutsideSurfaceCheckBox.checked
     fillValue = self.fillValueEdit.value
+    cropToRoi = self.cropToRoiCheckBox.checked
     clippingRoi = self.clippingRoiSelector.currentNode()
     inputVolume = self.inputVolumeSelector.currentNode()
     outputVolume = self.outputVolumeSelector.currentNode()
-    self.logic.clipVolumeWithRoi(clippingRoi, inputVolume, fillValue, clipOutsideSurface, outputVolume)
-    self.logic.showInSliceViewers(outputVolume, ["Red", "Yellow", "Green"])
-    self.applyButton.text = "Apply"
+    if self.clipSequenceCheckBox.checked and not cropToRoi:
+      sequenceBrowserNode, inputSequence = VolumeClipLib.getBrowsedSequence(slicer.modules.sequences.logic(), inputVolume)
+      if inputSequence:
+        self.clipSequence(clippingRoi, sequenceBrowserNode, inputSequence, fillValue, clipOutsideSurface, outputVolume)
+        return
+    try:
+      clipTask = self.logic.startClipVolumeWithRoi(clippingRoi, inputVolume, fillValue, clipOutsideSurface, outputVolume, cropToRoi)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip volume: {0}".format(e))
+      return
+    self.runClipTask(clipTask, outputVolume)
+
+  def clipSequence(self, clippingRoi, sequenceBrowserNode, inputSequence, fillValue, clipOutsideSurface, outputVolume):
+    """Clip all frames of the input sequence into the sequence that the browser shows in the output volume"""
+    try:
+      outputSequence = VolumeClipLib.getOutputSequence(sequenceBrowserNode, outputVolume)
+      clipTask = self.logic.startClipSequenceWithRoi(clippingRoi, inputSequence, fillValue, clipOutsideSurface, outputSequence)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip sequence: {0}".format(e))
+      return
+    self.runClipTask(clipTask, outputVolume, sequenceBrowserNode)
+
+  def runClipTask(self, clipTask, outputVolume, sequenceBrowserNode=None):
+    """Process voxels on a background thread, the output volume (or sequence) is updated when processing is completed"""
+    self.clipTask = clipTask
+    self.clipTaskOutputVolume = outputVolume
+    self.clipTaskSequenceBrowserNode = sequenceBrowserNode
+    self.setClipTaskInProgress(True)
+    self.clipTask.runInBackground()
+    self.clipTaskTimer.start()
+
+  def onCancel(self):
+    self.cancelButton.enabled = False
+    self.logic.cancel()
+
+  def onClipProgress(self, operationName, progress, stageName):
+    # Called from the processing thread, therefore GUI is updated in onClipTaskTimer
+    self.clipTaskProgress = progress
+
+  def onClipTaskTimer(self):
+    self.progressBar.value = int(self.clipTaskProgress * 100)
+    if self.clipTask.isRunning():
+      return
+    self.clipTaskTimer.stop()
+    try:
+      if self.clipTask.finish():
+        if self.clipTaskSequenceBrowserNode:
+          # Show the clipped frame that is selected in the browser
+          slicer.modules.sequences.logic().UpdateProxyNodesFromSequences(self.clipTaskSequenceBrowserNode)
+        self.logic.showInSliceViewers(self.clipTaskOutputVolume, ["Red", "Yellow", "Green"])
+    except VolumeClipLib.ClipCancelledError:
+      logging.info("Clipping was cancelled")
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to clip volume: {0}".format(e))
+    finally:
+      self.clipTask = None
+      self.clipTaskOutputVolume = None
+      self.clipTaskSequenceBrowserNode = None
+      self.setClipTaskInProgress(False)
+      # Apply live clipping settings that were changed while clipping was in progress
+      self.updateLiveClippingState()
+
+  def updateLiveClippingState(self):
+    """Start, restart, or stop live clipping to match the current settings"""
+    if self.clipTask:
+      # output volume is being updated by Apply, settings are applied when it is completed
+      return
+    liveClippingSettings = None
+    sequenceBrowserNode = None
+    if self.liveUpdateCheckBox.checked and not self.cropToRoiCheckBox.checked:
+      clippingRoi = self.clippingRoiSelector.currentNode()
+      inputVolume = self.inputVolumeSelector.currentNode()
+      outputVolume = self.outputVolumeSelector.currentNode()
+      if clippingRoi and inputVolume and outputVolume and inputVolume != outputVolume:
+        liveClippingSettings = (clippingRoi, inputVolume, self.fillValueEdit.value, self.clipOutsideSurfaceCheckBox.checked, outputVolume)
+        if self.clipSequenceCheckBox.checked:
+          # Frames of the browsed sequence are clipped when they are selected in the browser
+          sequenceBrowserNode, inputSequence = VolumeClipLib.getBrowsedSequence(slicer.modules.sequences.logic(), inputVolume)
+          if inputSequence:
+            liveClippingSettings = (clippingRoi, sequenceBrowserNode, inputSequence, self.fillValueEdit.value,
+              self.clipOutsideSurfaceCheckBox.checked, outputVolume)
+    if liveClippingSettings == self.liveClippingSettings:
+      return
+    self.liveClippingSettings = liveClippingSettings
+    self.setAndObserveLiveClippingRoiNode(None)
+    self.setAndObserveLiveClippingSequenceBrowserNode(None)
+    self.logic.stopLiveClipping()
+    self.logic.stopSequenceClipping()
+    if not liveClippingSettings:
+      return
+    try:
+      if sequenceBrowserNode:
+        self.logic.startSequenceClipping(*liveClippingSettings)
+      else:
+        self.logic.startLiveClipping(*liveClippingSettings)
+    except Exception as e:
+      self.liveClippingSettings = None
+      slicer.util.errorDisplay("Failed to clip volume: {0}".format(e))
+      return
+    self.logic.showInSliceViewers(liveClippingSettings[-1], ["Red", "Yellow", "Green"])
+    self.setAndObserveLiveClippingRoiNode(liveClippingSettings[0])
+    self.setAndObserveLiveClippingSequenceBrowserNode(sequenceBrowserNode)
+
+  def setAndObserveLiveClippingRoiNode(self, roiNode):
+    for observer in self.liveClippingRoiNodeObservers:
+      self.liveClippingRoiNode.RemoveObserver(observer)
+    self.liveClippingRoiNodeObservers = []
+    self.liveClippingRoiNode = roiNode
+    if self.liveClippingRoiNode:
+      for event in [vtk.vtkCommand.ModifiedEvent, slicer.vtkMRMLTransformableNode.TransformModifiedEvent]:
+        self.liveClippingRoiNodeObservers.append(self.liveClippingRoiNode.AddObserver(event, self.onLiveClippingRoiNodeModified))
+
+  def setAndObserveLiveClippingSequenceBrowserNode(self, sequenceBrowserNode):
+    if self.liveClippingSequenceBrowserNodeObserver:
+      self.liveClippingSequenceBrowserNode.RemoveObserver(self.liveClippingSequenceBrowserNodeObserver)
+      self.liveClippingSequenceBrowserNodeObserver = None
+    self.liveClippingSequenceBrowserNode = sequenceBrowserNode
+    if self.liveClippingSequenceBrowserNode:
+      self.liveClippingSequenceBrowserNodeObserver = self.liveClippingSequenceBrowserNode.AddObserver(
+        vtk.vtkCommand.ModifiedEvent, self.onLiveClippingSequenceBrowserNodeModified)
+
+  def onLiveClippingSequenceBrowserNodeModified(self, observer, eventid):
+    # Output is updated immediately (not coalesced by the update timer), so that it keeps up with playback
+    if self.clipTask:
+      return
+    self.logic.updateSequenceClipping()
+
+  def onLiveClippingRoiNodeModified(self, observer, eventid):
+    if not self.liveClippingUpdateTimer.isActive():
+      self.liveClippingUpdateTimer.start()
+
+  def onLiveClippingUpdateTimer(self):
+    if self.clipTask:
+      # output volume is being updated by Apply, try again later
+      self.liveClippingUpdateTimer.start()
+      return
+    self.logic.updateLiveClipping()
+    self.logic.updateSequenceClipping()
+
+  def setClipTaskInProgress(self, inProgress):
+    self.clipTaskProgress = 0.0
+    self.progressBar.value = 0
+    self.progressBar.visible = inProgress
+    self.cancelButton.visible = inProgress
+    self.cancelButton.enabled = inProgress
+    self.applyButton.text = "Working..." if inProgress else "Apply"
+    self.updateApplyButtonState()
 
 
 #
 # VolumeClipWithRoiLogic
 #
 
-class VolumeClipWithRoiLogic(ScriptedLoadableModuleLogic):
+class VolumeClipWithRoiLogic(ClipLogicMixin, ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
   should be such that other python code can import
@@ -249,6 +489,12 @@ class VolumeClipWithRoiLogic(ScriptedLoadableModuleLogic):
 
   def __init__(self, parent = None):
     ScriptedLoadableModuleLogic.__init__(self, parent)
+    # Worker threads, progress reporting, cancellation and sequence clipping
+    ClipLogicMixin.__init__(self)
+    # ROI boxes are not cached: voxels inside the box are computed analytically for each image row
+    # (see VolumeClipLib.BoxRasterizer), which takes less time than looking up and applying a cached stencil
+    # Inputs and current box of live clipping, None if live clipping is not active
+    self.liveClipping = None
 
   def createParameterNode(self):
     # Set default parameters
@@ -256,22 +502,397 @@ class VolumeClipWithRoiLogic(ScriptedLoadableModuleLogic):
     node.SetName(slicer.mrmlScene.GetUniqueNameByString(self.moduleName))
     node.SetParameter("ClipOutsideSurface", "1")
     node.SetParameter("FillValue", "0")
+    node.SetParameter("CropToRoi", "0")
+    node.SetParameter("LiveUpdate", "0")
+    node.SetParameter("ClipSequence", "0")
     return node
 
-  def clipVolumeWithRoi(self, roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume):
+  def clipVolumeWithRoi(self, roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume, cropToRoi=False):
+    """
+    Fill voxels of the input volume inside/outside the ROI with the provided fill value.
+    If cropToRoi is True then the output volume only contains the smallest block of voxels
+    that includes the ROI. If the ROI is aligned with the volume axes then no voxels need to be filled
+    and, if possible, the output image refers to the memory of the input image (no copy is made),
+    therefore the output changes if the input image voxels are modified.
+    If the output volume is the same as the input volume (and cropToRoi is False) then voxels
+    are filled in place, without allocating a new image.
+    Returns False if the output would be empty (ROI does not intersect the volume in crop mode).
+    Stage timings are available in getLastClipResult(). Raises VolumeClipLib.ClipCancelledError
+    (and leaves the output volume unchanged) if cancel() is called during processing.
+    """
+    return self.startClipVolumeWithRoi(roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume, cropToRoi).finish()
 
-    # Create a box implicit function that will be used as a stencil to fill the volume
+  def startClipVolumeWithRoi(self, roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume, cropToRoi=False):
+    """
+    Prepare clipping of a volume (see clipVolumeWithRoi) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask: call its runInBackground() method to process the voxels, then
+    call its finish() method on the main thread to update the output volume.
+    """
+    return VolumeClipLib.ClipTask(self.clipVolumeWithRoiSteps(roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume, cropToRoi))
+
+  def clipVolumeWithRoiSteps(self, roiNode, volumeNode, fillValue, clipOutsideSurface, outputVolume, cropToRoi):
+    with self.startOperation("clipVolumeWithRoi") as operation:
+
+      ijkToRas = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix( ijkToRas )
+
+      imageData=volumeNode.GetImageData()
+      extent = imageData.GetExtent()
+
+      # Fill the volume. Voxels inside the ROI are determined analytically for each image row
+      # (or as a sub-block if the ROI is aligned with the image axes), without evaluating each voxel.
+      with operation.stage("computeRoiGeometry"):
+        roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+        rasToBox = VolumeClipLib.getNumpyMatrix(rasToBox)
+        voxelIndexToRas = self.getVoxelIndexToRasMatrix(imageData, ijkToRas)
+
+      # Process voxels (MRML nodes are not accessed until the next yield)
+      yield
+
+      inputVoxels = VolumeClipLib.getVoxelArray(imageData)
+      fillProgressCallback = operation.getProgressCallback(0.0, 0.95)
+
+      if cropToRoi:
+        with operation.stage("fillVoxels") as stage:
+          ijkToBox = VolumeClipLib.getIjkToBox(voxelIndexToRas, rasToBox)
+          croppedSlices = VolumeClipLib.getBoxBoundingSlices(ijkToBox, roiBounds, extent)
+          if croppedSlices is None:
+            operation.result.error = "ROI does not intersect the volume"
+            logging.error("clipVolumeWithRoi failed: ROI does not intersect the volume")
+            return False
+          kSlice, jSlice, iSlice = croppedSlices
+          croppedExtent = (extent[0] + iSlice.start, extent[0] + iSlice.stop - 1,
+            extent[2] + jSlice.start, extent[2] + jSlice.stop - 1,
+            extent[4] + kSlice.start, extent[4] + kSlice.stop - 1)
+          outputVoxels = inputVoxels[croppedSlices]
+          if clipOutsideSurface and VolumeClipLib.getAxisAlignedBoxSlices(ijkToBox, roiBounds, extent) is not None:
+            # All voxels of the cropped block are inside the ROI, nothing to fill.
+            # Contiguous view (e.g., cropped only along K axis) is used without copying.
+            outputVoxels = np.ascontiguousarray(outputVoxels)
+          else:
+            outputVoxels = outputVoxels.copy()
+            VolumeClipLib.fillBox(outputVoxels, ijkToBox, roiBounds, VolumeClipLib.castFillValue(fillValue, outputVoxels.dtype),
+              clipOutsideSurface, croppedExtent)
+          stage["bytes"] = outputVoxels.nbytes
+        # Shift the origin so that the first voxel of the output is the first voxel of the cropped block
+        croppedIndexToIndex = vtk.vtkMatrix4x4()
+        spacing = imageData.GetSpacing()
+        for axis in range(3):
+          croppedIndexToIndex.SetElement(axis, 3, (croppedExtent[axis * 2] - extent[axis * 2]) * spacing[axis])
+        croppedIjkToRas = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(ijkToRas, croppedIndexToIndex, croppedIjkToRas)
+        ijkToRas = croppedIjkToRas
+      elif outputVolume == volumeNode:
+        # Cumulative clipping: voxels are filled in the existing image of the volume. No image is allocated
+        # and only the filled voxels are written. Filling in place cannot be cancelled, as it would leave
+        # the volume partially clipped.
+        operation.setCancellable(False)
+        with operation.stage("fillVoxels") as stage:
+          VolumeClipLib.clipVoxelsWithRoi(inputVoxels, voxelIndexToRas, roiBounds, rasToBox, fillValue, clipOutsideSurface, extent,
+            self.numberOfWorkerThreads, outputVoxels=inputVoxels, progressCallback=fillProgressCallback)
+          stage["bytes"] = inputVoxels.nbytes
+        # Update the volume on the main thread
+        yield
+        with operation.stage("updateOutputVolume"):
+          self.notifyVoxelsModified(volumeNode)
+        operation.setProgress(1.0)
+        return True
+      else:
+        # Copy and fill slab by slab on multiple threads
+        with operation.stage("fillVoxels") as stage:
+          outputVoxels = VolumeClipLib.clipVoxelsWithRoi(inputVoxels, voxelIndexToRas, roiBounds, rasToBox, fillValue, clipOutsideSurface, extent,
+            self.numberOfWorkerThreads, progressCallback=fillProgressCallback)
+          stage["bytes"] = outputVoxels.nbytes
+
+      # Update the output volume on the main thread
+      yield
+
+      # Update the volume with the clipping result (output image refers to the numpy array, no copy is made).
+      # The output volume is only modified if the operation was not cancelled.
+      operation.setProgress(0.95)
+      operation.setCancellable(False)
+      with operation.stage("updateOutputVolume"):
+        outputImageData = VolumeClipLib.createImageData(outputVoxels, imageData)
+        self.updateOutputVolume(outputVolume, outputImageData, ijkToRas)
+      operation.setProgress(1.0)
+
+    return True
+
+  def clipVolumesWithRoi(self, roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes):
+    """
+    Clip multiple volumes (for example, frames of a time sequence or multiple contrasts) with the same ROI.
+    The ROI is rasterized only once for each distinct image geometry, then the volumes are clipped concurrently,
+    using the number of threads set by setNumberOfWorkerThreads.
+    Returns a list that contains a dictionary for each input volume: "success" (bool),
+    "error" (error message or None), "processingTimeSec" (time spent with filling the voxels).
+    Output volumes that could not be computed are not modified.
+    If cancel() is called then VolumeClipLib.ClipCancelledError is raised and no output volumes are modified.
+    """
+    return self.startClipVolumesWithRoi(roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes).finish()
 
-    roiBox = vtk.vtkBox()
-    rasToBox = vtk.vtkMatrix4x4()
+  def startClipVolumesWithRoi(self, roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes):
+    """
+    Prepare clipping of multiple volumes (see clipVolumesWithRoi) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask, see startClipVolumeWithRoi.
+    """
+    if len(inputVolumes) != len(outputVolumes):
+      raise ValueError("clipVolumesWithRoi failed: number of input and output volumes must be the same")
+    return VolumeClipLib.ClipTask(self.clipVolumesWithRoiSteps(roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes))
+
+  def clipVolumesWithRoiSteps(self, roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes):
+    with self.startOperation("clipVolumesWithRoi") as operation:
+
+      # Rasterize the ROI for each distinct image geometry (on the main thread, as it accesses MRML nodes)
+      insideMasks = {}
+      clippingTasks = []
+      for volumeIndex, inputVolume in enumerate(inputVolumes):
+        ijkToRas = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix( ijkToRas )
+        imageData = inputVolume.GetImageData()
+        geometryKey = VolumeClipLib.getImageGeometryKey(imageData, ijkToRas)
+        if geometryKey not in insideMasks:
+          with operation.stage("rasterizeRoi") as stage:
+            roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+            insideMasks[geometryKey] = VolumeClipLib.createRoiMask(VolumeClipLib.getVoxelArray(imageData),
+              self.getVoxelIndexToRasMatrix(imageData, ijkToRas), roiBounds, VolumeClipLib.getNumpyMatrix(rasToBox), imageData.GetExtent())
+            stage["bytes"] = insideMasks[geometryKey].nbytes
+        clippingTasks.append((imageData, insideMasks[geometryKey]))
+        operation.setProgress(0.3 * (volumeIndex + 1) / len(inputVolumes))
+
+      # Fill voxels on worker threads (MRML nodes are not accessed until the next yield)
+      yield
+
+      def clipVoxels(clippingTask):
+        imageData, insideMask = clippingTask
+        inputVoxels = VolumeClipLib.getVoxelArray(imageData)
+        castedFillValue = VolumeClipLib.castFillValue(fillValue, inputVoxels.dtype)
+        return VolumeClipLib.applyMask(inputVoxels, insideMask,
+          clipOutsideSurface, castedFillValue, not clipOutsideSurface, castedFillValue)
+      fillProgressCallback = operation.getProgressCallback(0.3, 0.95)
+      with operation.stage("fillVoxels") as stage:
+        taskResults = VolumeClipLib.processInParallel(clipVoxels, clippingTasks, self.numberOfWorkerThreads,
+          lambda numberOfCompletedVolumes, numberOfVolumes: fillProgressCallback(float(numberOfCompletedVolumes) / numberOfVolumes))
+        stage["bytes"] = sum(taskResult["result"].nbytes for taskResult in taskResults if taskResult["error"] is None)
+
+      # Update output volumes on the main thread
+      yield
+
+      operation.setCancellable(False)
+      results = []
+      with operation.stage("updateOutputVolume"):
+        for inputVolume, outputVolume, clippingTask, taskResult in zip(inputVolumes, outputVolumes, clippingTasks, taskResults):
+          if taskResult["error"] is None:
+            ijkToRas = vtk.vtkMatrix4x4()
+            inputVolume.GetIJKToRASMatrix( ijkToRas )
+            self.updateOutputVolume(outputVolume, VolumeClipLib.createImageData(taskResult["result"], clippingTask[0]), ijkToRas)
+          else:
+            logging.error("Failed to clip volume {0}: {1}".format(inputVolume.GetName(), taskResult["error"]))
+          results.append({
+            "success": taskResult["error"] is None,
+            "error": str(taskResult["error"]) if taskResult["error"] is not None else None,
+            "processingTimeSec": taskResult["processingTimeSec"],
+            })
+      operation.setProgress(1.0)
+
+    return results
+
+  def clipVolumeFileWithRoi(self, roiNode, inputImageFile, fillValue, clipOutsideSurface, outputFilePath, maxSlabSizeBytes=64*1024*1024):
+    """
+    Clip a volume stored in a file, without loading it into the scene. The input file is memory-mapped and
+    clipped slab by slab, and the result is written into a NRRD file slab by slab,
+    therefore memory usage is limited by maxSlabSizeBytes, regardless of the image size.
+    :param inputImageFile: uncompressed NRRD or NIfTI file path, or VolumeClipLib.ImageFileInfo that describes a raw file
+    Raises ValueError if the input file cannot be memory-mapped. If cancel() is called then
+    VolumeClipLib.ClipCancelledError is raised and the incomplete output file is removed.
+    """
+    with self.startOperation("clipVolumeFileWithRoi") as operation:
+      if isinstance(inputImageFile, VolumeClipLib.ImageFileInfo):
+        imageFileInfo = inputImageFile
+      else:
+        imageFileInfo = VolumeClipLib.readImageFileInfo(inputImageFile)
+      roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+      rasToBox = VolumeClipLib.getNumpyMatrix(rasToBox)
 
-    # Determine the non-transformed ROI box and
-    # the transform between the box and the world coordinate systems
+      def fillSlab(slabVoxels, slabImageData):
+        with operation.stage("fillVoxels") as stage:
+          # Origin and spacing of the slab image are (0,0,0) and (1,1,1)
+          VolumeClipLib.clipVoxelsWithRoi(slabVoxels, imageFileInfo.ijkToRas, roiBounds, rasToBox, fillValue, clipOutsideSurface,
+            slabImageData.GetExtent(), self.numberOfWorkerThreads, outputVoxels=slabVoxels)
+          stage["bytes"] = slabVoxels.nbytes
+
+      with operation.stage("clipFile") as stage:
+        VolumeClipLib.clipImageFile(imageFileInfo, outputFilePath, fillSlab, maxSlabSizeBytes, operation.setProgress)
+        stage["bytes"] = os.path.getsize(outputFilePath)
+
+    return True
+
+  def createMaskWithRoi(self, roiNode, volumeNode, outputNode, segmentName=None):
+    """
+    Store only the clipping mask instead of a clipped copy of the input volume: voxels inside the ROI are 1,
+    voxels outside are 0. The mask has the same geometry as the input volume, input voxels are not read.
+    :param outputNode: labelmap volume node (the mask is stored as an unsigned char image, 1 byte per voxel)
+      or segmentation node (the mask is stored in the segment named segmentName, which is added if it does not exist yet;
+      by default the name of the ROI is used)
+    """
+    with self.startOperation("createMaskWithRoi") as operation:
+      ijkToRas = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix( ijkToRas )
+      imageData = volumeNode.GetImageData()
+      with operation.stage("createMask") as stage:
+        roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+        maskVoxels = VolumeClipLib.createRoiMask(VolumeClipLib.getVoxelArray(imageData), self.getVoxelIndexToRasMatrix(imageData, ijkToRas),
+          roiBounds, VolumeClipLib.getNumpyMatrix(rasToBox), imageData.GetExtent()).view(np.uint8)
+        stage["bytes"] = maskVoxels.nbytes
+      operation.setProgress(0.9)
+      operation.setCancellable(False)
+      with operation.stage("updateOutputNode"):
+        self.updateMaskNode(outputNode, maskVoxels, volumeNode, segmentName if segmentName else roiNode.GetName())
+      operation.setProgress(1.0)
+    return True
+
+  def writeMaskFileWithRoi(self, roiNode, volumeNode, maskFilePath):
+    """
+    Write the clipping mask of the input volume into a compact file (1 bit per voxel, compressed),
+    see VolumeClipLib.writeMaskFile. The mask can be applied later using clipVolumeWithMaskFile
+    of the VolumeClipWithModel module.
+    """
+    with self.startOperation("writeMaskFileWithRoi") as operation:
+      ijkToRas = vtk.vtkMatrix4x4()
+      volumeNode.GetIJKToRASMatrix( ijkToRas )
+      imageData = volumeNode.GetImageData()
+      extent = imageData.GetExtent()
+      with operation.stage("packMask") as stage:
+        roiBounds, ijkToBox = self.getIjkToBoxMatrix(roiNode, imageData, ijkToRas)
+        packedMask = VolumeClipLib.packMask(lambda slabExtent: VolumeClipLib.getBoxMask(ijkToBox, roiBounds, extent,
+          slice(slabExtent[4] - extent[4], slabExtent[5] - extent[4] + 1)), extent)
+        stage["bytes"] = packedMask.nbytes
+      operation.setProgress(0.9)
+      with operation.stage("writeMaskFile") as stage:
+        VolumeClipLib.writeMaskFile(maskFilePath, packedMask, extent, VolumeClipLib.getNumpyMatrix(ijkToRas))
+        stage["bytes"] = os.path.getsize(maskFilePath)
+      operation.setProgress(1.0)
+    return True
+
+  def startLiveClipping(self, roiNode, inputVolume, fillValue, clipOutsideSurface, outputVolume):
+    """
+    Clip the volume and prepare for keeping the output volume in sync with the ROI. After the ROI is moved
+    or resized, updateLiveClipping() only writes the voxels that entered or left the box, instead of
+    clipping the whole volume again. The output volume must not be the same as the input volume,
+    because voxels that are not filled anymore are restored from the input volume.
+    """
+    if outputVolume == inputVolume:
+      raise ValueError("startLiveClipping failed: output volume must be different from the input volume")
+    self.stopLiveClipping()
+    self.clipVolumeWithRoi(roiNode, inputVolume, fillValue, clipOutsideSurface, outputVolume)
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix( ijkToRas )
+    inputImageData = inputVolume.GetImageData()
+    roiBounds, ijkToBox = self.getIjkToBoxMatrix(roiNode, inputImageData, ijkToRas)
+    self.liveClipping = {
+      "roiNode": roiNode,
+      "inputVolume": inputVolume,
+      "fillValue": fillValue,
+      "clipOutsideSurface": clipOutsideSurface,
+      "outputVolume": outputVolume,
+      # The output can only be updated incrementally if the images are not replaced since the last update
+      "inputGeometryKey": VolumeClipLib.getImageGeometryKey(inputImageData, ijkToRas),
+      "outputImageData": outputVolume.GetImageData(),
+      # Range of voxels inside the box in each image row
+      "rowSpans": VolumeClipLib.getBoxRowSpans(ijkToBox, roiBounds, inputImageData.GetExtent()),
+      }
+
+  def updateLiveClipping(self):
+    """
+    Update the output volume of live clipping (see startLiveClipping) after the ROI is changed.
+    Only voxels in the symmetric difference of the previous and current box are filled or restored.
+    If the input or output image has been replaced then the whole volume is clipped again.
+    Returns the number of updated voxels.
+    """
+    if not self.liveClipping:
+      return 0
+    liveClipping = self.liveClipping
+    inputVolume = liveClipping["inputVolume"]
+    outputVolume = liveClipping["outputVolume"]
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix( ijkToRas )
+    inputImageData = inputVolume.GetImageData()
+    if (outputVolume.GetImageData() != liveClipping["outputImageData"]
+      or VolumeClipLib.getImageGeometryKey(inputImageData, ijkToRas) != liveClipping["inputGeometryKey"]):
+      self.startLiveClipping(liveClipping["roiNode"], inputVolume, liveClipping["fillValue"], liveClipping["clipOutsideSurface"], outputVolume)
+      return inputImageData.GetNumberOfPoints()
+
+    roiBounds, ijkToBox = self.getIjkToBoxMatrix(liveClipping["roiNode"], inputImageData, ijkToRas)
+    rowSpans = VolumeClipLib.getBoxRowSpans(ijkToBox, roiBounds, inputImageData.GetExtent())
+    outputVoxels = VolumeClipLib.getVoxelArray(outputVolume.GetImageData())
+    numberOfUpdatedVoxels = VolumeClipLib.updateBoxClip(outputVoxels, VolumeClipLib.getVoxelArray(inputImageData),
+      liveClipping["rowSpans"], rowSpans, VolumeClipLib.castFillValue(liveClipping["fillValue"], outputVoxels.dtype),
+      liveClipping["clipOutsideSurface"])
+    liveClipping["rowSpans"] = rowSpans
+    if numberOfUpdatedVoxels:
+      self.notifyVoxelsModified(outputVolume)
+    return numberOfUpdatedVoxels
+
+  def stopLiveClipping(self):
+    """Stop live clipping. The output volume is kept as it is."""
+    self.liveClipping = None
+
+  def clipSequenceWithRoi(self, roiNode, inputSequence, fillValue, clipOutsideSurface, outputSequence):
+    """
+    Clip all frames of a sequence (for example, 4D cine MR or CT perfusion) with the same ROI and store them
+    in the output sequence, with the index values of the input sequence. The ROI is rasterized once and shared
+    by all frames (see clipVolumesWithRoi). Previous frames of the output sequence are removed.
+    The output sequence may be the same as the input sequence.
+    Returns a list that contains a dictionary for each frame (see clipVolumesWithRoi), frames that could not be
+    clipped are left out from the output sequence.
+    """
+    return self.startClipSequenceWithRoi(roiNode, inputSequence, fillValue, clipOutsideSurface, outputSequence).finish()
+
+  def startClipSequenceWithRoi(self, roiNode, inputSequence, fillValue, clipOutsideSurface, outputSequence):
+    """
+    Prepare clipping of all frames of a sequence (see clipSequenceWithRoi) so that voxels can be processed on a background thread.
+    Returns a VolumeClipLib.ClipTask, see startClipVolumeWithRoi. The output sequence is updated by its finish() method.
+    """
+    return VolumeClipLib.ClipTask(self.clipSequenceWithRoiSteps(roiNode, inputSequence, fillValue, clipOutsideSurface, outputSequence))
 
+  def clipSequenceWithRoiSteps(self, roiNode, inputSequence, fillValue, clipOutsideSurface, outputSequence):
+    inputVolumes = [inputSequence.GetNthDataNode(frameIndex) for frameIndex in range(inputSequence.GetNumberOfDataNodes())]
+    outputVolumes = [slicer.vtkMRMLScalarVolumeNode() for inputVolume in inputVolumes]
+    results = yield from self.clipVolumesWithRoiSteps(roiNode, inputVolumes, fillValue, clipOutsideSurface, outputVolumes)
+    VolumeClipLib.updateOutputSequence(outputSequence, inputSequence, inputVolumes, outputVolumes, results)
+    return results
+
+  def startSequenceClipping(self, roiNode, sequenceBrowserNode, inputSequence, fillValue, clipOutsideSurface, outputVolume):
+    """
+    Show the clipped current frame of a browsed sequence in the output volume. Call updateSequenceClipping()
+    when the browser node is modified (a new frame is selected) or the ROI is changed.
+    The ROI is rasterized once for the whole sequence. Frames are clipped when they are first shown, while
+    the frames next to the current frame are clipped in advance on a background thread, so that clipped frames
+    can be played back at the acquisition frame rate. Clipped frames are kept in a frame cache, see
+    setFrameCacheMemoryBudget. The output volume refers to the cached voxels, therefore it must not be modified.
+    """
+    roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+    def getInsideMask(imageData, ijkToRas):
+      return VolumeClipLib.createRoiMask(VolumeClipLib.getVoxelArray(imageData), self.getVoxelIndexToRasMatrix(imageData, ijkToRas),
+        roiBounds, VolumeClipLib.getNumpyMatrix(rasToBox), imageData.GetExtent())
+    self.startSequenceClippingWithMask((roiNode, sequenceBrowserNode, inputSequence, fillValue, clipOutsideSurface, outputVolume),
+      self.getSequenceClippingShapeKey(roiNode), sequenceBrowserNode, inputSequence, outputVolume, getInsideMask,
+      clipOutsideSurface, fillValue, not clipOutsideSurface, fillValue)
+
+  def getSequenceClippingShapeKey(self, roiNode):
+    """Returns a hashable key that changes when the ROI box is changed"""
+    roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+    return (tuple(roiBounds), VolumeClipLib.getMatrixKey(rasToBox))
+
+  def getRoiBoxGeometry(self, roiNode):
+    """
+    Get the non-transformed ROI box and the transform between the box and the world coordinate systems.
+    Returns box bounds (xmin, xmax, ymin, ymax, zmin, zmax) and the RAS to box vtkMatrix4x4.
+    """
+    rasToBox = vtk.vtkMatrix4x4()
     if roiNode.IsA("vtkMRMLMarkupsROINode"):
       # Markups ROI node
       roiDiameter = roiNode.GetSize()
-      roiBox.SetBounds(-roiDiameter[0]/2, roiDiameter[0]/2, -roiDiameter[1]/2, roiDiameter[1]/2, -roiDiameter[2]/2, roiDiameter[2]/2)
+      roiBounds = [-roiDiameter[0]/2, roiDiameter[0]/2, -roiDiameter[1]/2, roiDiameter[1]/2, -roiDiameter[2]/2, roiDiameter[2]/2]
       vtk.vtkMatrix4x4.Invert(roiNode.GetObjectToWorldMatrix(), rasToBox)
     else:
       # Legacy Annotation ROI node
@@ -279,29 +900,58 @@ class VolumeClipWithRoiLogic(ScriptedLoadableModuleLogic):
       roiNode.GetXYZ( roiCenter )
       roiRadius = [0, 0, 0]
       roiNode.GetRadiusXYZ( roiRadius )
-      roiBox.SetBounds(roiCenter[0] - roiRadius[0], roiCenter[0] + roiRadius[0], roiCenter[1] - roiRadius[1], roiCenter[1] + roiRadius[1], roiCenter[2] - roiRadius[2], roiCenter[2] + roiRadius[2])
+      roiBounds = [roiCenter[0] - roiRadius[0], roiCenter[0] + roiRadius[0], roiCenter[1] - roiRadius[1], roiCenter[1] + roiRadius[1], roiCenter[2] - roiRadius[2], roiCenter[2] + roiRadius[2]]
       if roiNode.GetTransformNodeID() != None:
         roiBoxTransformNode = slicer.mrmlScene.GetNodeByID(roiNode.GetTransformNodeID())
         boxToRas = vtk.vtkMatrix4x4()
         roiBoxTransformNode.GetMatrixTransformToWorld(boxToRas)
         rasToBox.DeepCopy(boxToRas)
         rasToBox.Invert()
+    return roiBounds, rasToBox
 
-    # Get transform between the box and volume IJK
+  def getVoxelIndexToRasMatrix(self, imageData, ijkToRas):
+    """Returns the transform from voxel indices of the image to RAS as a 4x4 numpy array (as used by VolumeClipLib.ClipCore)"""
+    # Image origin and spacing are normally (0,0,0) and (1,1,1), but they are taken into account for completeness
+    return np.dot(VolumeClipLib.getNumpyMatrix(ijkToRas), VolumeClipLib.getIndexToPointMatrix(imageData))
 
-    ijkToRas = vtk.vtkMatrix4x4()
-    volumeNode.GetIJKToRASMatrix( ijkToRas )
+  def getIjkToBoxMatrix(self, roiNode, imageData, ijkToRas):
+    """
+    Get ROI box bounds and the transform from image voxel indices to box coordinates.
+    Returns box bounds and a 4x4 numpy array.
+    """
+    roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+    return roiBounds, VolumeClipLib.getIjkToBox(self.getVoxelIndexToRasMatrix(imageData, ijkToRas), VolumeClipLib.getNumpyMatrix(rasToBox))
+
+  def createStencilFromRoi(self, roiNode, imageData, ijkToRas, stencilCache=None):
+    """
+    Rasterize the ROI box on the voxel grid of the image.
+    Returns a vtkImageStencilData that is non-zero inside the ROI.
+    If a VolumeClipLib.StencilCache is provided then the stencil is reused while the ROI and the image geometry
+    are unchanged. The returned stencil may be shared with the stencil cache, therefore it must not be modified.
+    """
+
+    # Determine the non-transformed ROI box and
+    # the transform between the box and the world coordinate systems
+    roiBounds, rasToBox = self.getRoiBoxGeometry(roiNode)
+
+    # Reuse previously rasterized stencil if the ROI and the image geometry are the same
+    stencilKey = ("roi", tuple(roiBounds), VolumeClipLib.getMatrixKey(rasToBox),
+      VolumeClipLib.getImageGeometryKey(imageData, ijkToRas))
+    stencil = stencilCache.get(stencilKey) if stencilCache else None
+    if stencil is not None:
+      return stencil
+
+    # Create a box implicit function that will be used as a stencil to fill the volume
+    roiBox = vtk.vtkBox()
+    roiBox.SetBounds(roiBounds)
 
+    # Get transform between the box and volume IJK
     ijkToBox = vtk.vtkMatrix4x4()
     vtk.vtkMatrix4x4.Multiply4x4(rasToBox,ijkToRas,ijkToBox)
     ijkToBoxTransform = vtk.vtkTransform()
     ijkToBoxTransform.SetMatrix(ijkToBox)
     roiBox.SetTransform(ijkToBoxTransform)
 
-    # Use the stencil to fill the volume
-
-    imageData=volumeNode.GetImageData()
-
     # Convert the implicit function to a stencil
     functionToStencil = vtk.vtkImplicitFunctionToImageStencil()
     functionToStencil.SetInput(roiBox)
@@ -310,50 +960,10 @@ class VolumeClipWithRoiLogic(ScriptedLoadableModuleLogic):
     functionToStencil.SetOutputWholeExtent(imageData.GetExtent())
     functionToStencil.Update()
 
-    # Apply the stencil to the volume
-    stencilToImage=vtk.vtkImageStencil()
-    stencilToImage.SetInputData(imageData)
-    stencilToImage.SetStencilData(functionToStencil.GetOutput())
-    if clipOutsideSurface:
-      stencilToImage.ReverseStencilOff()
-    else:
-      stencilToImage.ReverseStencilOn()
-    stencilToImage.SetBackgroundValue(fillValue)
-    stencilToImage.Update()
-
-    # Update the volume with the stencil operation result
-    outputImageData = vtk.vtkImageData()
-    outputImageData.DeepCopy(stencilToImage.GetOutput())
-
-    outputVolume.SetAndObserveImageData(outputImageData);
-    outputVolume.SetIJKToRASMatrix(ijkToRas)
-
-    # Add a default display node to output volume node if it does not exist yet
-    if not outputVolume.GetDisplayNode:
-      displayNode=slicer.vtkMRMLScalarVolumeDisplayNode()
-      displayNode.SetAndObserveColorNodeID("vtkMRMLColorTableNodeGrey")
-      slicer.mrmlScene.AddNode(displayNode)
-      outputVolume.SetAndObserveDisplayNodeID(displayNode.GetID())
-
-  def showInSliceViewers(self, volumeNode, sliceWidgetNames):
-    # Displays volumeNode in the selected slice viewers as background volume
-    # Existing background volume is pushed to foreground, existing foreground volume will not be shown anymore
-    # sliceWidgetNames is a list of slice view names, such as ["Yellow", "Green"]
-    if not volumeNode:
-      return
-    newVolumeNodeID = volumeNode.GetID()
-    for sliceWidgetName in sliceWidgetNames:
-      sliceLogic = slicer.app.layoutManager().sliceWidget(sliceWidgetName).sliceLogic()
-      foregroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetForegroundVolumeID()
-      backgroundVolumeNodeID = sliceLogic.GetSliceCompositeNode().GetBackgroundVolumeID()
-      if foregroundVolumeNodeID == newVolumeNodeID or backgroundVolumeNodeID == newVolumeNodeID:
-        # new volume is already shown as foreground or background
-        continue
-      if backgroundVolumeNodeID:
-        # there is a background volume, push it to the foreground because we will replace the background volume
-        sliceLogic.GetSliceCompositeNode().SetForegroundVolumeID(backgroundVolumeNodeID)
-      # show the new volume as background
-      sliceLogic.GetSliceCompositeNode().SetBackgroundVolumeID(newVolumeNodeID)
+    stencil = functionToStencil.GetOutput()
+    if stencilCache:
+      stencilCache.add(stencilKey, stencil)
+    return stencil
 
 class VolumeClipWithRoiTest(ScriptedLoadableModuleTest):
   """
@@ -370,6 +980,53 @@ class VolumeClipWithRoiTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_VolumeClipWithRoi1()
+    self.setUp()
+    self.test_VolumeClipWithRoiAnalytic()
+    self.setUp()
+    self.test_VolumeClipWithRoiStageTimings()
+    self.setUp()
+    self.test_VolumeClipWithRoiBackground()
+    self.setUp()
+    self.test_VolumeClipWithRoiCore()
+    self.setUp()
+    self.test_VolumeClipWithRoiLiveClipping()
+    self.setUp()
+    self.test_VolumeClipWithRoiMask()
+    self.setUp()
+    self.test_VolumeClipWithRoiSequence()
+    self.setUp()
+    self.test_VolumeClipWithRoiInPlace()
+    self.setUp()
+    self.test_VolumeClipWithRoiCrop()
+    self.setUp()
+    self.test_VolumeClipWithRoiFile()
+
+  def createSyntheticVolume(self):
+    """Returns a volume with non-uniform spacing and voxel values that vary along all axes"""
+    inputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    inputVolume.SetSpacing(0.8, 0.9, 1.5)
+    inputVolume.SetOrigin(-20, -30, 10)
+    slicer.util.updateVolumeFromArray(inputVolume, np.arange(40*50*60, dtype=np.int16).reshape(40, 50, 60))
+    return inputVolume
+
+  def createObliqueRoi(self):
+    """Returns an ROI that partially covers the synthetic volume and is rotated with respect to the volume axes"""
+    roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+    roiNode.SetCenter(0, -5, 35)
+    roiNode.SetSize(30, 20, 25)
+    roiToWorld = vtk.vtkTransform()
+    roiToWorld.Translate(0, -5, 35)
+    roiToWorld.RotateWXYZ(30, 1, 2, 3)
+    roiToWorld.Translate(0, 5, -35)
+    roiNode.ApplyTransformMatrix(roiToWorld.GetMatrix())
+    return roiNode
+
+  def getRoiMask(self, logic, roiNode, inputVolume):
+    """Returns the boolean mask of voxels of the input volume that are inside the ROI"""
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    roiBounds, ijkToBox = logic.getIjkToBoxMatrix(roiNode, inputVolume.GetImageData(), ijkToRas)
+    return VolumeClipLib.getBoxMask(ijkToBox, roiBounds, inputVolume.GetImageData().GetExtent())
 
   def test_VolumeClipWithRoi1(self):
 
@@ -396,3 +1053,276 @@ class VolumeClipWithRoiTest(ScriptedLoadableModuleTest):
     logic.clipVolumeWithRoi(roiNode, mrHeadVolume, fillValue, clipOutsideSurface, outputVolume)
 
     self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiAnalytic(self):
+    """Analytic ROI rasterization must give the same result as vtkImplicitFunctionToImageStencil"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    stencil = logic.createStencilFromRoi(roiNode, inputVolume.GetImageData(), ijkToRas)
+
+    for clipOutsideSurface in [True, False]:
+      logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, clipOutsideSurface, outputVolume)
+
+      stencilToImage = vtk.vtkImageStencil()
+      stencilToImage.SetInputData(inputVolume.GetImageData())
+      stencilToImage.SetStencilData(stencil)
+      stencilToImage.SetReverseStencil(not clipOutsideSurface)
+      stencilToImage.SetBackgroundValue(fillValue)
+      stencilToImage.Update()
+      expectedVoxels = VolumeClipLib.getVoxelArray(stencilToImage.GetOutput())
+
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), expectedVoxels))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiStageTimings(self):
+    """Stage timings and processed data sizes are recorded for each clipping operation"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    clipResults = []
+    logic.setProfilingCallback(clipResults.append)
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, -7, True, outputVolume)
+
+    clipResult = logic.getLastClipResult()
+    self.assertEqual(clipResults, [clipResult])
+    self.assertTrue(clipResult.success)
+    self.assertEqual(clipResult.getStageBytes()["fillVoxels"], slicer.util.arrayFromVolume(outputVolume).nbytes)
+    self.assertIn("computeRoiGeometry", clipResult.getStageTimes())
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiBackground(self):
+    """Processing on a background thread must give the same result as processing on the main thread"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, False, expectedVolume)
+
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    clipTask = logic.startClipVolumeWithRoi(roiNode, inputVolume, fillValue, False, outputVolume)
+    clipTask.runInBackground()
+    self.assertTrue(clipTask.finish())
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiCore(self):
+    """Clipping core only needs numpy arrays and ROI parameters, which can be sent to worker processes"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, False, expectedVolume)
+
+    import pickle
+    ijkToRas = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRas)
+    roiBounds, rasToBox = logic.getRoiBoxGeometry(roiNode)
+    coreInputs = pickle.loads(pickle.dumps((slicer.util.arrayFromVolume(inputVolume), VolumeClipLib.getNumpyMatrix(ijkToRas),
+      roiBounds, VolumeClipLib.getNumpyMatrix(rasToBox))))
+    self.assertTrue(np.array_equal(VolumeClipLib.clipVoxelsWithRoi(*coreInputs, fillValue=fillValue, clipOutside=False),
+      slicer.util.arrayFromVolume(expectedVolume)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiLiveClipping(self):
+    """Live clipping must give the same result as clipping the whole volume after the ROI is changed"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.startLiveClipping(roiNode, inputVolume, fillValue, True, outputVolume)
+    roiNode.SetSize(25, 30, 15)
+    self.assertTrue(logic.updateLiveClipping() > 0)
+    logic.stopLiveClipping()
+
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, True, expectedVolume)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiMask(self):
+    """Mask-only output must match the rasterized box, both as a labelmap and as a mask file"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    expectedMask = self.getRoiMask(logic, roiNode, inputVolume)
+
+    maskVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    self.assertTrue(logic.createMaskWithRoi(roiNode, inputVolume, maskVolume))
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(maskVolume), expectedMask.view(np.uint8)))
+
+    maskFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithRoiTestMask.npz")
+    self.assertTrue(logic.writeMaskFileWithRoi(roiNode, inputVolume, maskFilePath))
+    mask, maskExtent, maskIjkToRas = VolumeClipLib.readMaskFile(maskFilePath)
+    os.remove(maskFilePath)
+    self.assertTrue(np.array_equal(mask, expectedMask))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiSequence(self):
+    """Frames of a sequence are clipped with the shared ROI mask, at once, on a background thread, and while browsing"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    insideMask = self.getRoiMask(logic, roiNode, inputVolume)
+    inputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    for frameIndex in range(3):
+      inputSequence.SetDataNodeAtValue(inputVolume, str(frameIndex))
+      slicer.util.arrayFromVolume(inputSequence.GetNthDataNode(frameIndex))[:] += frameIndex
+    expectedFrames = [np.where(insideMask, np.int16(fillValue), slicer.util.arrayFromVolume(inputSequence.GetNthDataNode(frameIndex)))
+      for frameIndex in range(3)]
+
+    outputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    logic.clipSequenceWithRoi(roiNode, inputSequence, fillValue, False, outputSequence)
+    self.assertEqual(outputSequence.GetNumberOfDataNodes(), 3)
+    for frameIndex in range(3):
+      self.assertEqual(outputSequence.GetNthIndexValue(frameIndex), str(frameIndex))
+      self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputSequence.GetNthDataNode(frameIndex)), expectedFrames[frameIndex]))
+
+    # Frames are clipped on a background thread, the output sequence is updated when the task is finished
+    backgroundOutputSequence = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode")
+    clipTask = logic.startClipSequenceWithRoi(roiNode, inputSequence, fillValue, False, backgroundOutputSequence)
+    clipTask.runInBackground()
+    self.assertEqual(len(clipTask.finish()), 3)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(backgroundOutputSequence.GetNthDataNode(2)), expectedFrames[2]))
+
+    sequenceBrowserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+    sequenceBrowserNode.SetAndObserveMasterSequenceNodeID(inputSequence.GetID())
+    sequenceBrowserNode.SetSelectedItemNumber(1)
+    sequenceOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.startSequenceClipping(roiNode, sequenceBrowserNode, inputSequence, fillValue, False, sequenceOutputVolume)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(sequenceOutputVolume), expectedFrames[1]))
+    # Next frame is clipped in advance, it is not clipped again when it is selected
+    sequenceBrowserNode.SetSelectedItemNumber(2)
+    self.assertTrue(logic.updateSequenceClipping())
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(sequenceOutputVolume), expectedFrames[2]))
+    self.assertEqual(logic.getFrameCacheStatistics()["misses"], 1)
+    logic.stopSequenceClipping()
+    self.assertIsNone(logic.getFrameCacheStatistics())
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiInPlace(self):
+    """In-place clipping must give the same result, without replacing the image of the volume"""
+
+    inputVolume = self.createSyntheticVolume()
+    roiNode = self.createObliqueRoi()
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, False, expectedVolume)
+
+    inputImageData = inputVolume.GetImageData()
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, False, inputVolume)
+    self.assertEqual(inputVolume.GetImageData(), inputImageData)
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(inputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiCrop(self):
+    """Cropped output must contain the voxels of the ROI bounding block at the same physical position as in the input"""
+
+    self.delayDisplay("Creating synthetic volume")
+    inputVolume = self.createSyntheticVolume()
+    inputVoxels = slicer.util.arrayFromVolume(inputVolume)
+    inputIjkToRasMatrix = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(inputIjkToRasMatrix)
+    inputIjkToRas = VolumeClipLib.getNumpyMatrix(inputIjkToRasMatrix)
+
+    roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+    roiNode.SetCenter(0, -5, 35)
+    roiNode.SetSize(30, 20, 25)
+
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    clippedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+
+    for axisAligned in [True, False]:
+      if not axisAligned:
+        roiToWorld = vtk.vtkTransform()
+        roiToWorld.Translate(0, -5, 35)
+        roiToWorld.RotateWXYZ(30, 1, 2, 3)
+        roiToWorld.Translate(0, 5, -35)
+        roiNode.ApplyTransformMatrix(roiToWorld.GetMatrix())
+
+      self.assertTrue(logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, True, outputVolume, cropToRoi=True))
+      logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, True, clippedVolume)
+
+      roiBounds, ijkToBox = logic.getIjkToBoxMatrix(roiNode, inputVolume.GetImageData(), inputIjkToRasMatrix)
+      croppedSlices = VolumeClipLib.getBoxBoundingSlices(ijkToBox, roiBounds, inputVolume.GetImageData().GetExtent())
+      self.assertEqual(VolumeClipLib.getAxisAlignedBoxSlices(ijkToBox, roiBounds, inputVolume.GetImageData().GetExtent()) is not None, axisAligned)
+      kSlice, jSlice, iSlice = croppedSlices
+
+      # Voxels are the cropped block of the clipped volume (all voxels are inside the ROI if it is axis-aligned)
+      outputVoxels = slicer.util.arrayFromVolume(outputVolume)
+      self.assertTrue(np.array_equal(outputVoxels, slicer.util.arrayFromVolume(clippedVolume)[croppedSlices]))
+      if axisAligned:
+        self.assertTrue(np.array_equal(outputVoxels, inputVoxels[croppedSlices]))
+
+      # First output voxel is at the position of the first voxel of the cropped block in the input
+      outputIjkToRas = vtk.vtkMatrix4x4()
+      outputVolume.GetIJKToRASMatrix(outputIjkToRas)
+      outputIjkToRas = VolumeClipLib.getNumpyMatrix(outputIjkToRas)
+      self.assertTrue(np.allclose(outputIjkToRas[:3, :3], inputIjkToRas[:3, :3]))
+      self.assertTrue(np.allclose(np.dot(outputIjkToRas, [0, 0, 0, 1]),
+        np.dot(inputIjkToRas, [iSlice.start, jSlice.start, kSlice.start, 1])))
+
+    # Crop fails if the ROI does not intersect the volume
+    roiNode.SetCenter(500, 500, 500)
+    self.assertFalse(logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, True, outputVolume, cropToRoi=True))
+
+    self.delayDisplay("Test passed!")
+
+  def test_VolumeClipWithRoiFile(self):
+    """Clipping a volume file slab by slab must give the same result as clipping the loaded volume"""
+
+    self.delayDisplay("Creating synthetic volume file")
+    inputVolume = self.createSyntheticVolume()
+    inputFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithRoiFileInput.nrrd")
+    outputFilePath = os.path.join(slicer.app.temporaryPath, "VolumeClipWithRoiFileOutput.nrrd")
+    slicer.util.saveNode(inputVolume, inputFilePath, {"useCompression": False})
+
+    roiNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsROINode")
+    roiNode.SetCenter(0, -5, 35)
+    roiNode.SetSize(30, 20, 25)
+
+    logic = VolumeClipWithRoiLogic()
+    fillValue = -7
+    expectedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.clipVolumeWithRoi(roiNode, inputVolume, fillValue, True, expectedVolume)
+
+    self.delayDisplay("Clipping volume file")
+    # Use small slabs to test processing of multiple slabs
+    logic.clipVolumeFileWithRoi(roiNode, inputFilePath, fillValue, True, outputFilePath, maxSlabSizeBytes=50*60*2*7)
+    outputVolume = slicer.util.loadVolume(outputFilePath)
+
+    self.assertTrue(np.array_equal(slicer.util.arrayFromVolume(outputVolume), slicer.util.arrayFromVolume(expectedVolume)))
+    outputIjkToRas = vtk.vtkMatrix4x4()
+    outputVolume.GetIJKToRASMatrix(outputIjkToRas)
+    expectedIjkToRas = vtk.vtkMatrix4x4()
+    expectedVolume.GetIJKToRASMatrix(expectedIjkToRas)
+    self.assertTrue(np.allclose(VolumeClipLib.getNumpyMatrix(outputIjkToRas), VolumeClipLib.getNumpyMatrix(expectedIjkToRas)))
+
+    self.delayDisplay("Test passed!")